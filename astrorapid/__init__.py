@@ -1,3 +1,5 @@
 from astrorapid.classify import Classify
+from astrorapid.single_object import SingleObjectClassifier
+from astrorapid.parallelism import set_parallelism, get_parallelism
 
 name = "astrorapid"
@@ -0,0 +1,128 @@
+"""
+Content-addressed cache of the artifacts of the training pipeline
+
+Each stage of the pipeline (ingest -> arrays -> split -> model -> metrics) saves its artifacts in a directory named
+after a hash of the stage name, its parameters and the keys of its upstream artifacts (or the content hash of an input
+file). A manifest records the completed artifacts, so a stage is only recomputed when its own parameters or one of its
+inputs changed, and changing a stage invalidates everything downstream of it.
+"""
+import os
+import json
+import time
+import hashlib
+
+
+def hash_params(*args):
+    """ Returns a short sha256 hex digest of JSON-serialisable arguments (dict keys are sorted) """
+    text = json.dumps(args, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+
+class ArtifactCache(object):
+    def __init__(self, cache_dir):
+        """ Cache of pipeline artifacts with a manifest.
+
+        Parameters
+        ----------
+        cache_dir : str
+            Directory of the cache. The artifacts of stage `stage` with key `key` are saved in
+            `cache_dir/stage/key/` and the manifest in `cache_dir/manifest.json`.
+
+        """
+        self.cache_dir = cache_dir
+        self.manifest_path = os.path.join(cache_dir, 'manifest.json')
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'artifacts': {}, 'file_hashes': {}}
+
+    def _save_manifest(self):
+        # Replace the manifest atomically so an interrupted run never leaves a partial manifest
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def file_hash(self, fpath, block_size=1 << 20):
+        """ Returns the sha256 hex digest of the content of an input file. The digest is remembered in the manifest
+        with the size and modification time of the file, so an unchanged file is only read once. """
+        fpath = os.path.abspath(fpath)
+        stat = os.stat(fpath)
+        entry = self.manifest['file_hashes'].get(fpath)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry['sha256']
+
+        print("Hashing", fpath)
+        sha = hashlib.sha256()
+        with open(fpath, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                sha.update(block)
+        self.manifest['file_hashes'][fpath] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                                               'sha256': sha.hexdigest()}
+        self._save_manifest()
+        return sha.hexdigest()
+
+    def get_key(self, stage, params, upstream=()):
+        """ Returns the key of the artifact of a stage from its parameters and the keys (or file hashes) of its
+        upstream artifacts """
+        return hash_params(stage, params, list(upstream))
+
+    def get_dir(self, stage, key):
+        """ Returns the directory of an artifact, creating it if needed """
+        artifact_dir = os.path.join(self.cache_dir, stage, key)
+        if not os.path.exists(artifact_dir):
+            os.makedirs(artifact_dir)
+        return artifact_dir
+
+    def is_complete(self, stage, key):
+        """ Returns True if the artifact has been recorded and all its files exist """
+        entry = self.manifest['artifacts'].get('{}/{}'.format(stage, key))
+        if entry is None:
+            return False
+        artifact_dir = os.path.join(self.cache_dir, stage, key)
+        return all(os.path.exists(os.path.join(artifact_dir, fname)) for fname in entry['files'])
+
+    def get_files(self, stage, key):
+        """ Returns the paths of the files of a recorded artifact """
+        entry = self.manifest['artifacts']['{}/{}'.format(stage, key)]
+        artifact_dir = os.path.join(self.cache_dir, stage, key)
+        return [os.path.join(artifact_dir, fname) for fname in entry['files']]
+
+    def find_latest(self, stage, params):
+        """ Returns the key of the most recent complete artifact of a stage made with the same parameters (from any
+        upstream artifacts), or None if there is none """
+        params = json.loads(json.dumps(params, default=str))
+        entries = [entry for entry in self.manifest['artifacts'].values()
+                   if entry['stage'] == stage and entry['params'] == params and self.is_complete(stage, entry['key'])]
+        if not entries:
+            return None
+        return max(entries, key=lambda entry: entry['created'])['key']
+
+    def record(self, stage, key, params, upstream=(), files=None):
+        """ Record a completed artifact in the manifest.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage.
+        key : str
+            Key of the artifact from `get_key`.
+        params : dict
+            Parameters of the stage.
+        upstream : list
+            Keys of the upstream artifacts.
+        files : list, optional
+            Names of the files of the artifact. The default is all the files in the artifact directory.
+
+        """
+        artifact_dir = self.get_dir(stage, key)
+        if files is None:
+            files = sorted(os.listdir(artifact_dir))
+        self.manifest['artifacts']['{}/{}'.format(stage, key)] = {
+            'stage': stage, 'key': key, 'params': json.loads(json.dumps(params, default=str)),
+            'upstream': list(upstream), 'files': list(files), 'created': time.strftime('%Y-%m-%d %H:%M:%S')}
+        self._save_manifest()
+        print("Cached {} artifact {}".format(stage, key))
@@ -6,7 +6,7 @@ from distutils.spawn import find_executable
 from sklearn.metrics import roc_curve, auc
 from sklearn.metrics import precision_recall_curve
 from sklearn.metrics import average_precision_score
-from scipy import interp
+from numpy import interp
 
 try:
     import matplotlib
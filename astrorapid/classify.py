@@ -7,6 +7,7 @@ from distutils.spawn import find_executable
 
 from astrorapid.process_light_curves import read_multiple_light_curves
 from astrorapid.prepare_arrays import PrepareInputArrays
+from astrorapid.parallelism import configure_tensorflow
 
 try:
     import matplotlib.pyplot as plt
@@ -66,6 +67,7 @@ class Classify(object):
             Do not set unless you know what you are doing.
             If you are running astrorapid in multiple threads you may need to predefine this
             This would have been created with keras' load_model function e.g. model = load_model('keras_model.hdf5')
+            If given, the model is used instead of loading model_filepath again (with or without a graph).
 
         """
         self.light_curves = light_curves
@@ -91,8 +93,9 @@ class Classify(object):
                 self.model_filepath = resource_filename(__name__, 'keras_model_with_redshift.hdf5')
 
         print(self.model_filepath)
+        configure_tensorflow()
         self.graph = graph
-        if graph is not None and model is not None:
+        if model is not None:
             self.model = model
         else:
             self.model = load_model(self.model_filepath)
@@ -132,36 +135,63 @@ class Classify(object):
             print("No objects to classify. These may have been removed from the chosen selection cuts")
             return None, None
 
-        if self.graph is not None:
-            with self.graph.as_default():
-                self.y_predict = self.model.predict(self.X)
-        else:
-            self.y_predict = self.model.predict(self.X)
+        self.y_predict = self.run_model(self.model, self.X, self.graph)
+
+        return self.get_time_step_predictions(self.y_predict, self.timesX, self.trigger_mjds, self.orig_lc,
+                                              self.passbands, return_predictions_at_obstime)
+
+    @staticmethod
+    def run_model(model, X, graph=None):
+        """ Returns the class probabilities of the model at each of the 50 time steps of the input arrays X """
+        if graph is not None:
+            with graph.as_default():
+                return model.predict(X, verbose=0)
+        return model.predict(X, verbose=0)
 
-        argmax = self.timesX.argmax(axis=1) + 1
+    @staticmethod
+    def get_time_step_predictions(y_predict, timesX, trigger_mjds, orig_lc=None, passbands=('g', 'r'),
+                                  return_predictions_at_obstime=False):
+        """ Cut the model output of each light curve to its time steps, or interpolate it to its observation times.
+        The arguments are the model output and the arrays of PrepareInputArrays.prepare_input_arrays (orig_lc is only
+        needed with return_predictions_at_obstime). Returns y_predict and time_steps as in get_predictions. """
+        nobjects = len(y_predict)
+        argmax = timesX.argmax(axis=1) + 1
 
         if return_predictions_at_obstime:
-            (s, n, m) = self.y_predict.shape  # (s, n, m) = (num light curves, num timesteps, num classes)
-            y_predict = []
+            (s, n, m) = y_predict.shape  # (s, n, m) = (num light curves, num timesteps, num classes)
+            y_predict_at_obstimes = []
             time_steps = []
             for idx in range(s):
                 obs_time = []
-                for pb in self.passbands:
-                    if pb in self.orig_lc[idx]:
-                        obs_time.append(self.orig_lc[idx][pb]['time'].values)
+                for pb in passbands:
+                    if pb in orig_lc[idx]:
+                        obs_time.append(orig_lc[idx][pb]['time'].values)
                 obs_time = np.array(obs_time)
                 obs_time = np.sort(obs_time[~np.isnan(obs_time)])
                 y_predict_at_obstime = []
-                for classnum, classname in enumerate(CLASS_NAMES):
-                    y_predict_at_obstime.append(np.interp(obs_time, self.timesX[idx][:argmax[idx]], self.y_predict[idx][:, classnum][:argmax[idx]]))
-                y_predict.append(np.array(y_predict_at_obstime).T)
-                time_steps.append(obs_time + self.trigger_mjds[idx])
-        else:
-            y_predict = [self.y_predict[i][:argmax[i]] for i in range(nobjects)]
-            time_steps = [self.timesX[i][:argmax[i]] + self.trigger_mjds[i] for i in range(nobjects)]
+                for classnum in range(m):
+                    y_predict_at_obstime.append(np.interp(obs_time, timesX[idx][:argmax[idx]], y_predict[idx][:, classnum][:argmax[idx]]))
+                y_predict_at_obstimes.append(np.array(y_predict_at_obstime).T)
+                time_steps.append(obs_time + trigger_mjds[idx])
+            return y_predict_at_obstimes, time_steps
+
+        y_predict = [y_predict[i][:argmax[i]] for i in range(nobjects)]
+        time_steps = [timesX[i][:argmax[i]] + trigger_mjds[i] for i in range(nobjects)]
 
         return y_predict, time_steps
 
+    @classmethod
+    def predict_arrays(cls, model, X, timesX, trigger_mjds, orig_lc=None, passbands=('g', 'r'), graph=None,
+                       return_predictions_at_obstime=False):
+        """ Classify light curves prepared by PrepareInputArrays.prepare_input_arrays with a loaded model.
+
+        Unlike get_predictions, nothing is printed or stored and TensorFlow is not configured again, so a service
+        can call it for every batch with the same model. Returns y_predict and time_steps as in get_predictions.
+        """
+        y_predict = cls.run_model(model, X, graph)
+        return cls.get_time_step_predictions(y_predict, timesX, trigger_mjds, orig_lc, passbands,
+                                             return_predictions_at_obstime)
+
     def plot_light_curves_and_classifications(self, indexes_to_plot=None, step=True, use_interp_flux=False):
         """
         Plot light curve (top panel) and classifications (bottom panel) vs time.
@@ -0,0 +1,31 @@
+"""
+The astrorapid command
+
+    astrorapid serve [options]        run a local classification service (see serve.py)
+    astrorapid benchmark [options]    measure the latency of classifying one alert (see latency_benchmark.py)
+"""
+import argparse
+
+from astrorapid import serve, latency_benchmark
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='astrorapid')
+    subparsers = parser.add_subparsers(dest='command')
+    serve_parser = subparsers.add_parser('serve', help="Run a local classification service that batches "
+                                                       "concurrent requests.")
+    serve.add_arguments(serve_parser)
+    serve_parser.set_defaults(func=serve.serve)
+    benchmark_parser = subparsers.add_parser('benchmark', help="Measure the latency of classifying one alert.")
+    latency_benchmark.add_arguments(benchmark_parser)
+    benchmark_parser.set_defaults(func=latency_benchmark.benchmark)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+import numpy as np
+import keras
+from keras.utils import Sequence, to_categorical
+
+KERAS_MAJOR_VERSION = int(keras.__version__.split('.')[0])
+
+
+class TrainingSequence(Sequence):
+    def __init__(self, X, y, sample_weights=None, batch_size=64, shuffle=True, block_size=1024, buffer_blocks=16,
+                 num_classes=None, class_lut=None, seed=42, workers=1, use_multiprocessing=False, max_queue_size=10):
+        """ Mini-batches of training data read from (memory mapped) arrays, for model.fit.
+
+        Only one batch is held in memory at a time, so the arrays can be larger than RAM. Shuffling reads from
+        the disk in large contiguous blocks: every epoch the order of the blocks of `block_size` rows is shuffled,
+        and the rows are shuffled within a buffer of `buffer_blocks` consecutive blocks of that order.
+
+        Parameters
+        ----------
+        X : array
+            Input array of shape (nobjects, ntimesteps, nfeatures). Usually a memmap, a slice of one, or a
+            LazyIndexedArray.
+        y : array
+            Labels. Either one-hot of shape (nobjects, ntimesteps, nclasses) or integer class indexes of shape
+            (nobjects, ntimesteps).
+        sample_weights : array, optional
+            Weight of each object, or of each timestep of each object.
+        batch_size : int
+            Number of objects in each batch.
+        shuffle : bool
+            Shuffle the objects every epoch.
+        block_size : int
+            Number of consecutive rows read together when shuffling.
+        buffer_blocks : int
+            Number of blocks that the rows are shuffled between.
+        num_classes : int, optional
+            If given, integer labels are one-hot encoded one batch at a time, so that a model trained with
+            categorical_crossentropy doesn't need a one-hot y on disk.
+        class_lut : array, optional
+            If given, lookup table from the class numbers in y to the class indexes, applied to each batch before
+            the one-hot encoding, so that y can be the saved array of class numbers.
+        seed : int
+            Seed of the shuffle.
+        workers, use_multiprocessing, max_queue_size :
+            Number of workers loading batches in parallel and number of batches prefetched. With Keras 2 these are
+            arguments of model.fit instead (see `get_fit_kwargs`).
+
+        """
+        if KERAS_MAJOR_VERSION >= 3:
+            super(TrainingSequence, self).__init__(workers=workers, use_multiprocessing=use_multiprocessing,
+                                                   max_queue_size=max_queue_size)
+        self.loader_kwargs = {'workers': workers, 'use_multiprocessing': use_multiprocessing,
+                              'max_queue_size': max_queue_size}
+        self.X = X
+        self.y = y
+        self.sample_weights = sample_weights
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.block_size = block_size
+        self.buffer_blocks = buffer_blocks
+        self.num_classes = num_classes
+        self.class_lut = class_lut
+        self.rng = np.random.RandomState(seed)
+        self.nobjects = len(X)
+        self.order = np.arange(self.nobjects)
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.ceil(self.nobjects / self.batch_size))
+
+    def on_epoch_end(self):
+        if not self.shuffle:
+            return
+        blocks = np.arange(0, self.nobjects, self.block_size)
+        self.rng.shuffle(blocks)
+        order = np.concatenate([np.arange(start, min(start + self.block_size, self.nobjects)) for start in blocks])
+        buffer_size = self.block_size * self.buffer_blocks
+        for start in range(0, self.nobjects, buffer_size):
+            self.rng.shuffle(order[start:start + buffer_size])
+        self.order = order
+
+    def __getitem__(self, index):
+        rows = self.order[index * self.batch_size:(index + 1) * self.batch_size]
+        # Read in increasing row order, then restore the shuffled order
+        sort = np.argsort(rows)
+        unsort = np.argsort(sort)
+        sorted_rows = rows[sort]
+
+        X_batch = np.asarray(self.X[sorted_rows])[unsort]
+        y_batch = np.asarray(self.y[sorted_rows])[unsort]
+        if self.class_lut is not None:
+            y_batch = self.class_lut[y_batch]
+        if self.num_classes is not None and y_batch.ndim == 2:
+            y_batch = to_categorical(y_batch, num_classes=self.num_classes)
+        if self.sample_weights is None:
+            return X_batch, y_batch
+        weights_batch = np.asarray(self.sample_weights[sorted_rows])[unsort]
+        return X_batch, y_batch, weights_batch
+
+    def get_fit_kwargs(self):
+        """ Returns the keyword arguments of model.fit that set the parallel loading (only needed with Keras 2). """
+        if KERAS_MAJOR_VERSION >= 3:
+            return {}
+        return self.loader_kwargs
@@ -1,13 +1,8 @@
 from astrorapid.classify import Classify
 
 
-def main(graph=None, model=None):
-    """
-    Example code to run astrorapid.
-
-    Ignore the graph and model parameter inputs unless you wish to do your own multithreading.
-    (Note: astrorapid already performs its own parallelisation based on a keras and tensorflow backend).
-    """
+def get_example_light_curve():
+    """ Returns the light curve of the example as a tuple in the form used by Classify. """
 
     mjd = [57433.4816, 57436.4815, 57439.4817, 57451.4604, 57454.4397, 57459.3963, 57462.418, 57465.4385, 57468.3768,
            57473.3606, 57487.3364, 57490.3341, 57493.3154, 57496.3352, 57505.3144, 57513.2542, 57532.2717, 57536.2531,
@@ -42,7 +37,18 @@ def main(graph=None, model=None):
     redshift = 0.233557
     mwebv = 0.0228761
 
-    light_curve_list = [(mjd, flux, fluxerr, passband, zeropoint, photflag, ra, dec, objid, redshift, mwebv)]
+    return mjd, flux, fluxerr, passband, zeropoint, photflag, ra, dec, objid, redshift, mwebv
+
+
+def main(graph=None, model=None):
+    """
+    Example code to run astrorapid.
+
+    Ignore the graph and model parameter inputs unless you wish to do your own multithreading.
+    (Note: astrorapid already performs its own parallelisation based on a keras and tensorflow backend).
+    """
+
+    light_curve_list = [get_example_light_curve()]
 
     classification = Classify(light_curve_list, known_redshift=True, graph=graph, model=model)
     predictions, time_steps = classification.get_predictions(return_predictions_at_obstime=False)
@@ -1,3 +1,4 @@
+import time
 import numpy as np
 
 
@@ -78,6 +79,11 @@ def get_sntypes():
     return sntypes_map
 
 
+def get_variable_sntypes():
+    """ Model numbers of the variable (non-transient) classes removed by the variables cut. """
+    return (50, 70, 80, 81, 83, 84, 90, 91, 92, 93)
+
+
 def aggregate_sntypes(reverse=False):
     if reverse:
         aggregate_map = {99: (45, 61, 62, 63, 90, 92),
@@ -125,3 +131,33 @@ def aggregate_sntypes(reverse=False):
                          }
 
     return aggregate_map
+
+
+def describe_error(error):
+    """ Returns the reason recorded for an object whose processing raised error """
+    return '{}: {}'.format(type(error).__name__, error)
+
+
+def call_with_retries(func, *args, ntries=3, delay=1., exceptions=(OSError,), **kwargs):
+    """ Call func(*args, **kwargs), retrying after a transient I/O error.
+
+    Parameters
+    ----------
+    func : callable
+        Function to call.
+    ntries : int
+        Maximum number of calls. The exception of the last call is raised.
+    delay : float
+        Seconds to wait before the first retry. The wait doubles after each retry.
+    exceptions : tuple
+        Exception types that are retried. Other exceptions are raised straight away.
+
+    """
+    for i in range(ntries):
+        try:
+            return func(*args, **kwargs)
+        except exceptions as e:
+            if i == ntries - 1:
+                raise
+            print("Retrying {} after {}: {}".format(getattr(func, '__name__', func), type(e).__name__, e))
+            time.sleep(delay * 2 ** i)
@@ -0,0 +1,85 @@
+"""
+Latency of classifying one alert
+
+    astrorapid benchmark --n 500 --compare
+
+Classifies the same light curve many times with SingleObjectClassifier and reports the percentiles of the time per
+alert. With --compare, the same is done with Classify and the largest difference between the predictions of the two
+paths is printed. The light curve is the one of example.py unless a JSON file is given with --light_curve, in the
+format of the light curves of `astrorapid serve`.
+"""
+import io
+import json
+import time
+import contextlib
+
+import numpy as np
+
+from astrorapid.classify import Classify
+from astrorapid.single_object import SingleObjectClassifier
+from astrorapid.example import get_example_light_curve
+from astrorapid.serve import light_curve_from_json
+
+
+def time_calls(func, n, nwarmup):
+    """ Returns the times in seconds of n calls of func, after nwarmup calls that are not timed """
+    for i in range(nwarmup):
+        func()
+    times = np.zeros(n)
+    for i in range(n):
+        start = time.perf_counter()
+        func()
+        times[i] = time.perf_counter() - start
+    return times
+
+
+def print_latency(name, times):
+    p50, p90, p99 = 1e3 * np.percentile(times, [50, 90, 99])
+    print("{:>24}: p50 {:8.2f}ms  p90 {:8.2f}ms  p99 {:8.2f}ms  mean {:8.2f}ms  max {:8.2f}ms  ({} alerts)".format(
+        name, p50, p90, p99, 1e3 * times.mean(), 1e3 * times.max(), len(times)))
+
+
+def benchmark(args):
+    """ Run the benchmark with the arguments parsed by astrorapid.cli """
+    if args.light_curve:
+        with open(args.light_curve) as f:
+            light_curve = light_curve_from_json(json.load(f))
+    else:
+        light_curve = light_curve_from_json(list(get_example_light_curve()))
+
+    classifier = SingleObjectClassifier(known_redshift=not args.no_redshift, model_filepath=args.model or '',
+                                        passbands=tuple(args.passbands))
+    y_predict, time_steps = classifier.get_predictions(light_curve)
+    if y_predict is None:
+        print("The light curve was removed by the selection cuts")
+        return
+
+    times = time_calls(lambda: classifier.get_predictions(light_curve), args.n, args.warmup)
+    print_latency('SingleObjectClassifier', times)
+
+    if args.compare:
+        def classify():
+            classification = Classify([light_curve], known_redshift=not args.no_redshift,
+                                      model_filepath=args.model or '', passbands=tuple(args.passbands),
+                                      model=classifier.model)
+            return classification.get_predictions()
+
+        # Classify prints a progress line for every light curve and model call
+        with contextlib.redirect_stdout(io.StringIO()):
+            y_predict_classify, time_steps_classify = classify()
+            times_classify = time_calls(classify, args.n, args.warmup)
+        print_latency('Classify', times_classify)
+        print("Speed-up of the median: {:.1f}x".format(np.median(times_classify) / np.median(times)))
+        print("Largest difference of the probabilities: {:.2g}, of the time steps: {:.2g}".format(
+            np.abs(y_predict - y_predict_classify[0]).max(), np.abs(time_steps - time_steps_classify[0]).max()))
+
+
+def add_arguments(parser):
+    """ Add the arguments of `astrorapid benchmark` to an argparse parser """
+    parser.add_argument("--n", type=int, default=200, help="Number of timed alerts. Default is 200.")
+    parser.add_argument("--warmup", type=int, default=10, help="Number of untimed alerts first. Default is 10.")
+    parser.add_argument("--light_curve", type=str, help="JSON file of the light curve. Default is the example.")
+    parser.add_argument("--model", type=str, help="Keras model file. Default is the pre-trained ZTF model.")
+    parser.add_argument("--no_redshift", action='store_true', help="Use the model for unknown redshifts.")
+    parser.add_argument("--passbands", type=str, nargs='+', default=['g', 'r'], help="Passbands. Default is g r.")
+    parser.add_argument("--compare", action='store_true', help="Also time Classify and compare the predictions.")
@@ -0,0 +1,555 @@
+"""
+Consolidated columnar HDF5 storage for preprocessed light curves.
+
+Instead of one PyTables group per object, all observations are stored in flat, chunked and compressed datasets,
+with an objid -> offset index and a per-object table of the `otherinfo` values. Reading many objects is then a few
+large sequential reads instead of one small read per object.
+
+File layout::
+
+    /observations/time, flux, fluxErr, photflag, passband    (one row per observation)
+    /objects/objid, offset, nobs, otherinfo, ninfo            (one row per object)
+
+The observations of each object are contiguous and grouped by passband. `passband` is an index into the `passbands`
+file attribute.
+"""
+import os
+import h5py
+import numpy as np
+import pandas as pd
+
+from astrorapid.parallelism import make_pool
+
+STORE_FORMAT = 'astrorapid_light_curve_store'
+OBS_FIELDS = ('time', 'flux', 'fluxErr', 'photflag')
+OBS_DTYPES = {'time': np.float64, 'flux': np.float64, 'fluxErr': np.float64, 'photflag': np.int32,
+              'passband': np.uint8}
+OBJID_DTYPE = 'S64'
+
+
+def is_light_curve_store(fname):
+    """ Return True if fname is a consolidated light curve store rather than a pandas HDFStore. """
+    try:
+        with h5py.File(fname, 'r') as hdffile:
+            return hdffile.attrs.get('format') == STORE_FORMAT
+    except OSError:
+        return False
+
+
+def _get_passbands(hdffile):
+    return tuple(str(pb) for pb in np.asarray(hdffile.attrs['passbands']).astype(str))
+
+
+def light_curve_to_arrays(data, passbands):
+    """ Convert a preprocessed light curve DataFrame into flat observation arrays.
+
+    Parameters
+    ----------
+    data : pandas DataFrame
+        Multi-index DataFrame as returned by `InputLightCurve.preprocess_light_curve`.
+    passbands : tuple
+        Passbands to store. Their position in this tuple is saved as the passband index.
+
+    Returns
+    -------
+    arrays : dict
+        Flat arrays for each of OBS_FIELDS and passband, grouped by passband.
+    otherinfo : array
+        The otherinfo values of the light curve.
+    """
+    arrays = {field: [] for field in OBS_FIELDS + ('passband',)}
+    for pbidx, pb in enumerate(passbands):
+        if pb not in data:
+            continue
+        time = data[pb]['time'].dropna()
+        arrays['passband'].append(np.full(len(time), pbidx, dtype=OBS_DTYPES['passband']))
+        for field in OBS_FIELDS:
+            arrays[field].append(data[pb][field][time.index].values.astype(OBS_DTYPES[field]))
+    arrays = {field: np.concatenate(values) if values else np.zeros(0, dtype=OBS_DTYPES[field])
+              for field, values in arrays.items()}
+    # The otherinfo column is padded with NaNs to the number of observations in the DataFrame, so drop the padding
+    otherinfo = data['otherinfo'].values.flatten().astype(np.float64)
+    finite = np.flatnonzero(~np.isnan(otherinfo))
+    otherinfo = otherinfo[:finite[-1] + 1] if len(finite) else otherinfo[:0]
+
+    return arrays, otherinfo
+
+
+def arrays_to_light_curve(arrays, otherinfo, passbands):
+    """ Rebuild the preprocessed light curve DataFrame from flat observation arrays (inverse of light_curve_to_arrays).
+    """
+    columns = {}
+    for pbidx, pb in enumerate(passbands):
+        mask = arrays['passband'] == pbidx
+        if not np.any(mask):
+            continue
+        for field in OBS_FIELDS:
+            columns[(pb, field)] = pd.Series(arrays[field][mask], dtype=np.float64)
+    columns[('otherinfo', 0)] = pd.Series(otherinfo)
+
+    return pd.DataFrame(columns)
+
+
+class LightCurveStoreWriter(object):
+    def __init__(self, fname, passbands=('g', 'r'), buffer_objects=1000, mode='w'):
+        """ Write preprocessed light curves to a consolidated light curve store.
+
+        Parameters
+        ----------
+        fname : str
+            File path of the store.
+        passbands : tuple
+            Passbands to store.
+        buffer_objects : int
+            Number of objects buffered in memory before they are appended to the datasets.
+        mode : str
+            'w' to create a new store or 'a' to append to an existing one.
+
+        """
+        self.fname = fname
+        self.buffer_objects = buffer_objects
+        self.hdffile = h5py.File(fname, mode)
+
+        if STORE_FORMAT != self.hdffile.attrs.get('format'):
+            self.passbands = tuple(passbands)
+            self.hdffile.attrs['format'] = STORE_FORMAT
+            self.hdffile.attrs['passbands'] = np.array(self.passbands, dtype='S')
+            for field in OBS_FIELDS + ('passband',):
+                self.hdffile.create_dataset('observations/{}'.format(field), shape=(0,), maxshape=(None,),
+                                            dtype=OBS_DTYPES[field], chunks=(65536,), compression='gzip',
+                                            compression_opts=4, shuffle=True)
+            self.hdffile.create_dataset('objects/objid', shape=(0,), maxshape=(None,), dtype=OBJID_DTYPE,
+                                        chunks=(4096,))
+            self.hdffile.create_dataset('objects/offset', shape=(0,), maxshape=(None,), dtype=np.int64,
+                                        chunks=(4096,))
+            self.hdffile.create_dataset('objects/nobs', shape=(0,), maxshape=(None,), dtype=np.int64,
+                                        chunks=(4096,))
+            self.hdffile.create_dataset('objects/ninfo', shape=(0,), maxshape=(None,), dtype=np.int16,
+                                        chunks=(4096,))
+        else:
+            self.passbands = _get_passbands(self.hdffile)
+
+        self._clear_buffer()
+
+    def _clear_buffer(self):
+        self._objids = []
+        self._arrays = []
+        self._otherinfo = []
+
+    def append(self, objid, data):
+        """ Add the preprocessed light curve DataFrame of one object. """
+        arrays, otherinfo = light_curve_to_arrays(data, self.passbands)
+        self.append_arrays(objid, arrays, otherinfo)
+
+    def append_arrays(self, objid, arrays, otherinfo):
+        """ Add one object from flat observation arrays (see light_curve_to_arrays). """
+        self._objids.append(objid)
+        self._arrays.append(arrays)
+        self._otherinfo.append(np.asarray(otherinfo, dtype=np.float64))
+        if len(self._objids) >= self.buffer_objects:
+            self.flush()
+
+    def flush(self):
+        """ Append the buffered objects to the datasets. """
+        nobjects = len(self._objids)
+        if nobjects == 0:
+            return
+
+        ninfo = np.array([len(info) for info in self._otherinfo], dtype=np.int64)
+        otherinfo = np.full((nobjects, ninfo.max()), np.nan)
+        for i, info in enumerate(self._otherinfo):
+            otherinfo[i, :len(info)] = info
+        nobs = np.array([len(arrays['time']) for arrays in self._arrays], dtype=np.int64)
+
+        batch = {field: np.concatenate([arrays[field] for arrays in self._arrays])
+                 for field in OBS_FIELDS + ('passband',)}
+        batch.update({'objid': self._objids, 'offsets': np.concatenate(([0], np.cumsum(nobs))),
+                      'otherinfo': otherinfo, 'ninfo': ninfo})
+        self._clear_buffer()
+        self.append_batch(batch)
+
+    def append_batch(self, batch):
+        """ Append a ragged batch of objects (in the format returned by `LightCurveStoreReader.read_batch`). """
+        self.flush()
+        nobjects = len(batch['objid'])
+        if nobjects == 0:
+            return
+
+        obs = self.hdffile['observations']
+        objects = self.hdffile['objects']
+        nobs = np.diff(batch['offsets'])
+        obs_start = obs['time'].shape[0]
+        obs_end = obs_start + batch['offsets'][-1]
+        for field in OBS_FIELDS + ('passband',):
+            obs[field].resize((obs_end,))
+            obs[field][obs_start:obs_end] = batch[field]
+
+        # otherinfo is padded with NaNs to the widest entry seen so far
+        ninfo = batch['otherinfo'].shape[1]
+        if 'otherinfo' not in objects:
+            objects.create_dataset('otherinfo', shape=(0, ninfo), maxshape=(None, None), dtype=np.float64,
+                                   chunks=(4096, ninfo), fillvalue=np.nan)
+        elif objects['otherinfo'].shape[1] < ninfo:
+            objects['otherinfo'].resize((objects['otherinfo'].shape[0], ninfo))
+        otherinfo = np.full((nobjects, objects['otherinfo'].shape[1]), np.nan)
+        otherinfo[:, :ninfo] = batch['otherinfo']
+
+        obj_start = objects['objid'].shape[0]
+        obj_end = obj_start + nobjects
+        for name in ('objid', 'offset', 'nobs', 'ninfo', 'otherinfo'):
+            objects[name].resize(obj_end, axis=0)
+        objects['objid'][obj_start:obj_end] = np.array(batch['objid'], dtype=OBJID_DTYPE)
+        objects['offset'][obj_start:obj_end] = obs_start + batch['offsets'][:-1]
+        objects['nobs'][obj_start:obj_end] = nobs
+        objects['ninfo'][obj_start:obj_end] = batch['ninfo']
+        objects['otherinfo'][obj_start:obj_end] = otherinfo
+
+    def close(self):
+        self.flush()
+        self.hdffile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class LightCurveStoreReader(object):
+    def __init__(self, fname):
+        """ Read light curves from a consolidated light curve store.
+
+        Parameters
+        ----------
+        fname : str
+            File path of the store.
+
+        """
+        self.fname = fname
+        self.hdffile = h5py.File(fname, 'r')
+        self.passbands = _get_passbands(self.hdffile)
+        objects = self.hdffile['objects']
+        self.objids = objects['objid'][:].astype(str)
+        self.offsets = objects['offset'][:]
+        self.nobs = objects['nobs'][:]
+        self.ninfo = objects['ninfo'][:]
+        self._rows = None
+
+    def __len__(self):
+        return len(self.objids)
+
+    def get_rows(self, objids):
+        """ Return the row of each objid in the store index. """
+        if self._rows is None:
+            self._rows = {objid: row for row, objid in enumerate(self.objids)}
+        return np.array([self._rows[str(objid)] for objid in objids], dtype=np.int64)
+
+    def read_batch(self, rows, max_gap=65536, max_row_gap=4096):
+        """ Read the observations of many objects as a ragged batch.
+
+        The rows are sorted by offset and objects within `max_gap` observations of each other are read with a single
+        contiguous read. Likewise, the otherinfo rows within `max_row_gap` rows of each other are read together.
+
+        Parameters
+        ----------
+        rows : array
+            Rows of the objects in the store index (see `get_rows`).
+        max_gap : int
+            Largest number of unneeded observations read to merge two reads into one.
+        max_row_gap : int
+            Largest number of unneeded otherinfo rows read to merge two reads into one.
+
+        Returns
+        -------
+        batch : dict
+            objid, otherinfo, ninfo (one entry per object, in the order of `rows`), flat arrays for each observation field,
+            and `offsets`, so that the observations of object i are [offsets[i]:offsets[i+1]].
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        order = np.argsort(self.offsets[rows], kind='stable')
+        obs = self.hdffile['observations']
+
+        parts = {field: [None] * len(rows) for field in OBS_FIELDS + ('passband',)}
+        start = 0
+        while start < len(order):
+            end = start + 1
+            run_end = self.offsets[rows[order[start]]] + self.nobs[rows[order[start]]]
+            while end < len(order) and self.offsets[rows[order[end]]] - run_end <= max_gap:
+                run_end = max(run_end, self.offsets[rows[order[end]]] + self.nobs[rows[order[end]]])
+                end += 1
+            run_start = self.offsets[rows[order[start]]]
+            blocks = {field: obs[field][run_start:run_end] for field in parts}
+            for i in order[start:end]:
+                lo = self.offsets[rows[i]] - run_start
+                hi = lo + self.nobs[rows[i]]
+                for field, block in blocks.items():
+                    parts[field][i] = block[lo:hi]
+            start = end
+
+        batch = {field: np.concatenate(values) if len(values) else np.zeros(0, dtype=OBS_DTYPES[field])
+                 for field, values in parts.items()}
+        batch['offsets'] = np.concatenate(([0], np.cumsum(self.nobs[rows])))
+        batch['objid'] = self.objids[rows]
+        batch['ninfo'] = self.ninfo[rows]
+        if len(rows):
+            sorted_rows = np.unique(rows)
+            otherinfo = self.hdffile['objects/otherinfo']
+            runs = np.split(sorted_rows, np.flatnonzero(np.diff(sorted_rows) > max_row_gap) + 1)
+            values = np.concatenate([otherinfo[run[0]:run[-1] + 1][run - run[0]] for run in runs])
+            batch['otherinfo'] = values[np.searchsorted(sorted_rows, rows)]
+        else:
+            # An empty store has no otherinfo dataset
+            batch['otherinfo'] = np.zeros((0, 0))
+
+        return batch
+
+    def iter_light_curves(self, objids):
+        """ Yield (objid, DataFrame) for each objid, in the same format as InputLightCurve.preprocess_light_curve.
+        """
+        return self.iter_rows(self.get_rows(objids))
+
+    def iter_rows(self, rows):
+        """ Yield (objid, DataFrame) for each row of the store index. """
+        batch = self.read_batch(rows)
+        offsets = batch['offsets']
+        for i, objid in enumerate(batch['objid']):
+            arrays = {field: batch[field][offsets[i]:offsets[i + 1]] for field in OBS_FIELDS + ('passband',)}
+            otherinfo = batch['otherinfo'][i][:batch['ninfo'][i]]
+            yield objid, arrays_to_light_curve(arrays, otherinfo, self.passbands)
+
+    def get_light_curve(self, objid):
+        """ Return the preprocessed light curve DataFrame of one object. """
+        return next(self.iter_light_curves([objid]))[1]
+
+    def close(self):
+        self.hdffile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class LightCurveList(object):
+    def __init__(self, fname, rows=None):
+        """ A list-like view of the light curves in a store that reads each light curve only when it is indexed.
+
+        Indexing with an integer returns the light curve DataFrame. Indexing with a slice or an array of indices
+        returns another LightCurveList, so train/test splits can be made without reading any light curves.
+
+        Parameters
+        ----------
+        fname : str
+            File path of the store.
+        rows : array, optional
+            Rows of the store index in the list. The default is all rows in the order of the store.
+
+        """
+        self.fname = fname
+        if rows is None:
+            with h5py.File(fname, 'r') as hdffile:
+                rows = np.arange(hdffile['objects/objid'].shape[0])
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self._reader = None
+
+    def __getstate__(self):
+        # The open file handle can't be pickled, so the copy reopens the store when it is first indexed
+        return {'fname': self.fname, 'rows': self.rows, '_reader': None}
+
+    @property
+    def reader(self):
+        if self._reader is None:
+            self._reader = LightCurveStoreReader(self.fname)
+        return self._reader
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return next(self.reader.iter_rows(self.rows[[index]]))[1]
+        return LightCurveList(self.fname, self.rows[index])
+
+    def __iter__(self):
+        for start in range(0, len(self.rows), 1000):
+            for objid, data in self.reader.iter_rows(self.rows[start:start + 1000]):
+                yield data
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+
+def combine_light_curve_stores(fnames, fname_out, mode='w'):
+    """ Concatenate several light curve stores into a new store.
+
+    Parameters
+    ----------
+    fnames : list
+        File paths of the light curve stores to combine. Files that cannot be read are skipped.
+    fname_out : str
+        File path of the combined store.
+    mode : str
+        'w' to create a new store or 'a' to append to an existing one.
+
+    Returns
+    -------
+    nobjects : int
+        Number of objects in the combined store.
+    """
+    writer = None
+    for n, fname in enumerate(fnames):
+        print(n, fname)
+        try:
+            reader = LightCurveStoreReader(fname)
+        except (OSError, KeyError) as e:
+            print("Failed to open file", fname)
+            print(e)
+            continue
+        if writer is None:
+            writer = LightCurveStoreWriter(fname_out, passbands=reader.passbands, mode=mode)
+        if writer.passbands != reader.passbands:
+            raise ValueError("Cannot combine {} with passbands {} into a store with passbands {}".format(
+                fname, reader.passbands, writer.passbands))
+
+        writer.append_batch(reader.read_batch(np.arange(len(reader))))
+        reader.close()
+
+    if writer is None:
+        return 0
+    writer.close()
+    with LightCurveStoreReader(fname_out) as reader:
+        return len(reader)
+
+
+def link_light_curve_stores(fnames, fname_out):
+    """ Combine several light curve stores into a master store without copying the observations.
+
+    The observation datasets of the master store are HDF5 virtual datasets that map onto the datasets of the input
+    files, so the cost does not depend on the number of observations. Only the small per-object index is copied. The
+    input files must be kept, and the master store can be read with LightCurveStoreReader like any other store. Use
+    `compact_light_curve_store` to turn it into a self-contained file.
+
+    Parameters
+    ----------
+    fnames : list
+        File paths of the light curve stores to combine. Files that cannot be read are skipped.
+    fname_out : str
+        File path of the master store.
+
+    Returns
+    -------
+    nobjects : int
+        Number of objects in the master store.
+    """
+    sources = []
+    passbands = None
+    for fname in fnames:
+        try:
+            with h5py.File(fname, 'r') as hdffile:
+                nobs = hdffile['observations/time'].shape[0]
+                if passbands is None:
+                    passbands = _get_passbands(hdffile)
+                elif passbands != _get_passbands(hdffile):
+                    raise ValueError("Cannot combine {} with passbands {} into a store with passbands {}".format(
+                        fname, _get_passbands(hdffile), passbands))
+        except (OSError, KeyError) as e:
+            print("Failed to open file", fname)
+            print(e)
+            continue
+        sources.append((os.path.abspath(fname), nobs))
+
+    total_nobs = sum(nobs for fname, nobs in sources)
+    with LightCurveStoreWriter(fname_out, passbands=passbands if passbands is not None else ()) as writer:
+        for field in OBS_FIELDS + ('passband',):
+            layout = h5py.VirtualLayout(shape=(total_nobs,), dtype=OBS_DTYPES[field])
+            start = 0
+            for fname, nobs in sources:
+                layout[start:start + nobs] = h5py.VirtualSource(fname, 'observations/{}'.format(field), shape=(nobs,))
+                start += nobs
+            del writer.hdffile['observations/{}'.format(field)]
+            writer.hdffile.create_virtual_dataset('observations/{}'.format(field), layout, fillvalue=0)
+        writer.hdffile.attrs['sources'] = np.array([fname for fname, nobs in sources], dtype='S')
+
+        obs_start = 0
+        objects = writer.hdffile['objects']
+        for fname, nobs in sources:
+            with h5py.File(fname, 'r') as hdffile:
+                src = hdffile['objects']
+                if 'otherinfo' not in src:
+                    continue
+                nobjects = src['objid'].shape[0]
+                obj_start = objects['objid'].shape[0]
+                obj_end = obj_start + nobjects
+                if 'otherinfo' not in objects:
+                    objects.create_dataset('otherinfo', shape=(0, src['otherinfo'].shape[1]), maxshape=(None, None),
+                                           dtype=np.float64, chunks=(4096, src['otherinfo'].shape[1]),
+                                           fillvalue=np.nan)
+                ninfo = max(objects['otherinfo'].shape[1], src['otherinfo'].shape[1])
+                for name in ('objid', 'offset', 'nobs', 'ninfo'):
+                    objects[name].resize((obj_end,))
+                objects['otherinfo'].resize((obj_end, ninfo))
+                objects['objid'][obj_start:obj_end] = src['objid'][:]
+                objects['offset'][obj_start:obj_end] = src['offset'][:] + obs_start
+                objects['nobs'][obj_start:obj_end] = src['nobs'][:]
+                objects['ninfo'][obj_start:obj_end] = src['ninfo'][:]
+                objects['otherinfo'][obj_start:obj_end, :src['otherinfo'].shape[1]] = src['otherinfo'][:]
+                obs_start += nobs
+
+    return _count_objects(fname_out)
+
+
+def _count_objects(fname):
+    with h5py.File(fname, 'r') as hdffile:
+        return hdffile['objects/objid'].shape[0]
+
+
+def _read_whole_store(fname):
+    with LightCurveStoreReader(fname) as reader:
+        return reader.read_batch(np.arange(len(reader)))
+
+
+def compact_light_curve_store(fname_in, fname_out, nprocesses=1):
+    """ Write a self-contained physical copy of a light curve store.
+
+    If `fname_in` is a master store made by `link_light_curve_stores`, its source files are read and decompressed by
+    `nprocesses` worker processes while the parent process writes the output sequentially.
+
+    Parameters
+    ----------
+    fname_in : str
+        File path of the light curve store (or master store) to compact.
+    fname_out : str
+        File path of the compacted store.
+    nprocesses : int
+        Number of processes reading the source files.
+
+    Returns
+    -------
+    nobjects : int
+        Number of objects in the compacted store.
+    """
+    with h5py.File(fname_in, 'r') as hdffile:
+        passbands = _get_passbands(hdffile)
+        sources = [str(fname) for fname in np.asarray(hdffile.attrs.get('sources', [])).astype(str)]
+    if not sources:
+        sources = [fname_in]
+
+    with LightCurveStoreWriter(fname_out, passbands=passbands) as writer:
+        if nprocesses > 1 and len(sources) > 1:
+            pool = make_pool(nprocesses)
+            try:
+                for n, batch in enumerate(pool.imap(_read_whole_store, sources)):
+                    print(n, sources[n])
+                    writer.append_batch(batch)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for n, fname in enumerate(sources):
+                print(n, fname)
+                writer.append_batch(_read_whole_store(fname))
+
+    return _count_objects(fname_out)
@@ -0,0 +1,139 @@
+"""
+CPU thread budget shared by the worker pools, TensorFlow and the BLAS libraries
+
+Without coordination every multiprocessing pool starts one process per core and every process (and TensorFlow in the
+main process) starts its own pool of BLAS/OpenMP and TensorFlow threads, so a many-core node runs many times more
+threads than cores. The budget is set once, with `set_parallelism` or with environment variables, and applied by
+`make_pool` (the worker processes of array preparation and ingestion) and `configure_tensorflow` (Classify and
+train_model):
+
+    ASTRORAPID_NUM_CORES           total number of cores to use (default: the cores available to this process)
+    ASTRORAPID_NUM_WORKERS         number of worker processes in a pool (default: NUM_CORES // WORKER_THREADS)
+    ASTRORAPID_WORKER_THREADS      BLAS/OpenMP threads in each worker process (default: 1)
+    ASTRORAPID_TF_INTRA_OP_THREADS TensorFlow threads used within an operation (default: NUM_CORES)
+    ASTRORAPID_TF_INTER_OP_THREADS TensorFlow operations run at the same time (default: 2)
+"""
+import os
+import multiprocessing as mp
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+BLAS_THREAD_VARIABLES = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'BLIS_NUM_THREADS',
+                         'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+_settings = {}
+_tensorflow_configured = None
+
+
+def _available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return mp.cpu_count()
+
+
+def _from_env(name):
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
+def set_parallelism(ncores=None, nworkers=None, worker_threads=None, tf_intra_op_threads=None,
+                    tf_inter_op_threads=None):
+    """ Set the CPU thread budget. Arguments that are None are taken from the ASTRORAPID_* environment variables or
+    their defaults (see the module docstring). Call this before making a Classify object or training a model.
+
+    Parameters
+    ----------
+    ncores : int
+        Total number of cores to use.
+    nworkers : int
+        Number of worker processes in the pools of array preparation and ingestion.
+    worker_threads : int
+        Number of BLAS/OpenMP threads in each worker process.
+    tf_intra_op_threads, tf_inter_op_threads : int
+        TensorFlow thread pools of the process running the model.
+
+    Returns
+    -------
+    settings : dict
+        The resolved budget (see get_parallelism).
+    """
+    _settings.clear()
+    _settings.update({'ncores': ncores, 'nworkers': nworkers, 'worker_threads': worker_threads,
+                      'tf_intra_op_threads': tf_intra_op_threads, 'tf_inter_op_threads': tf_inter_op_threads})
+    settings = get_parallelism()
+    print("Using {ncores} cores: {nworkers} worker processes with {worker_threads} threads each, TensorFlow with "
+          "{tf_intra_op_threads} intra-op and {tf_inter_op_threads} inter-op threads".format(**settings))
+    configure_tensorflow()
+    return settings
+
+
+def get_parallelism():
+    """ Returns the thread budget as a dictionary with the keys of the arguments of set_parallelism """
+    ncores = _settings.get('ncores') or _from_env('ASTRORAPID_NUM_CORES') or _available_cores()
+    worker_threads = _settings.get('worker_threads') or _from_env('ASTRORAPID_WORKER_THREADS') or 1
+    nworkers = _settings.get('nworkers') or _from_env('ASTRORAPID_NUM_WORKERS') or max(1, ncores // worker_threads)
+    tf_intra_op_threads = _settings.get('tf_intra_op_threads') or _from_env('ASTRORAPID_TF_INTRA_OP_THREADS') or ncores
+    tf_inter_op_threads = _settings.get('tf_inter_op_threads') or _from_env('ASTRORAPID_TF_INTER_OP_THREADS') or 2
+    return {'ncores': ncores, 'nworkers': nworkers, 'worker_threads': worker_threads,
+            'tf_intra_op_threads': tf_intra_op_threads, 'tf_inter_op_threads': tf_inter_op_threads}
+
+
+def limit_worker_threads(nthreads):
+    """ Limit the BLAS/OpenMP threads of this process. Used as the initializer of the pool processes. """
+    for name in BLAS_THREAD_VARIABLES:
+        os.environ[name] = str(nthreads)
+    # The libraries loaded before the process was forked have already read the environment variables
+    if threadpool_limits is not None:
+        threadpool_limits(limits=nthreads)
+
+
+def _init_worker(nthreads, initializer, initargs):
+    limit_worker_threads(nthreads)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def make_pool(processes=None, maxtasksperchild=None, initializer=None, initargs=()):
+    """ Returns a multiprocessing Pool that keeps to the thread budget.
+
+    Parameters
+    ----------
+    processes : int, optional
+        Number of worker processes. The default is nworkers of the budget.
+    maxtasksperchild : int, optional
+        Same as for multiprocessing.Pool.
+    initializer, initargs : optional
+        Same as for multiprocessing.Pool. Called in each worker process after its threads are limited, e.g. to open
+        a file once per process instead of once per task.
+
+    """
+    settings = get_parallelism()
+    if processes is None:
+        processes = settings['nworkers']
+    return mp.Pool(processes, initializer=_init_worker, initargs=(settings['worker_threads'], initializer, initargs),
+                   maxtasksperchild=maxtasksperchild)
+
+
+def configure_tensorflow():
+    """ Set the TensorFlow thread pools of this process from the budget. TensorFlow only allows this before it has
+    run its first operation, so later budgets are ignored with a warning. """
+    global _tensorflow_configured
+    settings = get_parallelism()
+    threads = (settings['tf_intra_op_threads'], settings['tf_inter_op_threads'])
+    if threads == _tensorflow_configured:
+        return
+    try:
+        import tensorflow as tf
+    except ImportError:
+        return
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(threads[0])
+        tf.config.threading.set_inter_op_parallelism_threads(threads[1])
+    except RuntimeError as e:
+        print("Warning: could not set the TensorFlow threads after TensorFlow started: {}".format(e))
+        return
+    _tensorflow_configured = threads
@@ -39,7 +39,8 @@ def plot_metrics(class_names, model, X_test, y_test, fig_dir, timesX_test=None,
     print("Accuracy: %.2f%%" % (scores[1] * 100))
 
     y_pred = model.predict(X_test)
-    y_test_indexes = np.argmax(y_test, axis=-1)
+    # y_test is either one-hot or integer class indexes
+    y_test_indexes = np.asarray(y_test) if np.ndim(y_test) == 2 else np.argmax(y_test, axis=-1)
     y_pred_indexes = np.argmax(y_pred, axis=-1)
 
     accuracy = len(np.where(y_pred_indexes == y_test_indexes)[0])
@@ -48,7 +49,8 @@ def plot_metrics(class_names, model, X_test, y_test, fig_dir, timesX_test=None,
 
     class_names = ["Pre-explosion"] + class_names
 
-    timesX_test[timesX_test == 0] = -200
+    # Copy rather than modify in place, since the test arrays can be read-only memmapped views
+    timesX_test = np.where(timesX_test == 0, -200, timesX_test)
 
     for cname in class_names:
         dirname = os.path.join(fig_dir + '/lc_pred', cname)
@@ -168,7 +170,7 @@ def plot_metrics(class_names, model, X_test, y_test, fig_dir, timesX_test=None,
     time_bins = np.arange(-110, 110, 1.)
     nobjects = len(timesX_test)
     ntimesteps = len(time_bins)
-    nclasses = y_test.shape[-1]
+    nclasses = y_pred.shape[-1]
     y_test_indexes_days_past_trigger = np.zeros((nobjects, ntimesteps))
     y_pred_indexes_days_past_trigger = np.zeros((nobjects, ntimesteps))
     y_pred_days_past_trigger = np.zeros((nobjects, ntimesteps, nclasses))
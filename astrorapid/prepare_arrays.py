@@ -1,18 +1,242 @@
+import io
 import os
+import shutil
+import tempfile
 import h5py
 from sklearn.model_selection import train_test_split
 from keras.utils import to_categorical
 import pickle
-import multiprocessing as mp
 import numpy as np
 import pandas as pd
 from scipy.interpolate import interp1d
 
 from astrorapid import helpers
+from astrorapid.work_scheduler import AdaptiveChunkScheduler
+from astrorapid.parallelism import make_pool, get_parallelism
+from astrorapid.light_curve_store import LightCurveStoreReader, LightCurveStoreWriter, LightCurveList, \
+    is_light_curve_store, combine_light_curve_stores
 
 # fix random seed for reproducibility
 np.random.seed(42)
 
+# The input light curve store of PrepareTrainingSetArrays.process_objects, opened once in each worker process
+_worker_reader = None
+
+
+def _open_worker_reader(fpath):
+    """ Initializer of the worker processes of process_objects. Opening the store reads its whole index, so it is done
+    once per process instead of once per chunk. """
+    global _worker_reader
+    _worker_reader = LightCurveStoreReader(fpath) if is_light_curve_store(fpath) else None
+
+
+def save_rows_to_npy(fname, source, rows, block_rows=65536):
+    """ Save some rows of an array to a .npy file, copying at most block_rows rows at a time.
+
+    Parameters
+    ----------
+    fname : str
+        File path of the .npy file.
+    source : array
+        Array (usually a memmap) to copy the rows from.
+    rows : array
+        Sorted indices of the rows to copy.
+    block_rows : int
+        Maximum number of rows held in memory.
+
+    """
+    out = np.lib.format.open_memmap(fname, mode='w+', dtype=source.dtype, shape=(len(rows),) + source.shape[1:])
+    for pos in range(0, len(rows), block_rows):
+        out[pos:pos + block_rows] = source[rows[pos:pos + block_rows]]
+    out.flush()
+    del out
+
+
+def append_rows_to_npy(fname, source, rows, block_rows=65536):
+    """ Append some rows of an array to an existing .npy file.
+
+    The rows are written after the existing data and then the shape in the header is updated in place, so an
+    interrupted append leaves the file with its old shape. If the header of the new shape is longer than the space of
+    the old header, the file is copied to a new file instead.
+
+    Parameters
+    ----------
+    fname : str
+        File path of the .npy file.
+    source : array
+        Array (usually a memmap) to copy the rows from. It must have the same row shape as the saved array.
+    rows : array
+        Sorted indices of the rows to append.
+    block_rows : int
+        Maximum number of rows held in memory.
+
+    """
+    with open(fname, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        header_size = f.tell()
+    if fortran_order or tuple(shape[1:]) != tuple(source.shape[1:]):
+        raise ValueError("Cannot append rows of shape {} to {} of shape {}".format(source.shape[1:], fname, shape))
+
+    nrows = len(rows)
+    new_shape = (shape[0] + nrows,) + tuple(shape[1:])
+    header = io.BytesIO()
+    header_dict = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': new_shape}
+    if version == (1, 0):
+        np.lib.format.write_array_header_1_0(header, header_dict)
+    else:
+        np.lib.format.write_array_header_2_0(header, header_dict)
+
+    def iter_blocks():
+        for pos in range(0, len(rows), block_rows):
+            yield np.ascontiguousarray(source[rows[pos:pos + block_rows]], dtype=dtype)
+
+    if len(header.getvalue()) == header_size:
+        with open(fname, 'r+b') as f:
+            f.seek(header_size + int(np.prod(shape)) * dtype.itemsize)
+            for block in iter_blocks():
+                f.write(block.tobytes())
+            f.flush()
+            f.seek(0)
+            f.write(header.getvalue())
+        return
+
+    tmp_fname = fname + '.tmp.npy'
+    old = np.load(fname, mmap_mode='r')
+    out = np.lib.format.open_memmap(tmp_fname, mode='w+', dtype=dtype, shape=new_shape)
+    for block_start in range(0, shape[0], block_rows):
+        out[block_start:block_start + block_rows] = old[block_start:block_start + block_rows]
+    pos = shape[0]
+    for block in iter_blocks():
+        out[pos:pos + len(block)] = block
+        pos += len(block)
+    out.flush()
+    del out, old
+    os.replace(tmp_fname, fname)
+
+
+class LazyIndexedArray(object):
+    def __init__(self, array, indices):
+        """ The rows of an array (usually a memmap) given by an index array, read only when they are indexed.
+
+        Parameters
+        ----------
+        array : array
+            Array to take the rows from.
+        indices : array
+            Rows of `array` in this view.
+
+        """
+        self.array = array
+        self.indices = np.asarray(indices, dtype=np.int64)
+
+    @property
+    def shape(self):
+        return (len(self.indices),) + self.array.shape[1:]
+
+    @property
+    def dtype(self):
+        return self.array.dtype
+
+    @property
+    def ndim(self):
+        return self.array.ndim
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            rows = self[index[0]]
+            if np.ndim(self.indices[index[0]]) == 0:
+                return rows[index[1:]]
+            return rows[(slice(None),) + index[1:]]
+        indices = self.indices[index]
+        if np.ndim(indices) == 0:
+            return self.array[indices]
+        # Read in increasing row order, then restore the requested order
+        order = np.argsort(indices, kind='stable')
+        rows = np.empty((len(indices),) + self.array.shape[1:], dtype=self.array.dtype)
+        rows[order] = self.array[indices[order]]
+        return rows
+
+    def __array__(self, dtype=None, copy=None):
+        rows = self[:]
+        return rows if dtype is None else rows.astype(dtype)
+
+
+def get_train_test_indices(nobjects, train_size=0.6, labels=None, stratify=False, random_state=42):
+    """ Split the objects into a training and a testing set.
+
+    Parameters
+    ----------
+    nobjects : int
+        Number of objects.
+    train_size : float
+        Fraction of the objects in the training set.
+    labels : array, optional
+        Class of each object. Required if stratify is True.
+    stratify : bool
+        If False, the first objects are the training set (the arrays are saved in a random order). If True, the
+        objects are shuffled and split keeping the class fractions of both sets the same.
+    random_state : int
+        Seed of the shuffle if stratify is True.
+
+    Returns
+    -------
+    idx_train, idx_test : arrays
+        Sorted indices of the objects in each set.
+    """
+    if not stratify:
+        ntrain = int(np.floor(train_size * nobjects))
+        return np.arange(ntrain), np.arange(ntrain, nobjects)
+    idx_train, idx_test = train_test_split(np.arange(nobjects), train_size=train_size, stratify=labels,
+                                           random_state=random_state)
+    return np.sort(idx_train), np.sort(idx_test)
+
+
+def extend_train_test_indices(idx_train, idx_test, nobjects, train_size=0.6, labels=None, stratify=False,
+                              random_state=42):
+    """ Split the objects appended to arrays that were already split. The objects of the earlier split keep their
+    set, so that an extended training set never contains an object of the earlier testing set, and the new objects
+    are split like in get_train_test_indices.
+
+    Parameters
+    ----------
+    idx_train, idx_test : arrays
+        Earlier split. It covers the first len(idx_train) + len(idx_test) objects.
+    nobjects : int
+        Number of objects, including the new ones.
+    train_size, labels, stratify, random_state :
+        Same as in get_train_test_indices, for all the objects.
+
+    Returns
+    -------
+    idx_train, idx_test : arrays
+        Sorted indices of the objects in each set.
+    """
+    nold = len(idx_train) + len(idx_test)
+    try:
+        new_train, new_test = get_train_test_indices(nobjects - nold, train_size=train_size,
+                                                     labels=None if labels is None else labels[nold:],
+                                                     stratify=stratify, random_state=random_state)
+    except ValueError:
+        # Too few new objects of some class to stratify them. The rows are in a random order.
+        new_train, new_test = get_train_test_indices(nobjects - nold, train_size=train_size)
+    return np.concatenate([idx_train, nold + new_train]), np.concatenate([idx_test, nold + new_test])
+
+
+def take_rows(array, indices):
+    """ Rows of an array given by sorted indices without reading them: a slice view if the indices are contiguous,
+    otherwise a LazyIndexedArray. """
+    if len(indices) == 0 or indices[-1] - indices[0] == len(indices) - 1:
+        start = indices[0] if len(indices) else 0
+        return array[start:start + len(indices)]
+    return LazyIndexedArray(array, indices)
+
 
 class PrepareArrays(object):
     def __init__(self, passbands=('g', 'r'), contextual_info=(0,)):
@@ -26,36 +250,35 @@ class PrepareArrays(object):
         self.maxtime = 80
 
     def make_cuts(self, data, i, deleterows, b, redshift=None, class_num=None, bcut=True, zcut=0.5, variables_cut=True,
-                  pre_trigger=True):
-        deleted = False
+                  pre_trigger=True, reasons=None, verbose=True):
+        """ Append i to deleterows if the light curve doesn't pass the cuts. If a reasons dictionary is given, the
+        reason is saved in it with key i. The reason is printed if verbose is True. """
         try:
             time = data['r']['time'][0:self.nobs].dropna()
         except KeyError:
-            print("No r band data. passbands")
-            deleterows.append(i)
-            deleted = True
-            return deleterows, deleted
+            time = None
 
-        if data.shape[0] < 4:
-            print("Less than 4 epochs. nobs = {}".format(data.shape))
-            deleterows.append(i)
-            deleted = True
+        reason = None
+        if time is None:
+            reason = "No r band data. passbands"
+        elif data.shape[0] < 4:
+            reason = "Less than 4 epochs. nobs = {}".format(data.shape)
         elif pre_trigger and len(time[time < 0]) < 3:
-            print("Less than 3 points in the r band pre trigger", len(time[time < 0]))
-            deleterows.append(i)
-            deleted = True
+            reason = "Less than 3 points in the r band pre trigger {}".format(len(time[time < 0]))
         elif bcut and abs(b) < 15:
-            print("In galactic plane. b = {}".format(b))
-            deleterows.append(i)
-            deleted = True
+            reason = "In galactic plane. b = {}".format(b)
         elif zcut is not None and redshift is not None and (redshift > self.zcut or redshift == 0):
-            print("Redshift cut. z = {}".format(redshift))
+            reason = "Redshift cut. z = {}".format(redshift)
+        elif class_num is not None and variables_cut is True and class_num in helpers.get_variable_sntypes():
+            reason = "Not including variable models {}".format(class_num)
+
+        deleted = reason is not None
+        if deleted:
+            if verbose:
+                print(reason)
             deleterows.append(i)
-            deleted = True
-        elif class_num is not None and variables_cut is True and class_num in [50, 70, 80, 81, 83, 84, 90, 91, 92, 93]:
-            print("Not including variable models", class_num)
-            deleterows.append(i)
-            deleted = True
+            if reasons is not None:
+                reasons[i] = reason
 
         return deleterows, deleted
 
@@ -77,6 +300,10 @@ class PrepareArrays(object):
     def get_t_interp(self, data):
         mintime, maxtime = self.get_min_max_time(data)
 
+        return self.make_t_interp(mintime, maxtime)
+
+    def make_t_interp(self, mintime, maxtime):
+        """ Returns the interpolation times between mintime and maxtime, at most nobs of them, and their number """
         tinterp = np.arange(mintime, maxtime, step=self.timestep)
         len_t = len(tinterp)
         if len_t > self.nobs:
@@ -144,7 +371,9 @@ class PrepareInputArrays(PrepareArrays):
         self.bcut = bcut
         self.zcut = zcut
 
-    def prepare_input_arrays(self, lightcurves):
+    def prepare_input_arrays(self, lightcurves, verbose=True):
+        """ Make the input arrays of the model from preprocessed light curves (see read_multiple_light_curves).
+        Light curves that don't pass the cuts are left out. With verbose=False nothing is printed. """
         nobjects = len(lightcurves)
 
         X = np.zeros(shape=(nobjects, self.nfeatures, self.nobs))
@@ -155,14 +384,15 @@ class PrepareInputArrays(PrepareArrays):
         trigger_mjds = []
 
         for i, (objid, data) in enumerate(lightcurves.items()):
-            print("Preparing light curve {} of {}".format(i, nobjects))
+            if verbose:
+                print("Preparing light curve {} of {}".format(i, nobjects))
 
             otherinfo = data['otherinfo'].values.flatten()
             redshift, b, mwebv, trigger_mjd = otherinfo[0:4]
 
             # Make cuts
             deleterows, deleted = self.make_cuts(data, i, deleterows, b, redshift, class_num=None, bcut=self.bcut,
-                                                 zcut=self.zcut, pre_trigger=False)
+                                                 zcut=self.zcut, pre_trigger=False, verbose=verbose)
             if deleted:
                 continue
 
@@ -174,7 +404,7 @@ class PrepareInputArrays(PrepareArrays):
             X = self.update_X(X, i, data, tinterp, len_t, objid, self.contextual_info, otherinfo)
 
 
-        deleterows = np.array(deleterows)
+        deleterows = np.array(deleterows, dtype=int)
         X = np.delete(X, deleterows, axis=0)
         timesX = np.delete(timesX, deleterows, axis=0)
 
@@ -186,7 +416,8 @@ class PrepareInputArrays(PrepareArrays):
 
 class PrepareTrainingSetArrays(PrepareArrays):
     def __init__(self, passbands=('g', 'r'), contextual_info=(0,), reread=False, aggregate_classes=False, bcut=True,
-                 zcut=None, variablescut=False, nchunks=10000):
+                 zcut=None, variablescut=False, nchunks=10000, train_size=0.6, stratify=False, sparse_labels=False,
+                 cache=None, extend=False, maxtasksperchild=100, stream=False):
         PrepareArrays.__init__(self, passbands, contextual_info)
         self.passbands = passbands
         self.contextual_info = contextual_info
@@ -196,6 +427,26 @@ class PrepareTrainingSetArrays(PrepareArrays):
         self.zcut = zcut
         self.variablescut = variablescut
         self.nchunks = nchunks
+        self.train_size = train_size
+        self.stratify = stratify
+        self.sparse_labels = sparse_labels
+        # Optional ArtifactCache. If given, the arrays and the split are saved in it, keyed by their parameters and
+        # the content of the input file, instead of under a file name made from some of the parameters.
+        self.cache = cache
+        # If True, the objects of the input file that are not in the saved arrays are appended to them instead of
+        # remaking the arrays
+        self.extend = extend
+        # Worker processes are replaced after preparing this many chunks, so that memory leaks don't build up
+        self.maxtasksperchild = maxtasksperchild
+        # If True, y is returned as the memmapped class numbers for a loader that reads the training set in batches,
+        # and self.class_lut is the lookup table that the loader maps them to class indexes with
+        self.stream = stream
+        self.class_lut = None
+        self.arrays_dir = None
+        self.arrays_key = None
+        self.split_key = None
+        # Key of the cached arrays that the arrays were extended from, whose split is kept
+        self.extended_from = None
         self.agg_map = helpers.aggregate_sntypes()
         self.training_set_dir = 'training_set_files'
         if not os.path.exists(self.training_set_dir):
@@ -219,183 +470,134 @@ class PrepareTrainingSetArrays(PrepareArrays):
 
         """
 
-        with h5py.File(fpath_saved_lc, 'r') as hdffile:
-            objids = np.array(list(hdffile.keys()))
+        if is_light_curve_store(fpath_saved_lc):
+            with LightCurveStoreReader(fpath_saved_lc) as reader:
+                objids = np.array(reader.objids)
+        else:
+            with h5py.File(fpath_saved_lc, 'r') as hdffile:
+                objids = np.array(list(hdffile.keys()))
         np.random.shuffle(objids)
 
         return objids, fpath_saved_lc
 
-    def prepare_training_set_arrays(self, fpath_saved_lc, otherchange=''):
-        savepath = os.path.join(self.training_set_dir,
-                                "X_{}ag{}_ci{}_fp{}_z{}_b{}_var{}.npy".format(otherchange, self.aggregate_classes,
-                                                                              self.contextual_info,
-                                                                              os.path.basename(fpath_saved_lc),
-                                                                              self.zcut, self.bcut, self.variablescut))
+    def get_array_params(self, otherchange=''):
+        """ Returns the parameters that the prepared arrays depend on """
+        return {'otherchange': otherchange, 'aggregate_classes': self.aggregate_classes,
+                'contextual_info': self.contextual_info, 'passbands': self.passbands, 'zcut': self.zcut,
+                'bcut': self.bcut, 'variablescut': self.variablescut, 'nobs': self.nobs, 'timestep': self.timestep,
+                'mintime': self.mintime, 'maxtime': self.maxtime}
+
+    def get_array_path(self, name, fpath_saved_lc, otherchange='', ext='.npy'):
+        """ Returns the path of a saved training set array, e.g. name='X' """
+        if self.arrays_dir is not None:
+            return os.path.join(self.arrays_dir, name + ext)
+        return os.path.join(self.training_set_dir,
+                            "{}_{}ag{}_ci{}_fp{}_z{}_b{}_var{}{}".format(name, otherchange, self.aggregate_classes,
+                                                                         self.contextual_info,
+                                                                         os.path.basename(fpath_saved_lc),
+                                                                         self.zcut, self.bcut, self.variablescut, ext))
 
-        if self.reread is True or not os.path.isfile(savepath):
+    def prepare_training_set_arrays(self, fpath_saved_lc, otherchange=''):
+        extend_from = None
+        self.extended_from = None
+        if self.cache is not None:
+            array_params = self.get_array_params(otherchange)
+            upstream = [self.cache.file_hash(fpath_saved_lc)]
+            self.arrays_key = self.cache.get_key('arrays', array_params, upstream)
+            self.arrays_dir = self.cache.get_dir('arrays', self.arrays_key)
+            rebuild = self.reread is True or not self.cache.is_complete('arrays', self.arrays_key)
+            if rebuild and self.extend and self.reread is not True:
+                # Start from the latest arrays made with the same parameters from an earlier version of the input
+                extend_from = self.cache.find_latest('arrays', array_params)
+        else:
+            savepath = self.get_array_path('X', fpath_saved_lc, otherchange)
+            rebuild = self.reread is True or not os.path.isfile(savepath)
+            if not rebuild and self.extend:
+                extend_from = os.path.dirname(savepath)
+
+        # The light curves of arrays saved by older versions are pickled and cannot be appended to
+        if extend_from is not None and self.cache is not None:
+            extend_dir = self.cache.get_dir('arrays', extend_from)
+            if not os.path.isfile(os.path.join(extend_dir, 'origlc.hdf5')):
+                extend_from = None
+        elif extend_from is not None and not os.path.isfile(self.get_array_path('origlc', fpath_saved_lc,
+                                                                                 otherchange, ext='.hdf5')):
+            print("Cannot extend arrays saved without a light curve store. Remaking them.")
+            extend_from, rebuild = None, True
+
+        if extend_from is not None:
+            if self.cache is not None:
+                # Extend a copy so that the arrays of the earlier input stay valid in the cache
+                print("Extending the arrays {} with the new objects in {}".format(extend_from, fpath_saved_lc))
+                for fpath in self.cache.get_files('arrays', extend_from):
+                    shutil.copyfile(fpath, os.path.join(self.arrays_dir, os.path.basename(fpath)))
+                self.extended_from = extend_from
+            self.extend_training_set_arrays(fpath_saved_lc, otherchange)
+            if self.cache is not None:
+                self.cache.record('arrays', self.arrays_key, array_params, upstream)
+        elif rebuild:
+            # The split of earlier arrays does not apply to the new rows
+            split_path = self.get_array_path('split', fpath_saved_lc, otherchange, ext='.npz')
+            if self.cache is None and os.path.isfile(split_path):
+                os.remove(split_path)
             objids, self.fpath = self.get_saved_light_curves_from_database(fpath_saved_lc)
-            nobjects = len(objids)
-
-            # Store data labels (y) and 'r' band data (X). Use memory mapping because input file is very large.
-            labels = np.zeros(shape=nobjects, dtype=np.uint16)
-            y = np.zeros(shape=(nobjects, self.nobs), dtype=np.uint16)
-            X = np.memmap(os.path.join(self.training_set_dir, 'X_lc_data.dat'), dtype=np.float32, mode='w+', shape=(nobjects, self.nfeatures, self.nobs))
-            X[:] = np.zeros(shape=(nobjects, self.nfeatures, self.nobs))
-            timesX = np.zeros(shape=(nobjects, self.nobs))
-            objids_list = []
-            orig_lc = []
-
-            # Chunk before multiprocessing
-            multi_objids = np.array_split(objids, self.nchunks)
-
-            # Store light curves into X (fluxes) and y (labels)
-            pool = mp.Pool()
-            results = pool.map_async(self.multi_read_obj, multi_objids)
-            pool.close()
-            pool.join()
-
-            outputs = results.get()
-
-            sum_deleterows = 0
-            startidx = 0
-            num_outputs = len(outputs)
-            for i, output in enumerate(outputs):
-                labels_part, y_part, X_part, timesX_part, objids_list_part, orig_lc_part, num_deleterows_part, num_objects_part = output
-                endidx = startidx + num_objects_part
-                labels[startidx:endidx] = labels_part
-                y[startidx:endidx] = y_part
-                X[startidx:endidx] = X_part
-                timesX[startidx:endidx] = timesX_part
-                objids_list.extend(objids_list_part)
-                orig_lc.extend(orig_lc_part)
-                startidx += num_objects_part
-                sum_deleterows += num_deleterows_part
-                print('combining results...', i, num_outputs)
-
-            deleterows = np.array(np.arange(nobjects - sum_deleterows, nobjects))
-            X = np.delete(X, deleterows, axis=0)
-            y = np.delete(y, deleterows, axis=0)
-            labels = np.delete(labels, deleterows, axis=0)
-            timesX = np.delete(timesX, deleterows, axis=0)
-
-            np.save(os.path.join(self.training_set_dir,
-                                 "X_{}ag{}_ci{}_fp{}_z{}_b{}_var{}.npy".format(otherchange, self.aggregate_classes,
-                                                                               self.contextual_info,
-                                                                               os.path.basename(fpath_saved_lc),
-                                                                               self.zcut, self.bcut,
-                                                                               self.variablescut)), X)
-            np.save(os.path.join(self.training_set_dir,
-                                 "y_{}ag{}_ci{}_fp{}_z{}_b{}_var{}.npy".format(otherchange, self.aggregate_classes,
-                                                                               self.contextual_info,
-                                                                               os.path.basename(fpath_saved_lc),
-                                                                               self.zcut, self.bcut,
-                                                                               self.variablescut)), y)
-            np.save(os.path.join(self.training_set_dir,
-                                 "labels_{}ag{}_ci{}_fp{}_z{}_b{}_var{}.npy".format(otherchange, self.aggregate_classes,
-                                                                                    self.contextual_info,
-                                                                                    os.path.basename(fpath_saved_lc),
-                                                                                    self.zcut,
-                                                                                    self.bcut, self.variablescut)),
-                    labels)
-            np.save(os.path.join(self.training_set_dir, "tinterp_{}ag{}_ci{}_fp{}_z{}_b{}_var{}.npy".format(otherchange,
-                                                                                                            self.aggregate_classes,
-                                                                                                            self.contextual_info,
-                                                                                                            os.path.basename(
-                                                                                                                fpath_saved_lc),
-                                                                                                            self.zcut,
-                                                                                                            self.bcut,
-                                                                                                            self.variablescut)),
-                    timesX)
-            np.save(os.path.join(self.training_set_dir,
-                                 "objids_{}ag{}_ci{}_fp{}_z{}_b{}_var{}.npy".format(otherchange, self.aggregate_classes,
-                                                                                    self.contextual_info,
-                                                                                    os.path.basename(fpath_saved_lc),
-                                                                                    self.zcut,
-                                                                                    self.bcut, self.variablescut)),
-                    objids_list)
-            with open(os.path.join(self.training_set_dir,
-                                   "origlc_{}ag{}_ci{}_fp{}_z{}_b{}_var{}.npy".format(otherchange,
-                                                                                      self.aggregate_classes,
-                                                                                      self.contextual_info,
-                                                                                      os.path.basename(fpath_saved_lc),
-                                                                                      self.zcut,
-                                                                                      self.bcut, self.variablescut)),
-                      'wb') as f:
-                pickle.dump(orig_lc, f)
-
+            self.process_objects(objids, fpath_saved_lc, otherchange, append=False)
+            if self.cache is not None:
+                self.cache.record('arrays', self.arrays_key, array_params, upstream)
+
+        # The original light curves are read lazily from a light curve store when they are indexed
+        origlc_path = self.get_array_path('origlc', fpath_saved_lc, otherchange, ext='.hdf5')
+        if os.path.isfile(origlc_path):
+            origlc_rows_path = self.get_array_path('origlc_rows', fpath_saved_lc, otherchange)
+            # Arrays saved by older versions have their light curves in the order of the arrays
+            origlc_rows = np.load(origlc_rows_path) if os.path.isfile(origlc_rows_path) else None
+            orig_lc = LightCurveList(origlc_path, origlc_rows)
         else:
-            X = np.load(os.path.join(self.training_set_dir,
-                                     "X_{}ag{}_ci{}_fp{}_z{}_b{}_var{}.npy".format(otherchange, self.aggregate_classes,
-                                                                                   self.contextual_info,
-                                                                                   os.path.basename(fpath_saved_lc),
-                                                                                   self.zcut, self.bcut,
-                                                                                   self.variablescut)), mmap_mode='r')
-            y = np.load(os.path.join(self.training_set_dir,
-                                     "y_{}ag{}_ci{}_fp{}_z{}_b{}_var{}.npy".format(otherchange, self.aggregate_classes,
-                                                                                   self.contextual_info,
-                                                                                   os.path.basename(fpath_saved_lc),
-                                                                                   self.zcut, self.bcut,
-                                                                                   self.variablescut)))
-            labels = np.load(os.path.join(self.training_set_dir,
-                                          "labels_{}ag{}_ci{}_fp{}_z{}_b{}_var{}.npy".format(otherchange,
-                                                                                             self.aggregate_classes,
-                                                                                             self.contextual_info,
-                                                                                             os.path.basename(
-                                                                                                 fpath_saved_lc),
-                                                                                             self.zcut,
-                                                                                             self.bcut,
-                                                                                             self.variablescut)))
-            timesX = np.load(os.path.join(self.training_set_dir,
-                                          "tinterp_{}ag{}_ci{}_fp{}_z{}_b{}_var{}.npy".format(otherchange,
-                                                                                              self.aggregate_classes,
-                                                                                              self.contextual_info,
-                                                                                              os.path.basename(
-                                                                                                  fpath_saved_lc),
-                                                                                              self.zcut,
-                                                                                              self.bcut,
-                                                                                              self.variablescut)))
-            objids_list = np.load(os.path.join(self.training_set_dir,
-                                               "objids_{}ag{}_ci{}_fp{}_z{}_b{}_var{}.npy".format(otherchange,
-                                                                                                  self.aggregate_classes,
-                                                                                                  self.contextual_info,
-                                                                                                  os.path.basename(
-                                                                                                      fpath_saved_lc),
-                                                                                                  self.zcut,
-                                                                                                  self.bcut,
-                                                                                                  self.variablescut)))
-            with open(os.path.join(self.training_set_dir,
-                                   "origlc_{}ag{}_ci{}_fp{}_z{}_b{}_var{}.npy".format(otherchange,
-                                                                                      self.aggregate_classes,
-                                                                                      self.contextual_info,
-                                                                                      os.path.basename(fpath_saved_lc),
-                                                                                      self.zcut,
-                                                                                      self.bcut, self.variablescut)),
-                      'rb') as f:
+            # Arrays saved by older versions have a pickled list of DataFrames instead
+            with open(self.get_array_path('origlc', fpath_saved_lc, otherchange), 'rb') as f:
                 orig_lc = pickle.load(f)
 
+        # Keep the arrays on disk. Only the labels are read in full.
+        X = np.load(self.get_array_path('X', fpath_saved_lc, otherchange), mmap_mode='r')
+        y = np.load(self.get_array_path('y', fpath_saved_lc, otherchange), mmap_mode='r')
+        labels = np.load(self.get_array_path('labels', fpath_saved_lc, otherchange))
+        timesX = np.load(self.get_array_path('tinterp', fpath_saved_lc, otherchange), mmap_mode='r')
+        objids_list = np.load(self.get_array_path('objids', fpath_saved_lc, otherchange), mmap_mode='r')
+
         classes = sorted(list(set(labels)))
         sntypes_map = helpers.get_sntypes()
         class_names = [sntypes_map[class_num] for class_num in classes]
 
         # Count nobjects per class
         for c in classes:
-            nobs = len(X[labels == c])
+            nobs = np.sum(labels == c)
             print(c, nobs)
 
-        # Use class numbers 1,2,3... instead of 1, 3, 13 etc.
-        y_indexes = np.copy(y)
-        for i, c in enumerate(classes):
-            y_indexes[y == c] = i + 1
-        y = y_indexes
-
-        y = to_categorical(y)
+        # Use class numbers 1,2,3... instead of 1, 3, 13 etc. (0 is pre-explosion)
+        class_lut = np.zeros(max(classes) + 1, dtype=np.uint8)
+        class_lut[classes] = np.arange(1, len(classes) + 1)
+        if self.stream:
+            # Mapping y here would read it into memory, and one-hot labels are larger than X
+            self.class_lut = class_lut
+        else:
+            y = class_lut[y]
+            if not self.sparse_labels:
+                y = to_categorical(y)
 
         # Correct shape for keras is (N_objects, N_timesteps, N_passbands) (where N_timesteps is lookback time)
         X = X.swapaxes(2, 1)
 
-        X_train, X_test, y_train, y_test, labels_train, labels_test, timesX_train, timesX_test, orig_lc_train, orig_lc_test, objids_train, objids_test = train_test_split(
-            X, y, labels, timesX, orig_lc, objids_list, train_size=0.60,
-            shuffle=False, random_state=42)
+        # Split with index arrays so that the memmapped arrays are not copied into memory
+        idx_train, idx_test = self.get_split(labels, fpath_saved_lc, otherchange)
+        X_train, X_test = take_rows(X, idx_train), take_rows(X, idx_test)
+        y_train, y_test = take_rows(y, idx_train), take_rows(y, idx_test)
+        timesX_train, timesX_test = take_rows(timesX, idx_train), take_rows(timesX, idx_test)
+        objids_train, objids_test = take_rows(objids_list, idx_train), take_rows(objids_list, idx_test)
+        labels_train, labels_test = labels[idx_train], labels[idx_test]
+        if isinstance(orig_lc, LightCurveList):
+            orig_lc_train, orig_lc_test = orig_lc[idx_train], orig_lc[idx_test]
+        else:
+            orig_lc_train, orig_lc_test = [orig_lc[i] for i in idx_train], [orig_lc[i] for i in idx_test]
 
         counts = np.unique(labels_train, return_counts=True)[-1]
         class_weights = max(counts) / counts
@@ -403,69 +605,329 @@ class PrepareTrainingSetArrays(PrepareArrays):
         print("Class weights:", class_weights)
 
         # Sample weights
-        l_train_indexes = np.copy(labels_train)
-        for i, c in enumerate(classes):
-            l_train_indexes[l_train_indexes == c] = i
+        l_train_indexes = class_lut[labels_train].astype(int) - 1
         sample_weights = np.zeros(len(l_train_indexes))
         for key, val in class_weights.items():
             sample_weights[l_train_indexes == key] = val
 
+        if self.sparse_labels:
+            # The sparse loss takes a weight for each timestep: give every timestep the weight of its object's class,
+            # as in the one-hot path (without copying it or reading y_train)
+            sample_weights = np.broadcast_to(sample_weights[:, None], y_train.shape)
+
         return X_train, X_test, y_train, y_test, labels_train, labels_test, class_names, class_weights, \
                sample_weights, timesX_train, timesX_test, orig_lc_train, orig_lc_test, objids_train, objids_test
 
-    def multi_read_obj(self, objids):
+    def extend_training_set_arrays(self, fpath_saved_lc, otherchange=''):
+        """ Append the objects in the saved light curves that are not yet in the prepared arrays.
+
+        The objects already in the arrays and the objects in the rejects table are not processed again. The
+        class counts and sample weights are computed from the labels when the arrays are loaded, so they include
+        the new objects.
+
+        Parameters
+        ----------
+        fpath_saved_lc : str
+            File path of the light curves saved as a hdf5 file.
+        otherchange : str
+            Same as in prepare_training_set_arrays.
+
+        Returns
+        -------
+        nobjects : int
+            Number of new objects processed (including the ones that did not pass the cuts).
+        """
+        objids, self.fpath = self.get_saved_light_curves_from_database(fpath_saved_lc)
+        done = set(np.load(self.get_array_path('objids', fpath_saved_lc, otherchange)).astype(str))
+        rejects_path = self.get_array_path('rejects', fpath_saved_lc, otherchange, ext='.csv')
+        if os.path.isfile(rejects_path):
+            done.update(pd.read_csv(rejects_path, dtype=str)['objid'])
+        new_objids = objids[~np.isin(objids.astype(str), list(done))]
+        print("{} new objects of {} in {}".format(len(new_objids), len(objids), fpath_saved_lc))
+        if len(new_objids) > 0:
+            self.process_objects(new_objids, fpath_saved_lc, otherchange, append=True)
+
+        return len(new_objids)
+
+    def process_objects(self, objids, fpath_saved_lc, otherchange='', append=False):
+        """ Prepare the arrays of a list of objects with a pool of workers and save them.
+
+        Parameters
+        ----------
+        objids : array
+            Object IDs to process.
+        fpath_saved_lc : str
+            File path of the light curves saved as a hdf5 file.
+        otherchange : str
+            Same as in prepare_training_set_arrays.
+        append : bool
+            If True, the objects are appended to the saved arrays instead of replacing them.
+
+        """
+        nobjects = len(objids)
+
+        # Store data labels (y) and 'r' band data (X). Use memory mapping because input file is very large.
+        # The workers write their rows straight into memmaps in a workspace directory of this run, so only small
+        # metadata is sent back to the parent and concurrent runs don't share files.
+        workspace = tempfile.mkdtemp(prefix='workspace_', dir=self.training_set_dir)
+        self.workspace_arrays = {
+            'labels': (os.path.join(workspace, 'labels.dat'), np.uint16, (nobjects,)),
+            'y': (os.path.join(workspace, 'y.dat'), np.uint16, (nobjects, self.nobs)),
+            'X': (os.path.join(workspace, 'X.dat'), np.float32, (nobjects, self.nfeatures, self.nobs)),
+            'tinterp': (os.path.join(workspace, 'timesX.dat'), np.float64, (nobjects, self.nobs))}
+        for name, (path, dtype, shape) in self.workspace_arrays.items():
+            np.memmap(path, dtype=dtype, mode='w+', shape=shape).flush()
+        self.workspace = workspace
+        rejects = []
+        origlc_fnames = []
+
+        # The rows of the arrays are in the (random) order of objids, but reading the objects in that order would
+        # make every chunk many small reads scattered over the whole input store. So the objects are read in the
+        # order of the store, and each one is written to its row.
+        objids = np.asarray(objids).astype(str)
+        items = np.zeros(nobjects, dtype=[('row', np.int64), ('store_row', np.int64), ('objid', objids.dtype)])
+        items['row'] = np.arange(nobjects)
+        items['objid'] = objids
+        items['store_row'] = -1
+        if is_light_curve_store(self.fpath):
+            with LightCurveStoreReader(self.fpath) as reader:
+                items['store_row'] = reader.get_rows(objids)
+            items = items[np.argsort(items['store_row'], kind='stable')]
+
+        # Store light curves into X (fluxes) and y (labels). The chunks are sized from the measured time per object
+        # and handed out while the pool is busy, so slow chunks don't leave the other workers idle at the end. At
+        # most nchunks chunks are made.
+        nworkers = get_parallelism()['nworkers']
+        pool = make_pool(nworkers, maxtasksperchild=self.maxtasksperchild, initializer=_open_worker_reader,
+                         initargs=(self.fpath,))
+        scheduler = AdaptiveChunkScheduler(pool, nworkers, min_chunk_size=int(np.ceil(nobjects / self.nchunks)))
+        try:
+            outputs = list(scheduler.imap_unordered(self.multi_read_obj, items))
+        finally:
+            pool.terminate()
+            pool.join()
+
+        # Combine in the read order so that the saved arrays don't depend on which chunks finished first. The light
+        # curve stores of the chunks are combined in the read order too, so origlc_rows maps each row of the arrays
+        # to its row in the combined store.
+        kept_rows = []
+        for output in sorted(outputs, key=lambda output: output[0]):
+            offset, rows_part, origlc_fname_part, rejects_part = output
+            kept_rows.append(rows_part)
+            rejects.extend(rejects_part)
+            origlc_fnames.append(origlc_fname_part)
+        kept_rows = np.concatenate(kept_rows) if kept_rows else np.zeros(0, dtype=np.int64)
+        rows = np.sort(kept_rows)
+        objids_list = list(objids[rows])
+        origlc_rows = np.argsort(kept_rows, kind='stable')
+
+        # Copy the kept rows to the .npy files in blocks, so the memory used doesn't depend on the number of objects
+        for name, (path, dtype, shape) in self.workspace_arrays.items():
+            source = np.memmap(path, dtype=dtype, mode='r', shape=shape)
+            if append:
+                append_rows_to_npy(self.get_array_path(name, fpath_saved_lc, otherchange), source, rows)
+            else:
+                save_rows_to_npy(self.get_array_path(name, fpath_saved_lc, otherchange), source, rows)
+            del source
+        combine_light_curve_stores(origlc_fnames, self.get_array_path('origlc', fpath_saved_lc, otherchange,
+                                                                      ext='.hdf5'), mode='a' if append else 'w')
+
+        # The object IDs, origlc_rows and the rejects table (the objects that did not pass the cuts or failed, with
+        # the reason) are small, so they are rewritten in full. They are saved last, so an interrupted append
+        # processes the same objects again.
+        objids_path = self.get_array_path('objids', fpath_saved_lc, otherchange)
+        origlc_rows_path = self.get_array_path('origlc_rows', fpath_saved_lc, otherchange)
+        rejects_path = self.get_array_path('rejects', fpath_saved_lc, otherchange, ext='.csv')
+        rejects = pd.DataFrame(rejects, columns=['objid', 'reason'])
+        if append:
+            old_objids = list(np.load(objids_path))
+            # Arrays saved by older versions have their light curves in the order of the arrays
+            old_origlc_rows = np.load(origlc_rows_path) if os.path.isfile(origlc_rows_path) \
+                else np.arange(len(old_objids))
+            origlc_rows = np.concatenate((old_origlc_rows, len(old_origlc_rows) + origlc_rows))
+            objids_list = old_objids + objids_list
+            if os.path.isfile(rejects_path):
+                rejects = pd.concat([pd.read_csv(rejects_path, dtype=str), rejects], ignore_index=True)
+        if len(rejects) > 0:
+            print("{} objects rejected:".format(len(rejects)))
+            print(rejects['reason'].str.split(r'[.:]', regex=True).str[0].value_counts().to_string())
+        rejects.to_csv(rejects_path, index=False)
+        np.save(origlc_rows_path, origlc_rows)
+        np.save(objids_path, objids_list)
+
+        shutil.rmtree(workspace)
+
+    def get_split(self, labels, fpath_saved_lc, otherchange=''):
+        """ Returns the indices of the training and testing sets.
+
+        The split is saved with the arrays (in the cache if there is one) and reused. If the arrays were extended
+        since they were split, the objects of the saved split keep their set and only the new objects are split.
+        """
+        split_params = {'train_size': self.train_size, 'stratify': self.stratify}
+        previous = None
+        if self.cache is None:
+            split_path = self.get_array_path('split', fpath_saved_lc, otherchange, ext='.npz')
+            if os.path.isfile(split_path):
+                with np.load(split_path) as saved:
+                    if float(saved['train_size']) == self.train_size and bool(saved['stratify']) == self.stratify:
+                        previous = saved['idx_train'], saved['idx_test']
+        else:
+            self.split_key = self.cache.get_key('split', split_params, [self.arrays_key])
+            split_dir = self.cache.get_dir('split', self.split_key)
+            if self.reread is not True and self.cache.is_complete('split', self.split_key):
+                return np.load(os.path.join(split_dir, 'idx_train.npy')), \
+                       np.load(os.path.join(split_dir, 'idx_test.npy'))
+            if self.extended_from is not None:
+                previous_key = self.cache.get_key('split', split_params, [self.extended_from])
+                if self.cache.is_complete('split', previous_key):
+                    previous_dir = self.cache.get_dir('split', previous_key)
+                    previous = np.load(os.path.join(previous_dir, 'idx_train.npy')), \
+                               np.load(os.path.join(previous_dir, 'idx_test.npy'))
+
+        if previous is not None and len(previous[0]) + len(previous[1]) == len(labels):
+            return previous
+        if previous is not None and len(previous[0]) + len(previous[1]) < len(labels):
+            print("Keeping the split of the first {} objects".format(len(previous[0]) + len(previous[1])))
+            idx_train, idx_test = extend_train_test_indices(*previous, len(labels), train_size=self.train_size,
+                                                            labels=labels, stratify=self.stratify)
+        else:
+            idx_train, idx_test = get_train_test_indices(len(labels), train_size=self.train_size, labels=labels,
+                                                         stratify=self.stratify)
+
+        if self.cache is None:
+            np.savez(split_path, idx_train=idx_train, idx_test=idx_test, train_size=self.train_size,
+                     stratify=self.stratify)
+        else:
+            np.save(os.path.join(split_dir, 'idx_train.npy'), idx_train)
+            np.save(os.path.join(split_dir, 'idx_test.npy'), idx_test)
+            self.cache.record('split', self.split_key, split_params, [self.arrays_key])
+        return idx_train, idx_test
+
+    def multi_read_obj(self, chunk):
+        """ Prepare the arrays of a chunk of objects.
+
+        Parameters
+        ----------
+        chunk : tuple
+            (offset, items). items is a structured array with the objid of each object, its row in the input store
+            (store_row) and its row in the arrays (row). The arrays of the objects that pass the cuts are written to
+            their rows of the workspace memmaps in `self.workspace_arrays`.
+
+        Returns
+        -------
+        offset : int
+            Same as input.
+        rows : array
+            Rows of the objects written, in the order of items.
+        origlc_fname : str
+            File path of the light curve store in the workspace holding the light curves of the objects written, in
+            the order of rows.
+        rejects : list
+            (objid, reason) of the objects that did not pass the cuts or could not be prepared.
+        """
+        offset, items = chunk
+        objids = items['objid']
         nobjects = len(objids)
 
         labels = np.zeros(shape=nobjects, dtype=np.uint16)
         y = np.zeros(shape=(nobjects, self.nobs), dtype=np.uint16)
-        X = np.zeros(shape=(nobjects, self.nfeatures, self.nobs))
+        X = np.zeros(shape=(nobjects, self.nfeatures, self.nobs), dtype=np.float32)
         timesX = np.zeros(shape=(nobjects, self.nobs))
         objids_list = []
         orig_lc = []
         deleterows = []
+        reasons = {}
+
+        # A consolidated store is read with a few large reads for the whole chunk instead of one read per object,
+        # with the reader of this worker process if the chunk is run by the pool of process_objects.
+        # Transient I/O errors are retried. If the chunk still can't be read, its objects are rejected.
+        def read_chunk():
+            if _worker_reader is not None and _worker_reader.fname == self.fpath:
+                return dict(_worker_reader.iter_rows(items['store_row'])), None
+            if is_light_curve_store(self.fpath):
+                with LightCurveStoreReader(self.fpath) as reader:
+                    return dict(reader.iter_rows(reader.get_rows(objids))), None
+            # A combined file made in link mode holds external links to the groups in the per-batch files
+            with h5py.File(self.fpath, 'r') as hdffile:
+                return None, {str(objid): hdffile.get(str(objid), getlink=True) for objid in objids}
+        chunk_error = None
+        try:
+            chunk_data, chunk_links = helpers.call_with_retries(read_chunk)
+        except Exception as e:
+            chunk_error = "Could not read the chunk. " + helpers.describe_error(e)
+            print(chunk_error)
 
         for i, objid in enumerate(objids):
             print("Preparing {} light curve {} of {}".format(objid, i, nobjects))
+            if chunk_error is not None:
+                deleterows.append(i)
+                reasons[i] = chunk_error
+                continue
 
             # Get aggregate model
-            field, model, base, snid = objid.astype(str).split('_')
+            field, model, base, snid = str(objid).split('_')
             if self.aggregate_classes:
                 model = self.agg_map[int(model)]
             class_num = int(model)
 
-            # Get data for each object
-            try:
-                data = pd.read_hdf(self.fpath, key=objid)
-            except AttributeError:
-                print("ignoring: cannot read", objid)
+            # The class is known from the objid, so don't read objects that the variables cut would discard anyway
+            if self.variablescut and class_num in helpers.get_variable_sntypes():
+                print("Not including variable models", class_num)
                 deleterows.append(i)
+                reasons[i] = "Not including variable models {}".format(class_num)
                 continue
 
-            otherinfo = data['otherinfo'].values.flatten()
-            redshift, b, mwebv, trigger_mjd, t0, peakmjd = otherinfo[0:6]
+            # An object that fails is rejected with the reason instead of losing the whole chunk
+            try:
+                # Get data for each object
+                if chunk_data is not None:
+                    data = chunk_data[str(objid)]
+                elif isinstance(chunk_links[str(objid)], h5py.ExternalLink):
+                    link = chunk_links[str(objid)]
+                    data = helpers.call_with_retries(pd.read_hdf, link.filename, key=link.path)
+                else:
+                    data = helpers.call_with_retries(pd.read_hdf, self.fpath, key=objid)
 
-            # Make cuts
-            deleterows, deleted = self.make_cuts(data, i, deleterows, b, redshift, class_num=model, bcut=self.bcut,
-                                                 zcut=self.zcut, variables_cut=self.variablescut, pre_trigger=True)
-            if deleted:
-                continue
+                otherinfo = data['otherinfo'].values.flatten()
+                redshift, b, mwebv, trigger_mjd, t0, peakmjd = otherinfo[0:6]
 
-            tinterp, len_t = self.get_t_interp(data)
-            timesX[i][0:len_t] = tinterp
+                # Make cuts
+                deleterows, deleted = self.make_cuts(data, i, deleterows, b, redshift, class_num=model,
+                                                     bcut=self.bcut, zcut=self.zcut, variables_cut=self.variablescut,
+                                                     pre_trigger=True, reasons=reasons)
+                if deleted:
+                    continue
+
+                tinterp, len_t = self.get_t_interp(data)
+                timesX[i][0:len_t] = tinterp
+                X = self.update_X(X, i, data, tinterp, len_t, objid, self.contextual_info, otherinfo)
+
+                activeindexes = (tinterp > t0)
+                labels[i] = int(model)
+                y[i][0:len_t] = int(model) * activeindexes
+            except Exception as e:
+                print("Rejecting {}: {}".format(objid, helpers.describe_error(e)))
+                deleterows.append(i)
+                reasons[i] = helpers.describe_error(e)
+                continue
             orig_lc.append(data)
             objids_list.append(objid)
-            X = self.update_X(X, i, data, tinterp, len_t, objid, self.contextual_info, otherinfo)
 
-            activeindexes = (tinterp > t0)
-            labels[i] = int(model)
-            y[i][0:len_t] = int(model) * activeindexes
+        keep = np.ones(nobjects, dtype=bool)
+        keep[np.array(deleterows, dtype=int)] = False
+        chunk_arrays = {'labels': labels[keep], 'y': y[keep], 'X': X[keep], 'tinterp': timesX[keep]}
+        rejects = [(str(objids[i]), reasons.get(i, '')) for i in deleterows]
+        rows = items['row'][keep]
 
-        deleterows = np.array(deleterows)
-        X = np.delete(X, deleterows, axis=0)
-        y = np.delete(y, deleterows, axis=0)
-        labels = np.delete(labels, deleterows, axis=0)
-        timesX = np.delete(timesX, deleterows, axis=0)
-        count_deleterows = len(deleterows)
-        num_objects = X.shape[0]
+        for name, (path, dtype, shape) in self.workspace_arrays.items():
+            out = np.memmap(path, dtype=dtype, mode='r+', shape=shape)
+            out[rows] = chunk_arrays[name]
+            out.flush()
+            del out
+
+        origlc_fname = os.path.join(self.workspace, 'origlc_{}.hdf5'.format(offset))
+        with LightCurveStoreWriter(origlc_fname, passbands=self.passbands) as writer:
+            for objid, data in zip(objids_list, orig_lc):
+                writer.append(objid, data)
 
-        return labels, y, X, timesX, objids_list, orig_lc, count_deleterows, num_objects
+        return offset, rows, origlc_fname, rejects
@@ -2,7 +2,9 @@ import sys
 import os
 import configparser
 import pymysql
+import pymysql.cursors
 import getpass
+import tempfile
 
 # we should probably get these from a file instead
 _MYSQL_CONFIG = {'host':'dlgreenmysqlv.stsci.edu',
@@ -80,7 +82,8 @@ def make_mysql_schema_from_astropy_bintable_cols(astropy_columns):
                         'E':'FLOAT',
                         'D':'DOUBLE'}
 
-    mysql_formats = ['VARCHAR(255)',] + [dtype_conversion.get(x[-1], 'TINYTEXT') for x in astropy_columns.formats]
+    use_formats = [astropy_columns[field].format for field in use_fields]
+    mysql_formats = ['VARCHAR(255)',] + [dtype_conversion.get(x[-1], 'TINYTEXT') for x in use_formats]
     mysql_schema = ', '.join(['{} {}'.format(x, y) for x, y in zip(mysql_fields, mysql_formats)])
     return use_fields, mysql_fields, mysql_schema
 
@@ -160,33 +163,87 @@ def create_sql_index_table_for_release(data_release, schema, redo=False, table_n
     return table_name
 
 
-def write_rows_to_index_table(index_entries, table_name):
+def write_rows_to_index_table(index_entries, table_name, chunk_size=10000, use_infile=False):
     """
     Write rows to an index table
+    index_entries can be any iterable of rows (e.g. a generator over HEAD.FITS
+    files), it is consumed in chunks of chunk_size rows so that neither the
+    client memory nor the MySQL packet size grows with the number of rows.
+    If use_infile, each chunk is written to a local tab separated file and sent
+    with LOAD DATA LOCAL INFILE instead of INSERT statements.
     Returns number of rows written
     """
-    primitive = ['%s',]
-    nrows = len(index_entries)
-    if nrows == 0:
-        return nrows
+    con = get_mysql_connection(local_infile=use_infile)
+    cursor = con.cursor()
+    number_of_rows = 0
+    try:
+        chunk = []
+        for row in index_entries:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                number_of_rows += _write_chunk_to_index_table(cursor, chunk, table_name, use_infile)
+                con.commit()
+                chunk = []
+        if chunk:
+            number_of_rows += _write_chunk_to_index_table(cursor, chunk, table_name, use_infile)
+            con.commit()
+    finally:
+        con.close()
+    return number_of_rows
 
-    ncols = len(index_entries[0])
-    format_string = ', '.join(primitive*ncols)
 
-    con = get_mysql_connection()
-    query = f'INSERT INTO {table_name} VALUES ({format_string})'
-    cursor = con.cursor()
-    number_of_rows = cursor.executemany(query, index_entries)
-    con.commit()
-    con.close()
+def _format_infile_value(value):
+    """ Format a value for a LOAD DATA INFILE tab separated file """
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+def _write_chunk_to_index_table(cursor, chunk, table_name, use_infile):
+    """
+    Write one chunk of rows with executemany, or with LOAD DATA LOCAL INFILE
+    if use_infile
+    Returns number of rows written
+    """
+    if not use_infile:
+        format_string = ', '.join(['%s', ] * len(chunk[0]))
+        query = f'INSERT INTO {table_name} VALUES ({format_string})'
+        cursor.executemany(query, chunk)
+        return len(chunk)
+
+    with tempfile.NamedTemporaryFile('w', suffix='.tsv', delete=False) as f:
+        infile = f.name
+        for row in chunk:
+            f.write('\t'.join(_format_infile_value(value) for value in row))
+            f.write('\n')
+    try:
+        query = f"LOAD DATA LOCAL INFILE '{infile}' INTO TABLE {table_name} " \
+                f"FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n'"
+        number_of_rows = cursor.execute(query)
+    finally:
+        os.remove(infile)
     return number_of_rows
 
 
-def get_mysql_connection(attempts=0):
+def add_secondary_indexes_to_index_table(table_name):
+    """
+    Adds the secondary index on sntype to an index table. This is done after
+    the rows are loaded, since maintaining it during a bulk load is slow.
+    Queries on the objid field prefix (objid LIKE 'DDF_%') are already served
+    by the objid primary key, and InnoDB secondary indexes contain the primary
+    key, so this also serves queries on both sntype and objid.
+    """
+    query = f'ALTER TABLE {table_name} ADD INDEX {table_name}_sntype (sntype)'
+    result = exec_sql_query(query)
+    return result
+
+
+def get_mysql_connection(attempts=0, local_infile=False):
     """
     Get a  MySQL connection object. The config variable _MYSQL_CONFIG defines
     the context/parameters of the connection. If config does not include a
     MySQL password, the user is prompted for it.
+    Set local_infile to allow LOAD DATA LOCAL INFILE on the connection.
     Returns a MySQL connection object.
     """
     _MYSQL_CONFIG = get_mysql_config() 
@@ -194,50 +251,59 @@ def get_mysql_connection(attempts=0):
     if password is None:
         get_sql_password()
     try:
-        con = pymysql.connect(**_MYSQL_CONFIG)
+        con = pymysql.connect(local_infile=local_infile, **_MYSQL_CONFIG)
     except Exception as e:
         attempts += 1
         if attempts < 3:
             _MYSQL_CONFIG.pop('password')
-            con = get_mysql_connection(attempts=attempts)
+            con = get_mysql_connection(attempts=attempts, local_infile=local_infile)
         else:
             message = 'Login attempts exceeded!'
             raise RuntimeError(message)
     return con
 
 
-def exec_big_sql_query(query, big=False):
+def exec_big_sql_query(query, fetch_size=10000, verbose=False):
     """
-    Executes a supplied MySQL query. The context of the query is defined by
-    _MYSQL_CONFIG and the connection object returned by get_mysql_connection() 
-    Returns the result of the query (if any) or yields it as a generator if big=True
+    Executes a supplied MySQL query with an unbuffered server-side cursor. The
+    context of the query is defined by _MYSQL_CONFIG and the connection object
+    returned by get_mysql_connection()
+    Rows are streamed from the server in batches of fetch_size with fetchmany
+    so that memory use does not grow with the size of the result
+    Yields the result of the query one row at a time
     """
-    print(query)
-    result = None
+    if verbose:
+        print(query)
     con = get_mysql_connection()
+    cursor = None
     try:
-        cursor = con.cursor()
-        success = cursor.execute(query)
-        print('Query results:',success)
-        loop_ok = True 
-        while loop_ok:
-            result = cursor.fetchone()
-            if result:
-                yield result 
-            else:
-                loop_ok = False
+        cursor = con.cursor(pymysql.cursors.SSCursor)
+        cursor.execute(query)
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
     except Exception as e:
         message = '{}\nFailed to execute query\n{}'.format(e, query)
         raise RuntimeError(message)
     finally:
-        con.close()
-    return result
+        # Also close the cursor if the consumer stops early or the query fails, so that its unread rows are
+        # discarded before the connection is closed
+        try:
+            if cursor is not None:
+                cursor.close()
+        finally:
+            con.close()
+
 
-def exec_sql_query(query, big=False):
+def exec_sql_query(query):
     """
     Executes a supplied MySQL query. The context of the query is defined by
     _MYSQL_CONFIG and the connection object returned by get_mysql_connection() 
-    Returns the result of the query (if any) or yields it as a generator if big=True
+    Returns the result of the query (if any). Use exec_big_sql_query to stream
+    a large result instead.
     """
     print(query)
     result = None
@@ -4,7 +4,14 @@ Get PLASTICC data from SQL database
 """
 import sys
 import os
+import gzip
+import shutil
+import hashlib
+import contextlib
+import tempfile
+import threading
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import warnings
 import argparse
 import pandas as pd
@@ -12,11 +19,178 @@ import astropy.table as at
 import astropy.io.fits as afits
 from collections import OrderedDict
 from . import database
+from . import local_index
 from astrorapid import helpers
 
 ROOT_DIR = os.getenv('PLASTICC_DIR')
 DATA_DIR = os.path.join(ROOT_DIR, 'plasticc_data')
 
+# J2000 equatorial coordinates of the North Galactic Pole, used to push the galactic latitude cut into SQL
+RA_NGP = 192.85948
+DEC_NGP = 27.12825
+
+# Where decompressed copies of gzipped PHOT.FITS files are kept
+PHOT_CACHE_DIR = os.getenv('ASTRORAPID_PHOT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'astrorapid_phot_cache'))
+
+
+class _PhotFileEntry(object):
+    """ An open PHOT.FITS file in a PhotFileCache and the number of readers using it """
+
+    def __init__(self):
+        self.phot_HDU = None
+        # Decompressed copy of a gzipped file, deleted when the file is closed
+        self.local_file = None
+        # Set once the file is open, or failed to open with `error`
+        self.ready = threading.Event()
+        self.error = None
+        self.nusers = 0
+        self.evicted = False
+
+    def close(self):
+        if self.phot_HDU is not None:
+            self.phot_HDU.close()
+        if self.local_file is not None:
+            try:
+                os.remove(self.local_file)
+            except OSError:
+                pass
+
+
+class PhotFileCache(object):
+    """
+    Bounded LRU cache of open, memory-mapped PHOT.FITS files
+
+    Thousands of consecutive objects live in the same PHOT.FITS file, so the
+    file is opened once and kept open for subsequent objects instead of being
+    reopened for every light curve. Gzipped files cannot be memory-mapped, so
+    they are decompressed to `cache_dir` on local disk and the uncompressed
+    copy is opened instead. The copy is deleted when the file is closed, so
+    the cache holds at most `maxsize` copies.
+
+    One instance is shared by every GetData object in a process (see
+    `get_phot_file_cache`), and it is safe to use from several threads: a file
+    is used inside `with cache.open(phot_file) as phot_HDU:`, and a file that
+    is evicted while other threads are reading it is only closed when the
+    last of them is done. Files are opened and decompressed outside the lock
+    of the cache, so a large file being decompressed only holds up the
+    readers of that file.
+    """
+
+    def __init__(self, maxsize=16, cache_dir=PHOT_CACHE_DIR):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get_local_copy(self, phot_file):
+        """
+        Returns the path of an uncompressed copy of a gzipped phot file,
+        decompressing it to the cache directory if it is missing or stale
+        """
+        if not phot_file.endswith('.gz'):
+            return phot_file
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        path_hash = hashlib.md5(os.path.abspath(phot_file).encode('utf-8')).hexdigest()[:12]
+        local_file = os.path.join(self.cache_dir, '{}_{}'.format(path_hash, os.path.basename(phot_file)[:-3]))
+        if os.path.exists(local_file) and os.path.getmtime(local_file) >= os.path.getmtime(phot_file):
+            return local_file
+
+        # Decompress to a temporary name and rename so that other workers never see a partial file
+        temp_file = '{}.{}.{}.tmp'.format(local_file, os.getpid(), threading.get_ident())
+        with gzip.open(phot_file, 'rb') as f_in, open(temp_file, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, length=16 * 1024 * 1024)
+        os.replace(temp_file, local_file)
+        return local_file
+
+    def acquire(self, phot_file):
+        """
+        Returns the cache entry of phot_file, opening the file if it is not
+        cached and evicting the least recently used file if the cache is full.
+        The entry is pinned until it is given back with `release`.
+        """
+        with self._lock:
+            entry = self._entries.pop(phot_file, None)
+            opening = entry is None
+            if opening:
+                entry = _PhotFileEntry()
+                while len(self._entries) >= self.maxsize:
+                    _, old_entry = self._entries.popitem(last=False)
+                    self._evict(old_entry)
+            entry.nusers += 1
+            self._entries[phot_file] = entry
+
+        if opening:
+            try:
+                def open_file():
+                    # The copy is decompressed again if another process deleted it meanwhile
+                    entry.local_file = self.get_local_copy(phot_file) if phot_file.endswith('.gz') else None
+                    return afits.open(entry.local_file or phot_file, memmap=True, lazy_load_hdus=False)
+
+                # Network file systems give transient errors under load, so retry before giving up on the file
+                entry.phot_HDU = helpers.call_with_retries(open_file)
+                # HDUList reads the table lazily, which is not thread-safe, so map it before anyone else uses it
+                entry.phot_HDU[1].data
+            except Exception as e:
+                entry.error = e
+            entry.ready.set()
+        else:
+            entry.ready.wait()
+
+        if entry.error is not None:
+            with self._lock:
+                # Forget the file so that the next reader tries to open it again
+                if self._entries.get(phot_file) is entry:
+                    del self._entries[phot_file]
+                    entry.evicted = True
+            self.release(entry)
+            raise RuntimeError('Could not open photometry file {}: {}'.format(phot_file, entry.error)) \
+                from entry.error
+        return entry
+
+    def release(self, entry):
+        """ Unpin a cache entry from `acquire`, closing the file if it was evicted and nobody else uses it """
+        with self._lock:
+            entry.nusers -= 1
+            if entry.evicted and entry.nusers == 0:
+                entry.close()
+
+    @contextlib.contextmanager
+    def open(self, phot_file):
+        """
+        Context manager giving the open HDUList of phot_file. The file stays
+        open until the end of the block, even if it is evicted meanwhile.
+        """
+        entry = self.acquire(phot_file)
+        try:
+            yield entry.phot_HDU
+        finally:
+            self.release(entry)
+
+    def _evict(self, entry):
+        entry.evicted = True
+        if entry.nusers == 0:
+            entry.close()
+
+    def clear(self):
+        """ Closes all the cached files (files in use are closed when they are released) """
+        with self._lock:
+            while self._entries:
+                _, entry = self._entries.popitem()
+                self._evict(entry)
+
+
+_PHOT_FILE_CACHE = None
+
+
+def get_phot_file_cache():
+    """ Returns the PhotFileCache shared by all GetData objects in this process """
+    global _PHOT_FILE_CACHE
+    if _PHOT_FILE_CACHE is None:
+        _PHOT_FILE_CACHE = PhotFileCache()
+    return _PHOT_FILE_CACHE
+
 
 def parse_getdata_options(argv=None):
     if argv is None:
@@ -85,13 +259,31 @@ def parse_getdata_options(argv=None):
 class GetData(object):
     """
     Class to access the ANTARES parsed PLaSTiCC index and light curve data
+
+    The index is queried on the MySQL server by default. If `index_path` is
+    set, the local SQLite index built by `local_index.build_local_index` is
+    queried instead with the same SQL.
     """
 
-    def __init__(self, data_release):
+    def __init__(self, data_release, phot_cache=None, index_path=None):
         self.data_release = "release_{}".format(data_release)
+        self.phot_cache = get_phot_file_cache() if phot_cache is None else phot_cache
+        self.index_path = index_path
         self.phot_fields = ['MJD', 'FLT', 'FLUXCAL', 'FLUXCALERR', 'ZEROPT', 'PHOTFLAG']
         self.phot_fields_dtypes = {'FLT': np.str_, 'PHOTFLAG': np.int_}
 
+    def exec_sql_query(self, query):
+        """ Run a query on the index table backend (MySQL or the local index) """
+        if self.index_path is not None:
+            return local_index.exec_sql_query(query, self.index_path)
+        return database.exec_sql_query(query)
+
+    def exec_big_sql_query(self, query, fetch_size=10000):
+        """ Stream the rows of a query from the index table backend (MySQL or the local index) """
+        if self.index_path is not None:
+            return local_index.exec_big_sql_query(query, self.index_path, fetch_size=fetch_size)
+        return database.exec_big_sql_query(query, fetch_size=fetch_size)
+
     def get_phot_fields(self):
         """
         list of the photometry column names and a dictionary of NON-FLOAT
@@ -116,7 +308,7 @@ class GetData(object):
 
     def get_object_ids(self):
         """ Get list of all object ids """
-        obj_ids = database.exec_sql_query("SELECT objid FROM {0};".format(self.data_release))
+        obj_ids = self.exec_sql_query("SELECT objid FROM {0};".format(self.data_release))
         return obj_ids
 
     def get_column_for_sntype(self, column_name, sntype, field='%'):
@@ -137,7 +329,7 @@ class GetData(object):
             A list containing all the entire column for a particular sntype class
         """
         try:
-            column_out = database.exec_sql_query(
+            column_out = self.exec_sql_query(
                 "SELECT {0} FROM {1} WHERE objid LIKE '{2}%' AND sntype={3};".format(column_name, self.data_release,
                                                                                      field, sntype))
             column_out = np.array(column_out)[:, 0]
@@ -183,37 +375,29 @@ class GetData(object):
             E.g. Access the magnitude in the z filter with phot_out['z']['MAG'].
         """
         phot_file = self.get_photfile_for_objid(objid)
-
-        try:
-            phot_HDU = afits.open(phot_file, memmap=True)
-        except Exception as e:
-            message = f'Could not open photometry file {phot_file}'
-            raise RuntimeError(message)
-
-        phot_data = phot_HDU[1].data[ptrobs_min - 1:ptrobs_max]
-
-        phot_dict = OrderedDict()
-        filters = list(set(phot_data['FLT']))  # e.g. ['i', 'r', 'Y', 'u', 'g', 'z']
-        dtypes = dict(self.phot_fields_dtypes)
-        for f in filters:
-            fIndexes = np.where(phot_data['FLT'] == f)[0]
-            phot_dict[f] = OrderedDict()
-            for pfield in self.phot_fields:
-                if pfield == 'ZEROPT':
-                    phot_dict[f][pfield] = np.repeat(standard_zpt, len(fIndexes))
-                elif pfield == 'FLT':
-                    true_zpt = phot_data['ZEROPT'][fIndexes]
-                    nobs = len(true_zpt)
-                    phot_dict[f][pfield] = np.repeat(f.strip(), nobs)
-                else:
-                    phot_dict[f][pfield] = phot_data[pfield][fIndexes]
-
-                if not pfield in dtypes:
-                    dtypes[pfield] = np.float64
+        with self.phot_cache.open(phot_file) as phot_HDU:
+            phot_data = phot_HDU[1].data[ptrobs_min - 1:ptrobs_max]
+
+            phot_dict = OrderedDict()
+            filters = list(set(phot_data['FLT']))  # e.g. ['i', 'r', 'Y', 'u', 'g', 'z']
+            dtypes = dict(self.phot_fields_dtypes)
+            for f in filters:
+                fIndexes = np.where(phot_data['FLT'] == f)[0]
+                phot_dict[f] = OrderedDict()
+                for pfield in self.phot_fields:
+                    if pfield == 'ZEROPT':
+                        phot_dict[f][pfield] = np.repeat(standard_zpt, len(fIndexes))
+                    elif pfield == 'FLT':
+                        true_zpt = phot_data['ZEROPT'][fIndexes]
+                        nobs = len(true_zpt)
+                        phot_dict[f][pfield] = np.repeat(f.strip(), nobs)
+                    else:
+                        phot_dict[f][pfield] = phot_data[pfield][fIndexes]
+
+                    if not pfield in dtypes:
+                        dtypes[pfield] = np.float64
 
         phot_out = pd.DataFrame(phot_dict)
-        phot_HDU.close()
-        del phot_HDU[1].data
         return phot_out
 
     def get_light_curve_array(self, objid, ptrobs_min, ptrobs_max, standard_zpt=27.5):
@@ -230,22 +414,194 @@ class GetData(object):
 
         Return
         -------
-        phot_out: pandas DataFrame
-            A DataFrame containing the MJD, FLT, FLUXCAL, FLUXCALERR, ZEROPT seperated by each filter.
-            E.g. Access the magnitude in the z filter with phot_out['z']['MAG'].
+        phot_out: astropy Table
+            A Table with the rows of the object in the PHOT.FITS file.
         """
         phot_file = self.get_photfile_for_objid(objid)
+        with self.phot_cache.open(phot_file) as phot_HDU:
+            phot_data = phot_HDU[1].data[ptrobs_min - 1:ptrobs_max]
+            phot_data = at.Table(phot_data)
+        return phot_data
 
-        try:
-            phot_HDU = afits.open(phot_file, memmap=True)
-        except Exception as e:
-            message = f'Could not open photometry file {phot_file}'
-            raise RuntimeError(message)
+    def get_light_curve_arrays(self, objid, ptrobs_min, ptrobs_max, standard_zpt=27.5,
+                               passbands=('u', 'g', 'r', 'i', 'z', 'Y')):
+        """ Get lightcurve from fits file as typed arrays - avoids the Pandas and Table overheads of `get_light_curve`
+        and `get_light_curve_array`
 
-        phot_data = phot_HDU[1].data[ptrobs_min - 1:ptrobs_max]
-        phot_data = at.Table(phot_data)
-        return phot_data
+        Parameters
+        ----------
+        objid : str
+            The object ID. E.g. objid='DDF_04_NONIa-0004_87287'
+        ptrobs_min : int
+            Min index of object in _PHOT.FITS.
+        ptrobs_max : int
+            Max index of object in _PHOT.FITS.
+        standard_zpt : float
+            Zeropoint of the FLUXCAL column.
+        passbands : tuple
+            Only observations in these passbands are returned.
+
+        Return
+        -------
+        lc: dict
+            A dictionary of arrays with keys mjd, flux, dflux, pb, zpt, photflag. See `convert_phot_columns_to_array_lc`
+        """
+        phot_file = self.get_photfile_for_objid(objid)
+        with self.phot_cache.open(phot_file) as phot_HDU:
+            phot_data = phot_HDU[1].data
+            phot_columns = {pfield: np.array(phot_data.field(pfield)[ptrobs_min - 1:ptrobs_max])
+                            for pfield in ('MJD', 'FLT', 'FLUXCAL', 'FLUXCALERR', 'PHOTFLAG')}
+
+        return self.convert_phot_columns_to_array_lc(phot_columns, passbands=passbands, standard_zpt=standard_zpt)
+
+    @staticmethod
+    def convert_phot_columns_to_array_lc(phot_columns, passbands=('u', 'g', 'r', 'i', 'z', 'Y'), standard_zpt=27.5):
+        """ Convert raw PHOT.FITS columns of one object into the typed arrays used to build an InputLightCurve.
+
+        Parameters
+        ----------
+        phot_columns : dict
+            Arrays hashed by PHOT.FITS column name, with at least MJD, FLT, FLUXCAL, FLUXCALERR and PHOTFLAG.
+            E.g. the output of `read_photometry_bulk`.
+        passbands : tuple
+            Only observations in these passbands are kept (this also drops dummy entries with passband = -9).
+        standard_zpt : float
+            Zeropoint of the FLUXCAL column.
+
+        Return
+        -------
+        lc: dict
+            A dictionary of arrays in observation order with the same names as `convert_pandas_lc_to_recarray_lc`:
+            mjd, flux, dflux and zpt are float64, pb is str and photflag is int64.
+        """
+        pb = np.char.strip(np.asarray(phot_columns['FLT']).astype(str))
+        mask = np.isin(pb, passbands)
+
+        lc = {'mjd': np.asarray(phot_columns['MJD'], dtype=np.float64)[mask],
+              'flux': np.asarray(phot_columns['FLUXCAL'], dtype=np.float64)[mask],
+              'dflux': np.asarray(phot_columns['FLUXCALERR'], dtype=np.float64)[mask],
+              'pb': pb[mask],
+              'zpt': np.full(np.count_nonzero(mask), standard_zpt, dtype=np.float64),
+              'photflag': np.asarray(phot_columns['PHOTFLAG'], dtype=np.int64)[mask]}
+        return lc
+
+    def read_photfile_slices(self, phot_file, headers, fields=None, max_gap=1000):
+        """ Read the photometry of many objects that live in the same PHOT.FITS file
+
+        Parameters
+        ----------
+        phot_file : str
+            Path of the PHOT.FITS file that contains all the objects in `headers`.
+        headers : list
+            Header rows whose first three entries are (objid, ptrobs_min, ptrobs_max).
+        fields : list, optional
+            PHOT.FITS columns to read. The default is the list from `get_phot_fields`.
+        max_gap : int, optional
+            Objects separated by at most this many rows are read in a single contiguous slice.
+
+        Return
+        -------
+        phot_out : list
+            A list of (header, phot_columns) tuples ordered by ptrobs_min. phot_columns is a dictionary of arrays
+            hashed by PHOT.FITS column name.
+        """
+        if fields is None:
+            fields = self.phot_fields
+
+        headers = sorted(headers, key=lambda h: h[1])
+        phot_out = []
+        with self.phot_cache.open(phot_file) as phot_HDU:
+            phot_data = phot_HDU[1].data
+            columns = {pfield: phot_data.field(pfield) for pfield in fields}
+
+            start = 0
+            while start < len(headers):
+                # Extend this run while the next object starts close to the end of the previous one
+                end = start + 1
+                run_max = headers[start][2]
+                while end < len(headers) and headers[end][1] - 1 - run_max <= max_gap:
+                    run_max = max(run_max, headers[end][2])
+                    end += 1
+
+                lo = headers[start][1] - 1
+                blocks = {pfield: np.array(column[lo:run_max]) for pfield, column in columns.items()}
+                for h in headers[start:end]:
+                    ptrobs_min, ptrobs_max = h[1] - 1 - lo, h[2] - lo
+                    phot_out.append((h, {pfield: block[ptrobs_min:ptrobs_max] for pfield, block in blocks.items()}))
+                start = end
+
+        return phot_out
+
+    def read_photometry_bulk(self, headers, fields=None, nthreads=4, max_gap=1000, errors=None):
+        """ Read the photometry for a list of headers grouped by PHOT.FITS file
+
+        Consecutive headers in the same file are grouped, sorted by ptrobs_min and read in large contiguous slices
+        (see `read_photfile_slices`) instead of one small random read per object. Headers sorted by objid are
+        contiguous by file, so each file is read once. The headers are consumed as the files are read, and at most
+        `nthreads` files are read at the same time by a small thread pool, so only the photometry of those files is
+        held in memory.
+
+        Parameters
+        ----------
+        headers : iterable
+            Header rows whose first three entries are (objid, ptrobs_min, ptrobs_max), e.g. from `get_lcs_headers`.
+        fields : list, optional
+            PHOT.FITS columns to read. The default is the list from `get_phot_fields`.
+        nthreads : int, optional
+            Number of files read at the same time.
+        max_gap : int, optional
+            Objects separated by at most this many rows are read in a single contiguous slice.
+        errors : list, optional
+            If given, a file that cannot be read (after retrying transient I/O errors) doesn't stop the read. Instead
+            a (header, exception) tuple is appended to this list for each object in the file.
 
+        Return
+        -------
+        result: tuple
+            A generator of (header, phot_columns) tuples, grouped by file in the order that the files finish reading.
+        """
+        def iter_file_headers():
+            phot_file, file_headers = None, []
+            for h in headers:
+                h_phot_file = self.get_photfile_for_objid(h[0])
+                if h_phot_file != phot_file and file_headers:
+                    yield phot_file, file_headers
+                    file_headers = []
+                phot_file = h_phot_file
+                file_headers.append(h)
+            if file_headers:
+                yield phot_file, file_headers
+
+        def read_file(phot_file, file_headers):
+            try:
+                return helpers.call_with_retries(self.read_photfile_slices, phot_file, file_headers, fields=fields,
+                                                 max_gap=max_gap)
+            except Exception as e:
+                if errors is None:
+                    raise
+                print("Could not read {} objects in {}: {}".format(len(file_headers), phot_file, e))
+                errors.extend((h, e) for h in file_headers)
+                return []
+
+        if nthreads <= 1:
+            for phot_file, file_headers in iter_file_headers():
+                for result in read_file(phot_file, file_headers):
+                    yield result
+            return
+
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            pending = set()
+            for phot_file, file_headers in iter_file_headers():
+                pending.add(executor.submit(read_file, phot_file, file_headers))
+                if len(pending) >= nthreads:
+                    # Give back the files that are done before reading more
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        for result in future.result():
+                            yield result
+            for future in as_completed(pending):
+                for result in future.result():
+                    yield result
 
     @staticmethod
     def convert_pandas_lc_to_recarray_lc(phot, passbands=('u', 'g', 'r', 'i', 'z', 'Y')):
@@ -284,6 +640,40 @@ class GetData(object):
         out.dtype.names = out_names
         return out
 
+    @staticmethod
+    def get_cuts_sql(zcut=None, bcut=False, variablescut=False, bcut_degrees=15.):
+        """ Translate the training set selection cuts into SQL predicates on the index table.
+
+        The same cuts are applied (exactly) by `PrepareArrays.make_cuts` after the light curves are processed. Pushing
+        them into the header query means that the photometry of rejected objects is never read from the PHOT.FITS.
+
+        Parameters
+        ----------
+        zcut : float or None
+            Remove objects with sim_redshift_host above this value or equal to zero.
+        bcut : bool
+            Remove objects with galactic latitude |b| < `bcut_degrees`. The latitude is computed from ra and decl with
+            a small tolerance so that no object kept by `make_cuts` is rejected here.
+        variablescut : bool
+            Remove the variable model numbers listed in `helpers.get_variable_sntypes`.
+
+        Return
+        -------
+        extrasql : str
+            A string of ' AND ...' predicates for the `extrasql` argument of `get_lcs_headers`.
+        """
+        extrasql = ''
+        if zcut is not None:
+            extrasql += " AND sim_redshift_host <= {} AND sim_redshift_host != 0".format(float(zcut))
+        if bcut:
+            sinb = "SIN(RADIANS(decl))*SIN(RADIANS({0})) + COS(RADIANS(decl))*COS(RADIANS({0}))*COS(RADIANS(ra - {1}))"\
+                .format(DEC_NGP, RA_NGP)
+            extrasql += " AND ABS({}) >= SIN(RADIANS({}))".format(sinb, bcut_degrees - 1e-3)
+        if variablescut:
+            models = ', '.join("'{:02d}'".format(m) for m in helpers.get_variable_sntypes())
+            extrasql += " AND SUBSTRING_INDEX(SUBSTRING_INDEX(objid, '_', 2), '_', -1) NOT IN ({})".format(models)
+        return extrasql
+
     @staticmethod
     def get_sntypes():
         return helpers.get_sntypes()
@@ -294,12 +684,13 @@ class GetData(object):
 
     def get_avail_sntypes(self):
         """ Returns a list of the different transient classes in the database. """
-        sntypes = database.exec_sql_query("SELECT DISTINCT sntype FROM {};".format(self.data_release))
+        sntypes = self.exec_sql_query("SELECT DISTINCT sntype FROM {};".format(self.data_release))
         sntypes_map = self.get_sntypes()
         return sorted([sntype[0] for sntype in sntypes]), sntypes_map
 
     def get_lcs_headers(self, columns=None, field='%', model='%', base='%', snid='%', extrasql='', survey='LSST',
-                        get_num_lightcurves=False, limit=None, shuffle=False, sort=True, offset=0, big=False):
+                        get_num_lightcurves=False, limit=None, shuffle=False, sort=True, offset=0, big=False,
+                        fetch_size=10000, after_objid=None, upto_objid=None):
         """ Gets the header data given specific conditions.
 
         Parameters
@@ -328,8 +719,16 @@ class GetData(object):
         offset : int, optional
             Start returning MySQL results from this row number offset
         big : bool, optional
-            If True, use a generator to retrieve results - cannot be used with
+            If True, stream the results from the server with an unbuffered cursor
+            instead of loading them all into memory - cannot be used with
             get_num_lightcurves since generators have no length
+        fetch_size : int, optional
+            Number of rows fetched from the server per round-trip if `big` is True
+        after_objid : str, optional
+            Only return objects with objid strictly greater than this key (keyset pagination).
+            Unlike `offset`, the server does not need to sort and skip the preceding rows.
+        upto_objid : str, optional
+            Only return objects with objid less than or equal to this key (keyset pagination).
         Return
         -------
         result: tuple or int
@@ -359,6 +758,9 @@ class GetData(object):
             sort = True
 
         extrasql_command = '' if extrasql is None else extrasql
+        keyset_command = '' if after_objid is None else " AND objid > '{}'".format(after_objid)
+        if upto_objid is not None:
+            keyset_command += " AND objid <= '{}'".format(upto_objid)
         limit_command = '' if limit is None else " LIMIT {}".format(limit)
         offset_command = '' if offset is None else " OFFSET {}".format(offset)
         if model != '%':
@@ -371,16 +773,16 @@ class GetData(object):
 
         shuffle_command = '' if shuffle is False else " ORDER BY RAND()"
         sort_command = '' if sort is False else ' ORDER BY objid'
-        extra_command = ''.join([extrasql_command, sort_command, shuffle_command, limit_command, offset_command])
+        extra_command = ''.join([keyset_command, extrasql_command, sort_command, shuffle_command, limit_command, offset_command])
 
         query = "SELECT {} FROM {} WHERE objid LIKE '{}_{}_{}_{}' {};".format(', '.join(columns), \
                                                                               self.data_release, field, model, base,
                                                                               snid, extra_command)
         if big:
-            for result in database.exec_big_sql_query(query):
+            for result in self.exec_big_sql_query(query, fetch_size=fetch_size):
                 yield result
         else:
-            header = database.exec_sql_query(query)
+            header = self.exec_sql_query(query)
             if get_num_lightcurves:
                 num_lightcurves = int(header[0][0])
                 yield num_lightcurves
@@ -395,8 +797,46 @@ class GetData(object):
                       "field: {}, model: {}, base: {}, snid: {}".format(field, model, base, snid))
                 return
 
+    def get_objid_key_ranges(self, batch_size, field='%', model='%', base='%', snid='%', extrasql=''):
+        """ Partition the index into batches of contiguous objid key ranges.
+
+        The objids are streamed once in sorted order and every `batch_size`-th key is kept as a boundary,
+        so each batch can later be fetched with `after_objid`/`upto_objid` at the same cost, instead of
+        asking the server to sort and skip all the preceding rows with OFFSET.
+
+        Parameters
+        ----------
+        batch_size : int
+            Number of objects in each key range.
+        field, model, base, snid, extrasql :
+            Selection passed to `get_lcs_headers`.
+
+        Return
+        -------
+        key_ranges : list
+            A list of (after_objid, upto_objid) tuples. The first range starts with after_objid=None and the
+            last range ends with upto_objid=None, so the ranges cover every objid, including objids added later.
+        """
+        header = self.get_lcs_headers(columns=['objid', ], field=field, model=model, base=base, snid=snid,
+                                      extrasql=extrasql, sort=True, shuffle=False, big=True)
+
+        key_ranges = []
+        lower_key = None
+        nobjects = 0
+        for nobjects, h in enumerate(header, 1):
+            if nobjects % batch_size == 0:
+                key_ranges.append((lower_key, h[0]))
+                lower_key = h[0]
+        if nobjects % batch_size != 0:
+            key_ranges.append((lower_key, None))
+        elif key_ranges:
+            key_ranges[-1] = (key_ranges[-1][0], None)
+
+        return key_ranges
+
     def get_lcs_data(self, columns=None, field='%', model='%', base='%', snid='%', survey='LSST',\
-                     limit=None, shuffle=False, sort=True, offset=0, big=False, extrasql=''):
+                     limit=None, shuffle=False, sort=True, offset=0, big=False, extrasql='', fetch_size=10000,
+                     after_objid=None, upto_objid=None):
         """ Gets the light curve and header data given specific conditions. Returns a generator of LC info.
 
         Parameters
@@ -422,9 +862,14 @@ class GetData(object):
         offset : int, optional
             Start returning MySQL results from this row number offset (> 0)
         big : bool, optional
-            If True, use a generator to retrieve results - cannot be used with
-            get_num_lightcurves since generators have no length
-            
+            If True, stream the results from the server with an unbuffered cursor
+            instead of loading them all into memory
+        fetch_size : int, optional
+            Number of rows fetched from the server per round-trip if `big` is True
+        after_objid : str, optional
+            Only return objects with objid strictly greater than this key (keyset pagination)
+        upto_objid : str, optional
+            Only return objects with objid less than or equal to this key (keyset pagination)
 
         Return
         -------
@@ -438,10 +883,33 @@ class GetData(object):
         header = self.get_lcs_headers(columns=columns, field=field, \
                                       model=model, base=base, snid=snid, \
                                       limit=limit, sort=sort, shuffle=shuffle, offset=offset, \
-                                      big=big, extrasql=extrasql)
+                                      big=big, extrasql=extrasql, fetch_size=fetch_size,
+                                      after_objid=after_objid, upto_objid=upto_objid)
 
         for h in header:
             objid, ptrobs_min, ptrobs_max = h[0:3]
             phot_data = self.get_light_curve(objid, ptrobs_min, ptrobs_max)
             yield h, phot_data
 
+    def get_lcs_data_bulk(self, columns=None, field='%', model='%', base='%', snid='%', limit=None, shuffle=False,
+                          sort=True, offset=0, big=False, extrasql='', fetch_size=10000, after_objid=None,
+                          upto_objid=None, nthreads=4, errors=None):
+        """ Gets the header data and raw photometry columns given specific conditions.
+
+        Takes the same selection arguments as `get_lcs_data`, but reads the photometry with `read_photometry_bulk`, so
+        the results are grouped by PHOT.FITS file rather than ordered by objid. Files that cannot be read are
+        reported in `errors` if it is given (see `read_photometry_bulk`).
+
+        Return
+        -------
+        result: tuple
+            A generator of (header, phot_columns) tuples. phot_columns is a dictionary of arrays hashed by PHOT.FITS
+            column name.
+        """
+        header = self.get_lcs_headers(columns=columns, field=field, model=model, base=base, snid=snid, limit=limit,
+                                      sort=sort, shuffle=shuffle, offset=offset, big=big, extrasql=extrasql,
+                                      fetch_size=fetch_size, after_objid=after_objid, upto_objid=upto_objid)
+
+        for result in self.read_photometry_bulk(header, nthreads=nthreads, errors=errors):
+            yield result
+
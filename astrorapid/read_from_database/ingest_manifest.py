@@ -0,0 +1,211 @@
+# -*- coding: UTF-8 -*-
+"""
+Manifest of the completed batches of an ingest run
+
+Each batch covers a range (lower, upper] of either row offsets in the objid-sorted index (LIMIT/OFFSET batches) or
+objid keys (--keyset batches). A batch is recorded in a SQLite file in the save directory only after its file has been
+written completely and renamed into place, together with its object count, size and checksum. A restart redoes
+exactly the ranges that are not recorded, even if the batch size has changed, and the combine step can check that
+the recorded batches cover the whole selection.
+
+Objects that could not be read or preprocessed are skipped and recorded in a rejects table with the reason, so one bad
+object does not stop its batch.
+"""
+import os
+import time
+import hashlib
+import sqlite3
+
+import h5py
+
+from astrorapid.light_curve_store import is_light_curve_store, LightCurveStoreReader
+
+MANIFEST_NAME = 'manifest.sqlite'
+
+
+def get_file_checksum(fname, block_size=1 << 20):
+    """ Returns the sha256 hex digest of a file """
+    sha = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def count_objects_in_file(fname):
+    """ Returns the number of objects in a saved batch file (pandas HDFStore or light curve store) """
+    if is_light_curve_store(fname):
+        with LightCurveStoreReader(fname) as reader:
+            return len(reader)
+    with h5py.File(fname, 'r') as hdffile:
+        return len(hdffile.keys())
+
+
+def _key_lt(a, b):
+    """ a < b where a and b are range bounds: None is below everything as a lower bound and above everything as an
+    upper bound, so callers only pass a lower bound as a and an upper bound as b or two non-None values. """
+    if a is None or b is None:
+        return True
+    return a < b
+
+
+def subtract_ranges(key_range, done_ranges):
+    """
+    Returns the parts of the range (lower, upper] that are not covered by any of the done ranges, as a list of
+    (lower, upper) tuples. A lower bound of None is unbounded below and an upper bound of None is unbounded above.
+    """
+    pieces = [tuple(key_range)]
+    for done_lower, done_upper in done_ranges:
+        remaining = []
+        for lower, upper in pieces:
+            # Part below the done range
+            if done_lower is not None and _key_lt(lower, done_lower):
+                remaining.append((lower, done_lower if _key_lt(done_lower, upper) else upper))
+            # Part above the done range
+            if done_upper is not None and _key_lt(done_upper, upper):
+                remaining.append((done_upper if _key_lt(lower, done_upper) else lower, upper))
+        pieces = remaining
+    return pieces
+
+
+class IngestManifest(object):
+    def __init__(self, save_dir, mode, selection):
+        """ Open (or create) the manifest of an ingest run.
+
+        Parameters
+        ----------
+        save_dir : str
+            Directory of the batch files. The manifest is saved in it as manifest.sqlite.
+        mode : str
+            'offset' if the batches are row offset ranges or 'keyset' if they are objid key ranges.
+        selection : str
+            Description of the selection being ingested (data release, field, model, cuts and output format).
+            A manifest can only be resumed with the same mode and selection.
+
+        """
+        self.path = os.path.join(save_dir, MANIFEST_NAME)
+        self.save_dir = save_dir
+        self.mode = mode
+        self.selection = selection
+
+        con = self._connect()
+        with con:
+            con.execute('CREATE TABLE IF NOT EXISTS info (mode TEXT, selection TEXT)')
+            con.execute('CREATE TABLE IF NOT EXISTS batches (fname TEXT PRIMARY KEY, lower TEXT, upper TEXT, '
+                        'nobjects INTEGER, size INTEGER, checksum TEXT, completed REAL)')
+            con.execute('CREATE TABLE IF NOT EXISTS rejects (objid TEXT PRIMARY KEY, fname TEXT, reason TEXT)')
+            info = con.execute('SELECT mode, selection FROM info').fetchone()
+            if info is None:
+                con.execute('INSERT INTO info VALUES (?, ?)', (mode, selection))
+            elif tuple(info) != (mode, selection):
+                message = 'Manifest {} was made for {} batches of "{}" and cannot be resumed for {} batches of "{}". ' \
+                          'Use a new save directory.'.format(self.path, info[0], info[1], mode, selection)
+                raise RuntimeError(message)
+        con.close()
+
+    def _connect(self):
+        # Several ingest processes record their batches in the same file
+        return sqlite3.connect(self.path, timeout=600)
+
+    def _to_db(self, bound):
+        return None if bound is None else str(bound)
+
+    def _from_db(self, bound):
+        if bound is None or self.mode == 'keyset':
+            return bound
+        return int(bound)
+
+    def get_completed(self):
+        """ Returns a list of (fname, (lower, upper), nobjects, size, checksum) of the completed batches """
+        con = self._connect()
+        rows = con.execute('SELECT fname, lower, upper, nobjects, size, checksum FROM batches').fetchall()
+        con.close()
+        return [(fname, (self._from_db(lower), self._from_db(upper)), nobjects, size, checksum)
+                for fname, lower, upper, nobjects, size, checksum in rows]
+
+    def get_remaining(self, key_ranges):
+        """ Returns the parts of key_ranges that have not been completed """
+        done_ranges = [key_range for fname, key_range, nobjects, size, checksum in self.get_completed()
+                       if os.path.isfile(os.path.join(self.save_dir, fname))]
+        remaining = []
+        for key_range in key_ranges:
+            remaining += subtract_ranges(key_range, done_ranges)
+        return remaining
+
+    def get_batch_fname(self, key_range):
+        """ Returns the file name of the batch for a range. Completed ranges never overlap a new range, so naming a
+        batch after its lower bound is unique across restarts with different batch sizes. """
+        lower = key_range[0]
+        return 'lc_{}.hdf5'.format('start' if lower is None else lower)
+
+    def record(self, fname, key_range, nobjects):
+        """ Record a batch whose file has been completely written """
+        fpath = os.path.join(self.save_dir, fname)
+        size = os.path.getsize(fpath)
+        checksum = get_file_checksum(fpath)
+        con = self._connect()
+        with con:
+            con.execute('INSERT OR REPLACE INTO batches VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (fname, self._to_db(key_range[0]), self._to_db(key_range[1]), nobjects, size, checksum,
+                         time.time()))
+        con.close()
+
+    def record_rejects(self, fname, rejects):
+        """ Record the objects of a batch that were skipped, as a list of (objid, reason) tuples """
+        con = self._connect()
+        with con:
+            con.execute('DELETE FROM rejects WHERE fname = ?', (fname,))
+            con.executemany('INSERT OR REPLACE INTO rejects VALUES (?, ?, ?)',
+                            [(str(objid), fname, reason) for objid, reason in rejects])
+        con.close()
+
+    def get_rejects(self):
+        """ Returns a list of (objid, fname, reason) of the objects that were skipped """
+        con = self._connect()
+        rows = con.execute('SELECT objid, fname, reason FROM rejects ORDER BY fname, objid').fetchall()
+        con.close()
+        return rows
+
+    def verify(self, nobjects_expected=None):
+        """
+        Check that the completed batches are intact, do not overlap and cover the whole selection.
+
+        Parameters
+        ----------
+        nobjects_expected : int, optional
+            Number of objects in the selection. If given, the total object count of the batches plus the number of
+            rejected objects must match it.
+
+        Returns
+        -------
+        problems : list
+            A list of strings describing each problem. The ingest is complete if it is empty.
+        """
+        problems = []
+        completed = self.get_completed()
+        for fname, key_range, nobjects, size, checksum in completed:
+            fpath = os.path.join(self.save_dir, fname)
+            if not os.path.isfile(fpath):
+                problems.append('{} is missing'.format(fname))
+            elif os.path.getsize(fpath) != size or get_file_checksum(fpath) != checksum:
+                problems.append('{} does not match its checksum'.format(fname))
+
+        # Sort by lower bound with the unbounded range first and check that each range starts where the last ended
+        ranges = sorted((key_range for fname, key_range, nobjects, size, checksum in completed),
+                        key=lambda key_range: (key_range[0] is not None, key_range[0]))
+        expected_lower = None if self.mode == 'keyset' else 0
+        for lower, upper in ranges:
+            if lower != expected_lower:
+                problems.append('Range ({}, {}] is missing'.format(expected_lower, lower))
+            expected_lower = upper
+        if self.mode == 'keyset' and expected_lower is not None:
+            problems.append('Range ({}, None] is missing'.format(expected_lower))
+
+        total = sum(nobjects for fname, key_range, nobjects, size, checksum in completed)
+        completed_fnames = set(fname for fname, key_range, nobjects, size, checksum in completed)
+        nrejects = sum(1 for objid, fname, reason in self.get_rejects() if fname in completed_fnames)
+        if nobjects_expected is not None and total + nrejects != nobjects_expected:
+            problems.append('{} objects in the batches and {} rejected but {} in the selection'.format(
+                total, nrejects, nobjects_expected))
+
+        return problems
@@ -0,0 +1,286 @@
+# -*- coding: UTF-8 -*-
+"""
+Pipelined ingestion of light curves from the database
+
+The stages of reading a batch of light curves run concurrently with bounded queues between them:
+
+    header fetch (thread) -> photometry read (threads) -> preprocessing (processes) -> write (main thread)
+
+so the MySQL queries and FITS reads overlap with the CPU-heavy preprocessing instead of alternating with it. Each
+stage reports its throughput at the end of a batch. The throughput per worker of the preprocessing stage compared
+with the throughput of the I/O stages tells how many preprocessing processes the I/O can keep busy.
+"""
+import time
+import queue
+import threading
+
+from astrorapid import helpers
+from astrorapid.parallelism import make_pool, get_parallelism
+from astrorapid.read_from_database.get_data import GetData
+from astrorapid.process_light_curves import InputLightCurve
+from astrorapid.light_curve_store import LightCurveStoreWriter, light_curve_to_arrays
+import pandas as pd
+
+INGEST_COLUMNS = ['objid', 'ptrobs_min', 'ptrobs_max', 'sim_peakmag_r', 'sim_redshift_host', 'mwebv', 'sim_dlmu',
+                  'peakmjd', 'mwebv', 'ra', 'decl', 'hostgal_photoz', 'hostgal_photoz_err']
+
+_DONE = None
+# How often, in seconds, a stage blocked on a queue checks whether the pipeline was aborted
+_POLL_INTERVAL = 0.1
+
+
+class StageStats(object):
+    def __init__(self, name, nworkers=1):
+        """ Count the objects processed by a pipeline stage and the time its workers spend busy.
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage.
+        nworkers : int
+            Number of threads or processes running the stage.
+
+        """
+        self.name = name
+        self.nworkers = nworkers
+        self.count = 0
+        self.busy_time = 0.
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, count, busy_time):
+        with self._lock:
+            self.count += count
+            self.busy_time += busy_time
+
+    def report(self):
+        """ Print the throughput of the stage. """
+        wall_time = time.time() - self.start_time
+        rate = self.count / wall_time if wall_time > 0 else 0.
+        rate_per_worker = self.count / self.busy_time if self.busy_time > 0 else 0.
+        utilisation = self.busy_time / (wall_time * self.nworkers) if wall_time > 0 else 0.
+        print("{:>12}: {} objects in {:.1f}s, {:.1f} objects/s, {:.1f} objects/s per busy worker, "
+              "{} workers {:.0%} busy".format(self.name, self.count, wall_time, rate, rate_per_worker, self.nworkers,
+                                              utilisation))
+
+
+def make_input_light_curve(head, lc, passbands=('g', 'r'), known_redshift=True):
+    """ Make the InputLightCurve of an object from its header row and its array light curve
+    (see GetData.convert_phot_columns_to_array_lc). """
+    objid, ptrobs_min, ptrobs_max, peakmag, redshift, mwebv, dlmu, peakmjd, mwebv, ra, dec, photoz, photozerr = head
+
+    field, model, base, snid = objid.split('_')
+
+    return InputLightCurve(lc['mjd'], lc['flux'], lc['dflux'], lc['pb'], lc['zpt'], lc['photflag'], ra, dec, objid,
+                           redshift, mwebv, known_redshift=known_redshift,
+                           training_set_parameters={'class_number': int(model), 'peakmjd': peakmjd})
+
+
+def _preprocess_item(args):
+    """ Preprocessing stage. Runs in a worker process. An object that fails is returned with savepd None and the
+    reason, so that it doesn't stop the pool. """
+    head, lc, passbands, known_redshift, consolidated = args
+    start = time.time()
+    try:
+        savepd = make_input_light_curve(head, lc, passbands, known_redshift).preprocess_light_curve()
+        if consolidated:
+            # Flatten in the worker so that the writer only has to copy arrays
+            savepd = light_curve_to_arrays(savepd, passbands)
+    except Exception as e:
+        return head[0], None, time.time() - start, helpers.describe_error(e)
+    return head[0], savepd, time.time() - start, None
+
+
+def read_light_curves_pipelined(data_release, fname, field_in='%', model_in='%', batch_size=100, offset=0, sort=True,
+                                passbands=('g', 'r'), known_redshift=True, key_range=None, zcut=None, bcut=False,
+                                variablescut=False, index_path=None, consolidated=False, nreaders=2, npreprocess=None,
+                                queue_size=256, header_chunk=64, pool=None, maxtasksperchild=None, rejects=None):
+    """ Read, preprocess and save a batch of light curves with a pipeline of concurrent stages.
+
+    Takes the same arguments as `read_light_curves_from_sql_database` and writes the same file.
+
+    Parameters
+    ----------
+    nreaders : int
+        Number of threads reading photometry.
+    npreprocess : int
+        Number of preprocessing processes. The default is the number of workers of the thread budget (see
+        astrorapid/parallelism.py).
+    queue_size : int
+        Maximum number of objects held between stages. This bounds the memory used when a stage falls behind.
+    header_chunk : int
+        Number of headers handed to a photometry reader at a time. Headers in the same PHOT.FITS file are read in
+        contiguous slices, so larger chunks give larger reads.
+    pool : multiprocessing.Pool, optional
+        Pool of preprocessing processes to reuse across batches. If None, a pool of npreprocess processes is made. A
+        pool that is passed in should have npreprocess processes, which is only used to report the stage throughput.
+    maxtasksperchild : int, optional
+        If the pool is made here, replace a preprocessing process after it has preprocessed this many objects.
+    rejects : list, optional
+        Objects that cannot be read or preprocessed are skipped and a (objid, reason) tuple is appended to this list.
+
+    Returns
+    -------
+    stats : list
+        StageStats of the header, read, preprocess and write stages.
+    """
+    print(fname)
+
+    extrasql = GetData.get_cuts_sql(zcut=zcut, bcut=bcut, variablescut=variablescut)
+    getter = GetData(data_release, index_path=index_path)
+    if key_range is not None:
+        after_objid, upto_objid = key_range
+        offset = 0
+    else:
+        after_objid, upto_objid = None, None
+
+    if npreprocess is None:
+        npreprocess = get_parallelism()['nworkers']
+    own_pool = pool is None
+    if own_pool:
+        pool = make_pool(npreprocess, maxtasksperchild=maxtasksperchild)
+
+    header_stats = StageStats('headers')
+    read_stats = StageStats('photometry', nreaders)
+    preprocess_stats = StageStats('preprocess', npreprocess)
+    write_stats = StageStats('write')
+
+    header_queue = queue.Queue(maxsize=max(1, queue_size // header_chunk))
+    phot_queue = queue.Queue(maxsize=queue_size)
+    # Objects handed to the pool but not yet written. Bounds the internal queue of the pool, which is unbounded.
+    in_flight = threading.BoundedSemaphore(queue_size)
+    # Set when the write stage fails, so that the other stages stop instead of blocking on queues nobody empties
+    abort = threading.Event()
+    errors = []
+    read_errors = []
+    if rejects is None:
+        rejects = []
+
+    def put(q, item):
+        """ Put an item on a queue, waiting for room unless the pipeline is aborted. Returns False if aborted. """
+        while not abort.is_set():
+            try:
+                q.put(item, timeout=_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(q):
+        """ Get an item from a queue. Returns _DONE if the pipeline is aborted. """
+        while not abort.is_set():
+            try:
+                return q.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def fetch_headers():
+        try:
+            headers = getter.get_lcs_headers(columns=INGEST_COLUMNS, field=field_in, model=model_in, snid='%',
+                                             limit=batch_size, offset=offset, shuffle=False, sort=sort,
+                                             extrasql=extrasql, after_objid=after_objid, upto_objid=upto_objid)
+            chunk = []
+            start = time.time()
+            for head in headers:
+                chunk.append(head)
+                if len(chunk) == header_chunk:
+                    header_stats.add(len(chunk), time.time() - start)
+                    if not put(header_queue, chunk):
+                        return
+                    chunk = []
+                    start = time.time()
+            if chunk:
+                header_stats.add(len(chunk), time.time() - start)
+                put(header_queue, chunk)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            for i in range(nreaders):
+                put(header_queue, _DONE)
+
+    def read_photometry():
+        try:
+            while True:
+                chunk = get(header_queue)
+                if chunk is _DONE:
+                    break
+                start = time.time()
+                for head, phot in getter.read_photometry_bulk(chunk, nthreads=1, errors=read_errors):
+                    try:
+                        lc = getter.convert_phot_columns_to_array_lc(phot, passbands=passbands)
+                    except Exception as e:
+                        read_errors.append((head, e))
+                        continue
+                    read_stats.add(1, time.time() - start)
+                    if not put(phot_queue, (head, lc, passbands, known_redshift, consolidated)):
+                        return
+                    start = time.time()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            put(phot_queue, _DONE)
+
+    def iter_work_items():
+        # Runs in the task handler thread of the pool
+        nfinished = 0
+        while nfinished < nreaders:
+            item = get(phot_queue)
+            if abort.is_set():
+                return
+            if item is _DONE:
+                nfinished += 1
+                continue
+            while not in_flight.acquire(timeout=_POLL_INTERVAL):
+                if abort.is_set():
+                    return
+            yield item
+
+    threads = [threading.Thread(target=fetch_headers)] + \
+              [threading.Thread(target=read_photometry) for i in range(nreaders)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    if consolidated:
+        store = LightCurveStoreWriter(fname, passbands=passbands)
+    else:
+        store = pd.HDFStore(fname)
+
+    try:
+        for objid, savepd, preprocess_time, reason in pool.imap_unordered(_preprocess_item, iter_work_items()):
+            preprocess_stats.add(1, preprocess_time)
+            start = time.time()
+            if savepd is None:
+                print("Rejecting {}: {}".format(objid, reason))
+                rejects.append((objid, reason))
+            elif consolidated:
+                store.append_arrays(objid, *savepd)
+            else:
+                store.append(objid, savepd)
+            write_stats.add(1, time.time() - start)
+            in_flight.release()
+    except BaseException:
+        abort.set()
+        if own_pool:
+            # Don't wait for the objects still being preprocessed
+            pool.terminate()
+        raise
+    finally:
+        store.close()
+        if own_pool:
+            pool.close()
+            pool.join()
+
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    rejects.extend((head[0], helpers.describe_error(e)) for head, e in read_errors)
+
+    print("saved %s" % fname)
+    stats = [header_stats, read_stats, preprocess_stats, write_stats]
+    for stage in stats:
+        stage.report()
+
+    return stats
@@ -0,0 +1,254 @@
+# -*- coding: UTF-8 -*-
+"""
+Build the PLAsTiCC header index from HEAD.FITS files and query local copies of it
+
+The local index has the same table name and columns as the MySQL
+release_<data_release> table, so GetData can run the same queries against it
+without a connection to the remote server.
+
+Example usage:
+python -m astrorapid.read_from_database.local_index --data_release ZTF_20180716 --out release_ZTF_20180716.sqlite
+
+Add --mysql to bulk load the index table on the MySQL server instead.
+"""
+import sys
+import os
+import glob
+import math
+import random
+import sqlite3
+import argparse
+import numpy as np
+import astropy.io.fits as afits
+from . import database
+
+
+def _substring_index(string, delim, count):
+    """ SQLite implementation of the MySQL SUBSTRING_INDEX function """
+    if string is None:
+        return None
+    parts = string.split(delim)
+    if count > 0:
+        return delim.join(parts[:count])
+    elif count < 0:
+        return delim.join(parts[count:])
+    return ''
+
+
+def get_local_index_connection(db_path):
+    """
+    Get a connection to a local index file. The MySQL functions used by
+    GetData queries that SQLite lacks (RAND, SUBSTRING_INDEX and the
+    trigonometric functions) are registered on the connection.
+    Returns an sqlite3 connection object.
+    """
+    if not os.path.exists(db_path):
+        message = 'Local index {} does not exist. Build it with build_local_index'.format(db_path)
+        raise RuntimeError(message)
+    con = sqlite3.connect(db_path)
+    con.create_function('RAND', 0, random.random)
+    con.create_function('SUBSTRING_INDEX', 3, _substring_index)
+    con.create_function('RADIANS', 1, math.radians)
+    con.create_function('SIN', 1, math.sin)
+    con.create_function('COS', 1, math.cos)
+    # objids have a consistent case, so let prefix LIKE patterns use the primary key index
+    con.execute('PRAGMA case_sensitive_like = ON')
+    return con
+
+
+def exec_big_sql_query(query, db_path, fetch_size=10000, verbose=False):
+    """
+    Executes a supplied query on the local index, streaming the rows in
+    batches of fetch_size
+    Yields the result of the query one row at a time
+    """
+    if verbose:
+        print(query)
+    con = get_local_index_connection(db_path)
+    try:
+        cursor = con.execute(query)
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    except sqlite3.Error as e:
+        message = '{}\nFailed to execute query\n{}'.format(e, query)
+        raise RuntimeError(message)
+    finally:
+        con.close()
+
+
+def exec_sql_query(query, db_path, verbose=False):
+    """
+    Executes a supplied query on the local index
+    Returns the result of the query (if any)
+    """
+    if verbose:
+        print(query)
+    con = get_local_index_connection(db_path)
+    try:
+        result = con.execute(query).fetchall()
+    except sqlite3.Error as e:
+        message = '{}\nFailed to execute query\n{}'.format(e, query)
+        raise RuntimeError(message)
+    finally:
+        con.close()
+    return result
+
+
+def get_objid_prefix_for_head_file(head_file):
+    """
+    Returns the field_model_base prefix of the objids in a HEAD.FITS file.
+    This is the inverse of GetData.get_photfile_for_objid e.g.
+    LSST_DDF_MODEL04/LSST_DDF_NONIa-0004_HEAD.FITS -> DDF_04_NONIa-0004
+    """
+    model_dir = os.path.basename(os.path.dirname(os.path.abspath(head_file)))
+    survey_field, model = model_dir.split('_MODEL')
+    field = survey_field.split('_')[-1]
+
+    filename = os.path.basename(head_file)
+    for suffix in ('.gz', '_HEAD.FITS'):
+        if filename.endswith(suffix):
+            filename = filename[:-len(suffix)]
+    base = filename[len(survey_field) + 1:]
+    return '{}_{}_{}'.format(field, model, base)
+
+
+def get_index_rows_from_head_file(head_file, use_fields):
+    """
+    Read a HEAD.FITS file and return a list of index table rows
+    (objid followed by the values of use_fields)
+    """
+    prefix = get_objid_prefix_for_head_file(head_file)
+    with afits.open(head_file) as head_HDU:
+        head_data = head_HDU[1].data
+        snids = np.char.strip(np.asarray(head_data['SNID']).astype(str))
+        objids = ['{}_{}'.format(prefix, snid) for snid in snids]
+        columns = []
+        for field in use_fields:
+            column = np.asarray(head_data[field])
+            if column.dtype.kind in ('S', 'U'):
+                column = np.char.strip(column.astype(str))
+            columns.append(column.tolist())
+    return [row for row in zip(objids, *columns)]
+
+
+def iter_index_rows_from_head_files(head_files, use_fields):
+    """ Yields index table rows from a list of HEAD.FITS files one file at a time """
+    for n, head_file in enumerate(head_files):
+        rows = get_index_rows_from_head_file(head_file, use_fields)
+        print(n, head_file, len(rows))
+        for row in rows:
+            yield row
+
+
+def build_mysql_index(head_files, data_release, redo=False, use_infile=True, chunk_size=50000):
+    """
+    Creates the MySQL index table for a data release and bulk loads the rows of
+    a list of HEAD.FITS files into it in chunks (with LOAD DATA LOCAL INFILE if
+    use_infile). The secondary indexes are added after the load.
+    Returns the number of rows written
+    """
+    head_files = sorted(head_files)
+    if len(head_files) == 0:
+        message = 'No HEAD.FITS files to index'
+        raise RuntimeError(message)
+
+    with afits.open(head_files[0]) as head_HDU:
+        use_fields, mysql_fields, mysql_schema = database.make_mysql_schema_from_astropy_bintable_cols(
+            head_HDU[1].columns)
+
+    table_name = database.get_index_table_name_for_release(data_release)
+    if database.check_sql_db_for_table(table_name) and not redo:
+        print("Table {} exists.".format(table_name))
+        return 0
+    database.create_sql_index_table_for_release(data_release, mysql_schema, redo=redo, table_name=table_name)
+
+    rows = iter_index_rows_from_head_files(head_files, use_fields)
+    nrows = database.write_rows_to_index_table(rows, table_name, chunk_size=chunk_size, use_infile=use_infile)
+    database.add_secondary_indexes_to_index_table(table_name)
+    print("Wrote {} rows to {}".format(nrows, table_name))
+    return nrows
+
+
+def build_local_index(head_files, db_path, table_name, redo=False):
+    """
+    Builds a local SQLite index table from a list of HEAD.FITS files, with the
+    same schema as the MySQL index table for the release. The secondary index
+    on sntype is created after the rows are loaded.
+    Returns the number of rows written
+    """
+    head_files = sorted(head_files)
+    if len(head_files) == 0:
+        message = 'No HEAD.FITS files to index'
+        raise RuntimeError(message)
+
+    if os.path.exists(db_path):
+        if not redo:
+            print("Local index {} exists.".format(db_path))
+            return 0
+        print("Clobbering local index {}.".format(db_path))
+        os.remove(db_path)
+
+    with afits.open(head_files[0]) as head_HDU:
+        use_fields, mysql_fields, mysql_schema = database.make_mysql_schema_from_astropy_bintable_cols(
+            head_HDU[1].columns)
+
+    con = sqlite3.connect(db_path)
+    con.execute('PRAGMA journal_mode = OFF')
+    con.execute('PRAGMA synchronous = OFF')
+    con.execute('CREATE TABLE {} ({}, PRIMARY KEY (objid))'.format(table_name, mysql_schema))
+    query = 'INSERT INTO {} VALUES ({})'.format(table_name, ', '.join(['?', ] * len(mysql_fields)))
+
+    nrows = 0
+    for head_file in head_files:
+        rows = get_index_rows_from_head_file(head_file, use_fields)
+        con.executemany(query, rows)
+        con.commit()
+        nrows += len(rows)
+        print(head_file, len(rows))
+
+    if 'sntype' in mysql_fields:
+        con.execute('CREATE INDEX {0}_sntype ON {0} (sntype)'.format(table_name))
+    con.execute('ANALYZE')
+    con.commit()
+    con.close()
+    print("Wrote {} rows to {}".format(nrows, db_path))
+    return nrows
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(description="Build a local header index from PLAsTiCC HEAD.FITS files")
+    parser.add_argument('--data_release', required=True, help='PLAsTiCC data release to index')
+    parser.add_argument('--out', required=False, default=None, help='Path of the SQLite index file to create')
+    parser.add_argument('--mysql', action='store_true', help='Load the index table on the MySQL server instead')
+    parser.add_argument('--no_infile', action='store_true',
+                        help='With --mysql, use chunked INSERTs instead of LOAD DATA LOCAL INFILE')
+    parser.add_argument('--data_dir', required=False, default=None,
+                        help='Directory containing the data release. Default is $PLASTICC_DIR/plasticc_data')
+    parser.add_argument('--redo', action='store_true', help='Clobber the index if it exists')
+    args = parser.parse_args(args=argv)
+
+    data_dir = args.data_dir
+    if data_dir is None:
+        data_dir = os.path.join(os.getenv('PLASTICC_DIR', ''), 'plasticc_data')
+    release_dir = os.path.join(data_dir, args.data_release)
+    head_files = glob.glob(os.path.join(release_dir, '*', '*_HEAD.FITS')) \
+                 + glob.glob(os.path.join(release_dir, '*', '*_HEAD.FITS.gz'))
+
+    if args.mysql:
+        build_mysql_index(head_files, args.data_release, redo=args.redo, use_infile=not args.no_infile)
+    else:
+        if args.out is None:
+            parser.error('--out is required unless --mysql is set')
+        table_name = database.get_index_table_name_for_release(args.data_release)
+        build_local_index(head_files, args.out, table_name, redo=args.redo)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,54 +1,124 @@
 """
 Example usage:
 nice -n 19 python -m astrorapid.read_from_database.read_light_curves_from_database --offset 0 --offsetnext 70 --nprocesses 8 --savename 'testing' --combinefiles
+
+Add --keyset to page through the index by objid key ranges instead of LIMIT/OFFSET.
+Add --consolidated to save the light curves in the columnar format of astrorapid.light_curve_store instead of one
+pandas HDFStore group per object.
+Add --linkfiles to make the combined file reference the per-batch files instead of copying them (add --compact to
+instead write a self-contained consolidated store, reading the batch files in parallel).
+Completed batches are recorded in manifest.sqlite in the save directory, so rerunning the same command only redoes
+the unfinished batches, and --combinefiles checks that the batches cover the whole selection before combining.
+Objects that cannot be read or preprocessed are skipped and recorded in the rejects table of the manifest with the
+reason, and reads of the photometry files are retried after transient I/O errors.
+Add --pipeline to overlap the database queries, FITS reads, preprocessing and writes of each batch.
 """
 
 import os
+import functools
 import numpy as np
 import h5py
-import multiprocessing as mp
 import pandas as pd
 import argparse
 
+from astrorapid import helpers
+from astrorapid.parallelism import make_pool
 from astrorapid.read_from_database.get_data import GetData
-from astrorapid.process_light_curves import InputLightCurve
+from astrorapid.read_from_database.ingest_manifest import IngestManifest, count_objects_in_file
+from astrorapid.read_from_database.ingest_pipeline import INGEST_COLUMNS, make_input_light_curve, \
+    read_light_curves_pipelined
+from astrorapid.light_curve_store import LightCurveStoreWriter, is_light_curve_store, combine_light_curve_stores, \
+    link_light_curve_stores, compact_light_curve_store
 
 
 def read_light_curves_from_sql_database(data_release, fname, field_in='%', model_in='%', batch_size=100, offset=0,
-                                        sort=True, passbands=('g', 'r'), known_redshift=True):
+                                        sort=True, passbands=('g', 'r'), known_redshift=True, key_range=None, zcut=None,
+                                        bcut=False, variablescut=False, index_path=None, consolidated=False,
+                                        rejects=None):
     print(fname)
+    if rejects is None:
+        rejects = []
 
     extrasql = ''  # "AND (objid LIKE '%00' OR objid LIKE '%50' OR sim_type_index IN (51,61,62,63,64,84,90,91,93))"  # ''#AND sim_redshift_host < 0.5 AND sim_peakmag_r < 23'
-    getter = GetData(data_release)
-    result = getter.get_lcs_data(
-        columns=['objid', 'ptrobs_min', 'ptrobs_max', 'sim_peakmag_r', 'sim_redshift_host', 'mwebv', 'sim_dlmu',
-                 'peakmjd', 'mwebv', 'ra', 'decl', 'hostgal_photoz', 'hostgal_photoz_err'],
-        field=field_in, model=model_in, snid='%', limit=batch_size, offset=offset, shuffle=False, sort=sort,
-        extrasql=extrasql)
+    extrasql += GetData.get_cuts_sql(zcut=zcut, bcut=bcut, variablescut=variablescut)
+    getter = GetData(data_release, index_path=index_path)
+    if key_range is not None:
+        # Keyset pagination: every batch costs the same regardless of how far into the index it is
+        after_objid, upto_objid = key_range
+        offset = 0
+    else:
+        after_objid, upto_objid = None, None
+    # Read the photometry grouped by PHOT.FITS file as typed arrays - no DataFrames until the preprocessed output.
+    # Objects that cannot be read or preprocessed are skipped and added to rejects with the reason.
+    read_errors = []
+    result = getter.get_lcs_data_bulk(
+        columns=INGEST_COLUMNS, field=field_in, model=model_in, snid='%', limit=batch_size, offset=offset, shuffle=False, sort=sort,
+        extrasql=extrasql, after_objid=after_objid, upto_objid=upto_objid, errors=read_errors)
 
-    store = pd.HDFStore(fname)
+    if consolidated:
+        store = LightCurveStoreWriter(fname, passbands=passbands)
+    else:
+        store = pd.HDFStore(fname)
 
     for head, phot in result:
-        objid, ptrobs_min, ptrobs_max, peakmag, redshift, mwebv, dlmu, peakmjd, mwebv, ra, dec, photoz, photozerr = head
-
-        field, model, base, snid = objid.split('_')
-
-        lc = getter.convert_pandas_lc_to_recarray_lc(phot, passbands=passbands)
-
-        inputlightcurve = InputLightCurve(lc['mjd'], lc['flux'], lc['dflux'], lc['pb'], lc['zpt'], lc['photflag'], ra,
-                                          dec, objid, redshift, mwebv, known_redshift=known_redshift,
-                                          training_set_parameters={'class_number': int(model), 'peakmjd': peakmjd})
+        try:
+            lc = getter.convert_phot_columns_to_array_lc(phot, passbands=passbands)
+            inputlightcurve = make_input_light_curve(head, lc, passbands=passbands, known_redshift=known_redshift)
 
-        savepd = inputlightcurve.preprocess_light_curve()
-        store.append(objid, savepd)
+            savepd = inputlightcurve.preprocess_light_curve()
+        except Exception as e:
+            print("Rejecting {}: {}".format(head[0], helpers.describe_error(e)))
+            rejects.append((head[0], helpers.describe_error(e)))
+            continue
+        store.append(inputlightcurve.objid, savepd)
 
     store.close()
+    rejects.extend((head[0], helpers.describe_error(e)) for head, e in read_errors)
     print("saved %s" % fname)
 
 
-def combine_hdf_files(save_dir, combined_savename, training_set_dir):
-    fnames = os.listdir(save_dir)
+def combine_hdf_files(save_dir, combined_savename, training_set_dir, link=False, compact=False, nprocesses=1,
+                      fnames=None):
+    """ Combine the per-batch files in save_dir into a single file.
+
+    Parameters
+    ----------
+    save_dir : str
+        Directory of the per-batch files.
+    combined_savename : str
+        File name of the combined file.
+    training_set_dir : str
+        Directory to save the combined file in.
+    link : bool
+        If True, don't copy the light curves. The combined file instead references the per-batch files (external
+        links for pandas files, virtual datasets for consolidated stores), so merging takes a time independent of the
+        number of observations. The per-batch files must be kept.
+    compact : bool
+        Only used for consolidated stores. If True, the linked store is rewritten as a self-contained file, reading
+        the per-batch files with nprocesses processes.
+    nprocesses : int
+        Number of processes used by compact.
+    fnames : list, optional
+        Names of the files in save_dir to combine. The default is all the .hdf5 files in save_dir.
+
+    """
+    if fnames is None:
+        fnames = [f for f in os.listdir(save_dir) if f.endswith('.hdf5')]
     fname_out = os.path.join(training_set_dir, combined_savename)
+
+    fpaths = [os.path.join(save_dir, f) for f in fnames]
+    if fpaths and is_light_curve_store(fpaths[0]):
+        if compact:
+            fname_links = fname_out + '.links'
+            link_light_curve_stores(fpaths, fname_links)
+            compact_light_curve_store(fname_links, fname_out, nprocesses=nprocesses)
+            os.remove(fname_links)
+        elif link:
+            link_light_curve_stores(fpaths, fname_out)
+        else:
+            combine_light_curve_stores(fpaths, fname_out)
+        return
+
     output_file = h5py.File(fname_out, 'w')
 
     for n, f in enumerate(fnames):
@@ -56,8 +126,11 @@ def combine_hdf_files(save_dir, combined_savename, training_set_dir):
         try:
             f_hdf = h5py.File(os.path.join(save_dir, f), 'r')
             for objid in f_hdf.keys():
-                objid = objid.encode('utf-8')
-                h5py.h5o.copy(f_hdf.id, objid, output_file.id, objid)
+                if link:
+                    output_file[objid] = h5py.ExternalLink(os.path.abspath(os.path.join(save_dir, f)), '/' + objid)
+                else:
+                    objid = objid.encode('utf-8')
+                    h5py.h5o.copy(f_hdf.id, objid, output_file.id, objid)
             f_hdf.close()
         except OSError as e:
             print("Failed to open file", "f")
@@ -65,13 +138,36 @@ def combine_hdf_files(save_dir, combined_savename, training_set_dir):
     output_file.close()
 
 
-def create_all_hdf_files(args):
-    data_release, i, save_dir, field_in, model_in, batch_size, sort, passbands, known_redshift = args
-    offset = batch_size * i
-    fname = os.path.join(save_dir, 'lc_{}.hdf5'.format(i))
-    read_light_curves_from_sql_database(data_release=data_release, fname=fname, field_in=field_in, model_in=model_in,
-                                        batch_size=batch_size, offset=offset, sort=sort, passbands=passbands,
-                                        known_redshift=known_redshift)
+def create_all_hdf_files(args, pipeline_kwargs=None):
+    """ Read, preprocess and save one batch and record it in the manifest. args is the tuple made by main(). If
+    pipeline_kwargs is given, the batch is read with read_light_curves_pipelined and these extra arguments. """
+    data_release, key_range, save_dir, field_in, model_in, batch_size, sort, passbands, known_redshift, keyset, read_kwargs, manifest = args
+    if keyset:
+        offset = 0
+    else:
+        # Row offset range (lower, upper] of the objid-sorted index
+        offset, batch_size = key_range[0], key_range[1] - key_range[0]
+    fname = manifest.get_batch_fname(key_range)
+    fpath = os.path.join(save_dir, fname)
+    # Write to a temporary name so that a killed worker never leaves a truncated file under the batch name
+    fpath_part = fpath + '.part'
+    if os.path.exists(fpath_part):
+        os.remove(fpath_part)
+
+    read_function = read_light_curves_from_sql_database
+    rejects = []
+    if pipeline_kwargs is not None:
+        read_function = functools.partial(read_light_curves_pipelined, **pipeline_kwargs)
+    read_function(data_release=data_release, fname=fpath_part, field_in=field_in, model_in=model_in,
+                  batch_size=batch_size, offset=offset, sort=sort, passbands=passbands,
+                  known_redshift=known_redshift, key_range=key_range if keyset else None, rejects=rejects,
+                  **read_kwargs)
+
+    nobjects = count_objects_in_file(fpath_part)
+    os.replace(fpath_part, fpath)
+    manifest.record_rejects(fname, rejects)
+    manifest.record(fname, key_range, nobjects)
+    print("Recorded {} with {} objects and {} rejects in {}".format(fname, nobjects, len(rejects), manifest.path))
 
 
 def main():
@@ -97,6 +193,29 @@ def main():
     parser.add_argument("--savename", type=str)
     parser.add_argument("--combinefiles", help="Only set this if after this action, all files will have been created.",
                         action='store_true')
+    parser.add_argument("--keyset", help="Partition the index into objid key ranges instead of using LIMIT/OFFSET.",
+                        action='store_true')
+    parser.add_argument("--zcut", type=float, help="Only ingest objects with redshift below this value.")
+    parser.add_argument("--bcut", help="Only ingest objects outside the galactic plane (|b| > 15).",
+                        action='store_true')
+    parser.add_argument("--variablescut", help="Do not ingest the variable models.", action='store_true')
+    parser.add_argument("--consolidated", help="Save the light curves in the consolidated columnar format.",
+                        action='store_true')
+    parser.add_argument("--linkfiles", help="With --combinefiles, link to the per-batch files instead of copying "
+                                            "them into the combined file.", action='store_true')
+    parser.add_argument("--compact", help="With --combinefiles and --consolidated, write a self-contained combined "
+                                          "store, reading the per-batch files in parallel.", action='store_true')
+    parser.add_argument("--pipeline", help="Read each batch with a pipeline of concurrent header, photometry, "
+                                           "preprocessing and write stages (see ingest_pipeline.py). The batches are "
+                                           "then run one after another and --nprocesses sets the number of "
+                                           "preprocessing processes.", action='store_true')
+    parser.add_argument("--nreaders", type=int, default=2, help="With --pipeline, number of photometry reading "
+                                                                 "threads. Default is 2.")
+    parser.add_argument("--maxtasksperchild", type=int, help="Replace a worker process after this many tasks to "
+                                                              "contain memory growth. A task is a batch, or an object "
+                                                              "with --pipeline. Default is 10 batches or 10000 objects.")
+    parser.add_argument("--index_path", type=str, help="Query this local header index (see local_index.py) instead "
+                                                       "of the MySQL server.")
     args = parser.parse_args()
     if args.offset is not None:
         offset = args.offset
@@ -121,27 +240,67 @@ def main():
     if not os.path.exists(save_dir) and offset == 0:
         os.makedirs(save_dir)
 
+    # Apply the training set cuts in the header query so that rejected objects are never read
+    cuts = {'zcut': args.zcut, 'bcut': args.bcut, 'variablescut': args.variablescut}
+
+    getter = GetData(data_release, index_path=args.index_path)
+    if args.keyset:
+        key_ranges = getter.get_objid_key_ranges(batch_size, field=field, model=model,
+                                                 extrasql=GetData.get_cuts_sql(**cuts))
+        offset_next = min(offset_next, len(key_ranges))
+        print("{} key ranges of {} objects".format(len(key_ranges), batch_size))
+    else:
+        key_ranges = [(i * batch_size, (i + 1) * batch_size) for i in range(offset_next)]
+
+    # Completed batches are recorded in the manifest, so only the ranges it does not cover are (re)done
+    selection = "{} field={} model={} cuts={} consolidated={}".format(data_release, field, model, sorted(cuts.items()),
+                                                                      args.consolidated)
+    manifest = IngestManifest(save_dir, mode='keyset' if args.keyset else 'offset', selection=selection)
+    remaining = manifest.get_remaining(key_ranges[offset:offset_next])
+    print("{} of {} batches to do".format(len(remaining), offset_next - offset))
+
     # Multiprocessing
-    i_list = np.arange(offset, offset_next)
-    print(i_list)
     args_list = []
-    file_list = os.listdir(save_dir)
-    for i in i_list:
-        if 'lc_{}.hdf5'.format(i) not in file_list:
-            print(os.path.join(save_dir, 'lc_{}.hdf5'.format(i)))
-            args_list.append((data_release, i, save_dir, field, model, batch_size, sort, passbands, known_redshift))
-
-    if nprocesses == 1:
-        for args in args_list:
-            create_all_hdf_files(args)
+    for key_range in remaining:
+        print(os.path.join(save_dir, manifest.get_batch_fname(key_range)))
+        args_list.append((data_release, key_range, save_dir, field, model, batch_size, sort, passbands, known_redshift,
+                          args.keyset, dict(cuts, index_path=args.index_path, consolidated=args.consolidated),
+                          manifest))
+
+    if args.pipeline:
+        pool = make_pool(nprocesses, maxtasksperchild=args.maxtasksperchild or 10000)
+        try:
+            pipeline_kwargs = {'nreaders': args.nreaders, 'pool': pool, 'npreprocess': nprocesses}
+            for batch_args in args_list:
+                create_all_hdf_files(batch_args, pipeline_kwargs=pipeline_kwargs)
+        except BaseException:
+            # A failed batch may leave objects in the pool that nobody collects
+            pool.terminate()
+            raise
+        finally:
+            pool.close()
+            pool.join()
+    elif nprocesses == 1:
+        for batch_args in args_list:
+            create_all_hdf_files(batch_args)
     else:
-        pool = mp.Pool(nprocesses)
+        pool = make_pool(nprocesses, maxtasksperchild=args.maxtasksperchild or 10)
         results = pool.map_async(create_all_hdf_files, args_list)
         pool.close()
         pool.join()
 
     if args.combinefiles:
-        combine_hdf_files(save_dir, 'saved_lc_{}_{}_{}.hdf5'.format(field, data_release, savename), training_set_dir)
+        nobjects = next(getter.get_lcs_headers(field=field, model=model, get_num_lightcurves=True, sort=False,
+                                               extrasql=GetData.get_cuts_sql(**cuts)))
+        print("{} objects were rejected (see the rejects table of {})".format(len(manifest.get_rejects()),
+                                                                              manifest.path))
+        problems = manifest.verify(nobjects_expected=nobjects)
+        if problems:
+            message = 'Not combining the files, the ingest is incomplete:\n' + '\n'.join(problems)
+            raise RuntimeError(message)
+        fnames = [fname for fname, key_range, nobjects, size, checksum in manifest.get_completed()]
+        combine_hdf_files(save_dir, 'saved_lc_{}_{}_{}.hdf5'.format(field, data_release, savename), training_set_dir,
+                          link=args.linkfiles, compact=args.compact, nprocesses=nprocesses, fnames=fnames)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,366 @@
+"""
+Local classification service with micro-batching
+
+    astrorapid serve --port 8765
+    astrorapid serve --socket /tmp/astrorapid.sock
+
+The service loads the model once and keeps it in memory. Light curves are posted as JSON to /classify, either as
+lists in the order of the Classify tuples
+
+    {"light_curves": [[mjd, flux, fluxerr, passband, zeropoint, photflag, ra, dec, objid, redshift, mwebv], ...]}
+
+or as objects with those names as keys. Requests that arrive at the same time are classified together: the first
+request of a batch waits at most `max_wait` seconds for others, and a batch holds at most `max_batch_size` light
+curves, so many clients classifying one light curve each share a model call instead of paying for one each.
+GET /stats returns the queue depth and a histogram of the batch sizes. `ClassificationClient` is a client for both
+HTTP and Unix socket services.
+"""
+import os
+import json
+import time
+import queue
+import socket
+import threading
+import http.client
+import socketserver
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from astrorapid.classify import Classify
+from astrorapid.process_light_curves import read_multiple_light_curves
+from astrorapid.prepare_arrays import PrepareInputArrays
+
+LIGHT_CURVE_KEYS = ('mjd', 'flux', 'fluxerr', 'passband', 'zeropoint', 'photflag', 'ra', 'dec', 'objid', 'redshift',
+                    'mwebv')
+
+
+def light_curve_from_json(light_curve):
+    """ Returns the Classify tuple of a light curve given as a list in the tuple order or as a dictionary """
+    if isinstance(light_curve, dict):
+        light_curve = [light_curve.get(key) for key in LIGHT_CURVE_KEYS]
+    if len(light_curve) != len(LIGHT_CURVE_KEYS):
+        raise ValueError("A light curve needs the {} entries {}".format(len(LIGHT_CURVE_KEYS),
+                                                                         ', '.join(LIGHT_CURVE_KEYS)))
+    mjd, flux, fluxerr, passband, zeropoint, photflag, ra, dec, objid, redshift, mwebv = light_curve
+    return (np.asarray(mjd, dtype=float), np.asarray(flux, dtype=float), np.asarray(fluxerr, dtype=float),
+            np.asarray(passband), np.asarray(zeropoint, dtype=float), np.asarray(photflag, dtype=int), ra, dec,
+            objid, redshift, mwebv)
+
+
+class _Request(object):
+    def __init__(self, light_curves):
+        self.light_curves = light_curves
+        self.results = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher(object):
+    def __init__(self, known_redshift=True, model_filepath='', passbands=('g', 'r'), bcut=False, zcut=None,
+                 max_batch_size=64, max_wait=0.005, model=None):
+        """ Classify light curves from many threads, coalescing concurrent calls into batches.
+
+        Parameters
+        ----------
+        known_redshift, model_filepath, passbands, bcut, zcut, model :
+            Same as for Classify.
+        max_batch_size : int
+            Maximum number of light curves classified in one model call. A single request with more light curves is
+            classified on its own.
+        max_wait : float
+            Maximum time in seconds that the first request of a batch waits for more requests.
+
+        """
+        # Load the model once. Every batch reuses it.
+        classification = Classify([], known_redshift=known_redshift, model_filepath=model_filepath,
+                                  passbands=passbands, bcut=bcut, zcut=zcut, model=model)
+        self.model = classification.model
+        self.class_names = classification.class_names
+        self.known_redshift = known_redshift
+        self.passbands = passbands
+        self.prepare_input_arrays = PrepareInputArrays(passbands, classification.contextual_info, bcut, zcut)
+
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+        self.nqueued = 0
+        self.max_nqueued = 0
+        self.nrequests = 0
+        self.nbatches = 0
+        self.nlight_curves = 0
+        self.batch_time = 0.
+        self.batch_size_histogram = Counter()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def classify(self, light_curves):
+        """ Classify a list of light curves in the Classify tuple format. Blocks until its batch is done.
+
+        Returns
+        -------
+        results : list
+            For each light curve, a dictionary with the objid, the MJDs of the time steps and the class probabilities
+            at each time step, or None if it was removed by the selection cuts.
+        """
+        request = _Request(list(light_curves))
+        with self._lock:
+            self.nqueued += len(request.light_curves)
+            self.max_nqueued = max(self.max_nqueued, self.nqueued)
+            self.nrequests += 1
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.results
+
+    def _run(self):
+        while True:
+            requests = [self.queue.get()]
+            nlight_curves = len(requests[0].light_curves)
+            deadline = time.time() + self.max_wait
+            while nlight_curves < self.max_batch_size:
+                try:
+                    request = self.queue.get(timeout=max(0., deadline - time.time()))
+                except queue.Empty:
+                    break
+                if nlight_curves + len(request.light_curves) > self.max_batch_size:
+                    # Keep it for the next batch
+                    self._classify_batch(requests)
+                    requests, nlight_curves = [request], len(request.light_curves)
+                    deadline = time.time() + self.max_wait
+                    continue
+                requests.append(request)
+                nlight_curves += len(request.light_curves)
+            self._classify_batch(requests)
+
+    def _classify_batch(self, requests):
+        start = time.time()
+        try:
+            self._predict(requests)
+        except Exception:
+            # Classify the requests one at a time so that a bad light curve only fails its own request
+            for request in requests:
+                try:
+                    self._predict([request])
+                except Exception as e:
+                    request.error = e
+        nlight_curves = sum(len(request.light_curves) for request in requests)
+        with self._lock:
+            self.nqueued -= nlight_curves
+            self.nbatches += 1
+            self.nlight_curves += nlight_curves
+            self.batch_time += time.time() - start
+            self.batch_size_histogram[nlight_curves] += 1
+        for request in requests:
+            request.done.set()
+
+    def _predict(self, requests):
+        # Give every light curve a unique objid in the batch, since the light curves are keyed by objid
+        light_curves = []
+        for i, request in enumerate(requests):
+            for j, light_curve in enumerate(request.light_curves):
+                light_curves.append(tuple(light_curve[:8]) + ('{}_{}'.format(i, j),) + tuple(light_curve[9:]))
+
+        # The same steps as Classify.get_predictions, without its printing
+        processed_light_curves = read_multiple_light_curves(light_curves, known_redshift=self.known_redshift)
+        X, orig_lc, timesX, objids, trigger_mjds = self.prepare_input_arrays.prepare_input_arrays(
+            processed_light_curves, verbose=False)
+        predictions = {}
+        if objids:
+            y_predict, time_steps = Classify.predict_arrays(self.model, X, timesX, trigger_mjds, orig_lc,
+                                                            self.passbands)
+            predictions = dict(zip(objids, zip(y_predict, time_steps)))
+
+        for i, request in enumerate(requests):
+            results = []
+            for j, light_curve in enumerate(request.light_curves):
+                prediction = predictions.get('{}_{}'.format(i, j))
+                if prediction is None:
+                    results.append(None)
+                else:
+                    results.append({'objid': light_curve[8], 'mjd': prediction[1], 'probabilities': prediction[0]})
+            request.results = results
+
+    def get_stats(self):
+        """ Returns the counters of the service as a dictionary """
+        with self._lock:
+            return {'uptime': time.time() - self.start_time,
+                    'requests': self.nrequests,
+                    'light_curves': self.nlight_curves,
+                    'batches': self.nbatches,
+                    'queue_depth': self.nqueued,
+                    'max_queue_depth': self.max_nqueued,
+                    'mean_batch_size': self.nlight_curves / self.nbatches if self.nbatches else 0.,
+                    'mean_batch_time': self.batch_time / self.nbatches if self.nbatches else 0.,
+                    'batch_size_histogram': {str(size): count
+                                             for size, count in sorted(self.batch_size_histogram.items())},
+                    'max_batch_size': self.max_batch_size,
+                    'max_wait': self.max_wait}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _send_json(self, status, content):
+        body = json.dumps(content, default=_to_json).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._send_json(200, self.server.batcher.get_stats())
+        else:
+            self._send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+
+    def do_POST(self):
+        if self.path != '/classify':
+            self._send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+            return
+        try:
+            content = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if isinstance(content, dict):
+                content = content['light_curves']
+            light_curves = [light_curve_from_json(light_curve) for light_curve in content]
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {'error': 'Invalid request: {}'.format(e)})
+            return
+        try:
+            results = self.server.batcher.classify(light_curves)
+        except Exception as e:
+            self._send_json(500, {'error': '{}: {}'.format(type(e).__name__, e)})
+            return
+        self._send_json(200, {'class_names': self.server.batcher.class_names, 'results': results})
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def _to_json(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError("{} is not JSON serializable".format(type(obj)))
+
+
+# Many clients connect at the same time, so allow more pending connections than the default of 5
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class _TCPHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def make_server(batcher, host='127.0.0.1', port=8765, socket_path=None, verbose=False):
+    """ Returns an HTTP server of the batcher listening on host:port, or on a Unix socket if socket_path is given.
+    Run it with server.serve_forever(). """
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = _UnixHTTPServer(socket_path, _Handler)
+    else:
+        server = _TCPHTTPServer((host, port), _Handler)
+    server.batcher = batcher
+    server.verbose = verbose
+    return server
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=60):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class ClassificationClient(object):
+    def __init__(self, host='127.0.0.1', port=8765, socket_path=None, timeout=60):
+        """ Client of a classification service. The connection is kept open between calls, so a client should not
+        be shared between threads. """
+        if socket_path is not None:
+            self.connection = _UnixHTTPConnection(socket_path, timeout=timeout)
+        else:
+            self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def _request(self, method, path, content=None):
+        body = None if content is None else json.dumps(content, default=_to_json)
+        headers = {} if body is None else {'Content-Type': 'application/json'}
+        self.connection.request(method, path, body=body, headers=headers)
+        response = self.connection.getresponse()
+        content = json.loads(response.read())
+        if response.status != 200:
+            raise RuntimeError("Service returned {}: {}".format(response.status, content.get('error')))
+        return content
+
+    def classify(self, light_curves):
+        """ Classify a list of light curves in the Classify tuple format.
+
+        Returns
+        -------
+        class_names : list
+            Names of the classes of the probabilities.
+        results : list
+            For each light curve, a dictionary with the objid, the MJDs of the time steps ('mjd') and the class
+            probabilities at each time step ('probabilities'), or None if it was removed by the selection cuts.
+        """
+        content = self._request('POST', '/classify', {'light_curves': [list(lc) for lc in light_curves]})
+        return content['class_names'], content['results']
+
+    def stats(self):
+        """ Returns the counters of the service, including the queue depth and the batch size histogram """
+        return self._request('GET', '/stats')
+
+    def close(self):
+        self.connection.close()
+
+
+def serve(args):
+    """ Run the service with the arguments parsed by astrorapid.cli """
+    batcher = MicroBatcher(known_redshift=not args.no_redshift, model_filepath=args.model or '',
+                           passbands=tuple(args.passbands), max_batch_size=args.max_batch_size,
+                           max_wait=args.max_wait_ms / 1000.)
+    server = make_server(batcher, host=args.host, port=args.port, socket_path=args.socket, verbose=args.verbose)
+    print("Serving on {}".format(args.socket if args.socket else 'http://{}:{}'.format(args.host, args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+def add_arguments(parser):
+    """ Add the arguments of `astrorapid serve` to an argparse parser """
+    parser.add_argument("--host", type=str, default='127.0.0.1', help="Address to listen on. Default is 127.0.0.1.")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on. Default is 8765.")
+    parser.add_argument("--socket", type=str, help="Listen on this Unix socket instead of a TCP port.")
+    parser.add_argument("--model", type=str, help="Keras model file. Default is the pre-trained ZTF model.")
+    parser.add_argument("--no_redshift", action='store_true', help="Use the model for unknown redshifts.")
+    parser.add_argument("--passbands", type=str, nargs='+', default=['g', 'r'], help="Passbands. Default is g r.")
+    parser.add_argument("--max_batch_size", type=int, default=64,
+                        help="Maximum number of light curves in a model call. Default is 64.")
+    parser.add_argument("--max_wait_ms", type=float, default=5.,
+                        help="Maximum time in milliseconds that a request waits for others to batch with. "
+                             "Default is 5.")
+    parser.add_argument("--verbose", action='store_true', help="Log every request.")
@@ -0,0 +1,228 @@
+"""
+Low-latency classification of one light curve at a time
+
+Classify is made for lists of light curves: each light curve goes through LAobject and a pandas table
+(read_multiple_light_curves), the arrays are made by PrepareInputArrays and the model is run with model.predict,
+which sets up a full Keras prediction loop on every call. For a single alert these fixed costs are most of the time.
+SingleObjectClassifier does the same preprocessing with numpy arrays only, writes the input into buffers that are
+allocated once, and runs the model with predict_on_batch. The predictions are the same as those of Classify.
+
+Run `astrorapid benchmark` to measure the latency of both paths (see latency_benchmark.py).
+"""
+import warnings
+import numpy as np
+from scipy.interpolate import interp1d
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.cosmology import WMAP9 as cosmo
+
+from astrorapid import helpers
+from astrorapid.classify import Classify
+from astrorapid.prepare_arrays import PrepareArrays
+from astrorapid.ANTARES_object import constants
+
+GOOD_FILTERS = ('u', 'g', 'r', 'i', 'z', 'Y')
+
+_galactic_pole = None
+
+
+def get_galactic_latitude(ra, dec):
+    """ Galactic latitude in degrees of a position in ICRS degrees. Same as SkyCoord(...).galactic.b but without
+    making a SkyCoord for every light curve, which takes a few milliseconds. """
+    global _galactic_pole
+    if _galactic_pole is None:
+        pole = SkyCoord(l=0 * u.degree, b=90 * u.degree, frame='galactic').icrs
+        _galactic_pole = pole.cartesian.xyz.value
+    ra, dec = np.radians(ra), np.radians(dec)
+    position = np.array([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+    return np.degrees(np.arcsin(np.clip(np.dot(position, _galactic_pole), -1., 1.)))
+
+
+class SingleObjectClassifier(object):
+    def __init__(self, known_redshift=True, model_filepath='', passbands=('g', 'r'), bcut=False, zcut=None,
+                 graph=None, model=None):
+        """ Classify light curves one at a time with as little fixed overhead as possible.
+
+        The input buffers are reused by every call, so use one SingleObjectClassifier per thread.
+
+        Parameters
+        ----------
+        known_redshift, model_filepath, passbands, bcut, zcut, graph, model :
+            Same as for Classify.
+
+        """
+        classification = Classify([], known_redshift=known_redshift, model_filepath=model_filepath,
+                                  passbands=passbands, bcut=bcut, zcut=zcut, graph=graph, model=model)
+        self.model = classification.model
+        self.model_filepath = classification.model_filepath
+        self.class_names = classification.class_names
+        self.contextual_info = classification.contextual_info
+        self.known_redshift = known_redshift
+        self.passbands = passbands
+        self.bcut = bcut
+        self.zcut = zcut
+        self.graph = graph
+
+        self.prepare_arrays = PrepareArrays(passbands, self.contextual_info)
+        self.nobs = self.prepare_arrays.nobs
+        self.X = np.zeros((1, self.nobs, self.prepare_arrays.nfeatures), dtype=np.float32)
+        self.timesX = np.zeros(self.nobs)
+
+        # The first call of predict_on_batch builds the prediction function. Do it now instead of on the first alert.
+        self.predict_on_batch()
+
+    def predict_on_batch(self):
+        if self.graph is not None:
+            with self.graph.as_default():
+                return self.model.predict_on_batch(self.X)
+        return self.model.predict_on_batch(self.X)
+
+    def preprocess_light_curve(self, light_curve):
+        """ Same as InputLightCurve.preprocess_light_curve followed by LAobject, but with numpy arrays.
+
+        Returns
+        -------
+        lc : dict
+            The times and normalised fluxes of each passband, sorted by time.
+        otherinfo : list
+            [redshift, b, mwebv, trigger_mjd]
+
+        """
+        mjd, flux, fluxerr, passband, zeropoint, photflag, ra, dec, objid, redshift, mwebv = light_curve
+        mjd = np.asarray(mjd, dtype=float)
+        flux = np.asarray(flux, dtype=float)
+        fluxerr = np.asarray(fluxerr, dtype=float)
+        passband = np.asarray(passband)
+        zeropoint = np.asarray(zeropoint, dtype=float)
+        photflag = np.asarray(photflag)
+
+        b = get_galactic_latitude(ra, dec)
+        trigger_mjd = float(mjd[photflag == constants.TRIGGER_PHOTFLAG][0])
+        t = mjd - trigger_mjd
+        if self.known_redshift and redshift is not None:
+            t = t / (1 + redshift)
+            flux, fluxerr = helpers.calc_luminosity(flux, fluxerr, cosmo.distmod(redshift).value)
+
+        # Remove the bad values like LAobject
+        time = t.astype('f')
+        flux = flux.astype('f')
+        fluxerr = fluxerr.astype('f')
+        mask = np.isfinite(fluxerr) & np.isfinite(flux) & np.isfinite(zeropoint)
+        saveind = np.where(photflag[mask] >= constants.GOOD_PHOTFLAG)
+        mask[saveind] = True
+        time, flux, passband = time[mask], flux[mask], passband[mask]
+
+        filters = set(passband)
+        if not filters.issubset(GOOD_FILTERS):
+            warnings.warn('Number of useful filters ({}) does not equal number available filters ({}) - some filters '
+                          'will not be used'.format(''.join(filters & set(GOOD_FILTERS)), ''.join(filters)),
+                          RuntimeWarning)
+        if not filters & set(GOOD_FILTERS):
+            raise ValueError('Object {} with locus ID {} has no good observations.'.format(objid, objid))
+
+        # Normalise the flux of each passband to between 0 and 1 like LAobject._remove_flux_extinction. The
+        # extinction is not applied there since LAobject is made without ebv.
+        lc = {}
+        for pb in filters & set(GOOD_FILTERS):
+            ind = np.where(passband == pb)[0]
+            ind = ind[time[ind].argsort()]
+            flux_pb = flux[ind].astype(np.float64)
+            if len(ind) > 1:
+                minflux = flux_pb.min()
+                fluxrenorm = (flux_pb - minflux).astype('f')
+                fluxrenorm = (fluxrenorm / (flux_pb.max() - minflux)).astype('f')
+            else:
+                fluxrenorm = flux[ind] / (flux[ind] / 0.5)
+            # float64 like the columns of the pandas table
+            lc[pb] = (time[ind].astype(np.float64), fluxrenorm.astype(np.float64))
+
+        otherinfo = [np.nan if redshift is None else redshift, b, mwebv, trigger_mjd]
+
+        return lc, otherinfo
+
+    def make_cuts(self, lc, b, redshift):
+        """ Returns the reason that PrepareInputArrays would remove the light curve, or None. The cut on the number
+        of epochs is left out: PrepareInputArrays counts the rows of a table that always has the four rows of
+        otherinfo, so it never removes a light curve. """
+        if 'r' not in lc:
+            return "No r band data. passbands"
+        if self.bcut and abs(b) < 15:
+            return "In galactic plane. b = {}".format(b)
+        if self.zcut is not None and redshift is not None and (redshift > self.zcut or redshift == 0):
+            return "Redshift cut. z = {}".format(redshift)
+        return None
+
+    def update_X(self, lc, otherinfo):
+        """ Fill the input buffers like PrepareInputArrays.prepare_input_arrays. Returns the number of time steps. """
+        self.X[:] = 0.
+        self.timesX[:] = 0.
+
+        times = {}
+        fluxes = {}
+        for pb in self.passbands:
+            if pb in lc:
+                time, flux = lc[pb]
+                times[pb] = time[:self.nobs][~np.isnan(time[:self.nobs])]
+                fluxes[pb] = flux[:self.nobs][~np.isnan(flux[:self.nobs])]
+        mintime = min(time.min() for time in times.values())
+        maxtime = max(time.max() for time in times.values()) + self.prepare_arrays.timestep
+        tinterp, len_t = self.prepare_arrays.make_t_interp(mintime, maxtime)
+        self.timesX[0:len_t] = tinterp
+
+        for j, pb in enumerate(self.passbands):
+            if pb not in lc:
+                continue
+            time, flux = times[pb], fluxes[pb]
+            if len(flux) > 1:
+                if flux[-1] > flux[-2]:  # If last values are increasing, then set fill_values to zero
+                    f = interp1d(time, flux, kind='linear', bounds_error=False, fill_value=0.)
+                else:
+                    f = interp1d(time, flux, kind='linear', bounds_error=False, fill_value='extrapolate')
+                self.X[0, 0:len_t, j] = np.nan_to_num(f(tinterp)).clip(min=0)
+
+        # Add contextual information after the passbands
+        for jj, c_idx in enumerate(self.contextual_info):
+            self.X[0, 0:len_t, len(self.passbands) + jj] = otherinfo[c_idx]
+
+        return len_t
+
+    def get_predictions(self, light_curve, return_predictions_at_obstime=False):
+        """ Return the class probabilities as a function of time for one light curve
+
+        Parameters
+        ----------
+        light_curve : tuple
+            Light curve in the form (mjd, flux, fluxerr, passband, zeropoint, photflag, ra, dec, objid, redshift,
+            mwebv), like the tuples given to Classify.
+        return_predictions_at_obstime: bool
+            Return the predictions at the observation times instead of at the 50 interpolated timesteps.
+
+        Returns
+        -------
+        y_predict: array
+            Classification probability vector at each time step. Array of shape (n, m), where n is the number of time
+            steps and m is the number of classes. None if the light curve was removed by the selection cuts.
+        time_steps: array
+            MJD time steps corresponding to the timesteps of the y_predict array.
+
+        """
+        redshift = light_curve[9]
+        lc, otherinfo = self.preprocess_light_curve(light_curve)
+        reason = self.make_cuts(lc, otherinfo[1], redshift)
+        if reason is not None:
+            print(reason)
+            return None, None
+
+        self.update_X(lc, otherinfo)
+        y_predict = np.asarray(self.predict_on_batch())[0]
+        trigger_mjd = otherinfo[3]
+        argmax = self.timesX.argmax() + 1
+
+        if return_predictions_at_obstime:
+            obs_time = np.concatenate([lc[pb][0] for pb in self.passbands if pb in lc])
+            obs_time = np.sort(obs_time[~np.isnan(obs_time)])
+            y_predict = np.array([np.interp(obs_time, self.timesX[:argmax], y_predict[:argmax, classnum])
+                                  for classnum in range(y_predict.shape[1])]).T
+            return y_predict, obs_time + trigger_mjd
+
+        return y_predict[:argmax], self.timesX[:argmax] + trigger_mjd
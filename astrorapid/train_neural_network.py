@@ -1,23 +1,47 @@
 import os
+import numpy as np
+import keras
 from keras.models import Sequential
 from keras.models import load_model
 from keras.layers import Dense, Input
 from keras.layers import LSTM, GRU
 from keras.layers import Dropout, BatchNormalization, Activation, TimeDistributed
-from keras.layers.convolutional import Conv1D, Conv2D
-from keras.layers.convolutional import MaxPooling1D, MaxPooling2D
+from keras.layers import Conv1D, Conv2D
+from keras.layers import MaxPooling1D, MaxPooling2D
+from keras.utils import to_categorical
 
 from astrorapid.prepare_arrays import PrepareTrainingSetArrays
+from astrorapid.data_loader import TrainingSequence
+from astrorapid.artifact_cache import ArtifactCache
+from astrorapid.parallelism import configure_tensorflow
 from astrorapid.plot_metrics import plot_metrics
 
 
-def train_model(X_train, X_test, y_train, y_test, sample_weights=None, fig_dir='.', retrain=True, epochs=25):
+def train_model(X_train, X_test, y_train, y_test, sample_weights=None, fig_dir='.', retrain=True, epochs=25,
+                num_classes=None, stream=False, workers=1, sparse_labels=None, class_lut=None):
     model_filename = os.path.join(fig_dir, "keras_model.hdf5")
+    configure_tensorflow()
 
     if not retrain and os.path.isfile(model_filename):
         model = load_model(model_filename)
     else:
-        num_classes = y_test.shape[-1]
+        # Integer labels of shape (nobjects, ntimesteps) are used with a sparse loss instead of one-hot labels, unless
+        # sparse_labels is False. Then they are one-hot encoded here, or one batch at a time when streaming.
+        # If class_lut is given, the labels are class numbers that it maps to class indexes.
+        if sparse_labels is None:
+            sparse_labels = y_train.ndim == 2
+        if num_classes is None:
+            if y_test.ndim == 3:
+                num_classes = y_test.shape[-1]
+            else:
+                num_classes = int(np.max(class_lut if class_lut is not None else y_test)) + 1
+        loss = 'sparse_categorical_crossentropy' if sparse_labels else 'categorical_crossentropy'
+        if stream and sample_weights is not None and np.ndim(sample_weights) == 1:
+            # Give the per-timestep loss of the loader batches a weight at each timestep (without copying)
+            sample_weights = np.broadcast_to(np.asarray(sample_weights, dtype=np.float32)[:, None], y_train.shape[:2])
+        compile_kwargs = {}
+        if sample_weights is not None and np.ndim(sample_weights) == 2 and int(keras.__version__.split('.')[0]) < 3:
+            compile_kwargs['sample_weight_mode'] = 'temporal'
 
         model = Sequential()
 
@@ -36,8 +60,22 @@ def train_model(X_train, X_test, y_train, y_test, sample_weights=None, fig_dir='
         model.add(Dropout(0.2, seed=42))
 
         model.add(TimeDistributed(Dense(num_classes, activation='softmax')))
-        model.compile(loss='categorical_crossentropy', optimizer='adam', metrics=['accuracy'])
-        model.fit(X_train, y_train, validation_data=(X_test, y_test), epochs=epochs, batch_size=64, verbose=2, sample_weight=sample_weights)
+        model.compile(loss=loss, optimizer='adam', metrics=['accuracy'], **compile_kwargs)
+        if stream:
+            # Read shuffled mini-batches from the memmapped arrays instead of loading them into memory
+            label_kwargs = {'class_lut': class_lut, 'num_classes': None if sparse_labels else num_classes}
+            train_data = TrainingSequence(X_train, y_train, sample_weights, batch_size=64, shuffle=True,
+                                          workers=workers, use_multiprocessing=workers > 1, **label_kwargs)
+            test_data = TrainingSequence(X_test, y_test, batch_size=64, shuffle=False, **label_kwargs)
+            model.fit(train_data, validation_data=test_data, epochs=epochs, verbose=2, **train_data.get_fit_kwargs())
+        else:
+            # Load the arrays into memory. With a stratified split they are LazyIndexedArrays, which fit can't batch.
+            X_train, X_test, y_train, y_test = (np.asarray(a) for a in (X_train, X_test, y_train, y_test))
+            if class_lut is not None:
+                y_train, y_test = class_lut[y_train], class_lut[y_test]
+            if not sparse_labels and y_train.ndim == 2:
+                y_train, y_test = to_categorical(y_train, num_classes), to_categorical(y_test, num_classes)
+            model.fit(X_train, y_train, validation_data=(X_test, y_test), epochs=epochs, batch_size=64, verbose=2, sample_weight=sample_weights)
 
         print(model.summary())
         model.save(model_filename)
@@ -62,6 +100,17 @@ def main():
     bcut = True
     variablescut = True
 
+    # Keep integer labels and train with a sparse loss instead of one-hot encoding y
+    sparse_labels = False
+
+    # Append the objects of a new version of the saved light curves to the arrays of the previous version instead of
+    # preparing all the arrays again
+    extend_arrays = False
+
+    # Stream the training set from disk in mini-batches, so that it doesn't need to fit in memory
+    stream_training_data = True
+    loader_workers = 4
+
     training_set_dir = 'training_set_files'
     if not os.path.exists(training_set_dir):
         os.makedirs(training_set_dir)
@@ -71,16 +120,37 @@ def main():
     savename = 'astrorapid'
     fpath = os.path.join(training_set_dir, 'saved_lc_{}_{}_{}.hdf5'.format(field, data_release, savename))
 
-    fig_dir = os.path.join(training_set_dir, 'Figures', 'classify', 'ZTF_{}_epochs{}_ag{}_ci{}_fp{}_zcut{}_bcut{}_varcut{}'.format(otherchange, train_epochs, aggregate_classes, contextual_info, os.path.basename(fpath), zcut, bcut, variablescut))
-    for dirname in [fig_dir, fig_dir+'/cf_since_trigger', fig_dir+'/cf_since_t0', fig_dir+'/roc_since_trigger', fig_dir+'/lc_pred', fig_dir+'/pr_since_trigger', fig_dir+'/truth_table_since_trigger']:
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
+    # Each stage saves its artifacts in the cache keyed by its parameters and upstream artifacts, so only the stages
+    # whose inputs changed are recomputed. reread_hdf5_data and retrain_rnn force the arrays and model stages.
+    cache = ArtifactCache(os.path.join(training_set_dir, 'cache'))
 
-    preparearrays = PrepareTrainingSetArrays(passbands, contextual_info, reread_hdf5_data, aggregate_classes, bcut, zcut, variablescut, nchunks=nchunks)
+    preparearrays = PrepareTrainingSetArrays(passbands, contextual_info, reread_hdf5_data, aggregate_classes, bcut, zcut, variablescut, nchunks=nchunks, sparse_labels=sparse_labels, cache=cache, extend=extend_arrays, stream=stream_training_data)
     X_train, X_test, y_train, y_test, labels_train, labels_test, class_names, class_weights, sample_weights, timesX_train, timesX_test, orig_lc_train, orig_lc_test, objids_train, objids_test = preparearrays.prepare_training_set_arrays(fpath, otherchange)
-    model = train_model(X_train, X_test, y_train, y_test, sample_weights=sample_weights, fig_dir=fig_dir, retrain=retrain_rnn, epochs=train_epochs)
-    plot_metrics(class_names, model, X_test, y_test, fig_dir, timesX_test=timesX_test, orig_lc_test=orig_lc_test, objids_test=objids_test, passbands=passbands)
 
+    model_params = {'epochs': train_epochs, 'sparse_labels': sparse_labels, 'stream': stream_training_data,
+                    'architecture': 'GRU100-GRU100-TimeDistributedDense'}
+    model_key = cache.get_key('model', model_params, [preparearrays.split_key])
+    model_dir = cache.get_dir('model', model_key)
+    retrain = retrain_rnn or not cache.is_complete('model', model_key)
+    model = train_model(X_train, X_test, y_train, y_test, sample_weights=sample_weights, fig_dir=model_dir, retrain=retrain, epochs=train_epochs, num_classes=len(class_names) + 1, stream=stream_training_data, workers=loader_workers, sparse_labels=sparse_labels, class_lut=preparearrays.class_lut)
+    if retrain:
+        cache.record('model', model_key, model_params, [preparearrays.split_key], files=['keras_model.hdf5'])
+
+    metrics_params = {'passbands': passbands}
+    metrics_key = cache.get_key('metrics', metrics_params, [model_key, preparearrays.split_key])
+    fig_dir = cache.get_dir('metrics', metrics_key)
+    if retrain or not cache.is_complete('metrics', metrics_key):
+        for dirname in [fig_dir, fig_dir+'/cf_since_trigger', fig_dir+'/cf_since_t0', fig_dir+'/roc_since_trigger', fig_dir+'/lc_pred', fig_dir+'/pr_since_trigger', fig_dir+'/truth_table_since_trigger']:
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+        if preparearrays.class_lut is not None:
+            # The metrics are computed in memory, so map the streamed labels of the test set here
+            y_test = preparearrays.class_lut[np.asarray(y_test)]
+            if not sparse_labels:
+                y_test = to_categorical(y_test, num_classes=len(class_names) + 1)
+        plot_metrics(class_names, model, X_test, y_test, fig_dir, timesX_test=timesX_test, orig_lc_test=orig_lc_test, objids_test=objids_test, passbands=passbands)
+        cache.record('metrics', metrics_key, metrics_params, [model_key, preparearrays.split_key])
+    print("Model in {}, metrics in {}".format(model_dir, fig_dir))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,116 @@
+"""
+Adaptive scheduling of chunks of objects on a multiprocessing pool
+
+Instead of splitting the objects into a fixed number of chunks up front, chunks are handed out one at a time while
+the pool is busy. The size of each chunk is chosen from the measured time per object so that a chunk takes about
+`target_chunk_time`, and chunks get smaller towards the end so that the last chunks finish at about the same time
+on every worker. Results are yielded as soon as their chunk finishes, with the throughput and an estimate of the
+remaining time printed every `report_interval` seconds.
+"""
+import time
+import queue
+
+from astrorapid.parallelism import get_parallelism
+
+
+def _timed_call(args):
+    """ Call func(chunk) in a worker and return its result with the time it took """
+    func, chunk = args
+    start = time.time()
+    result = func(chunk)
+    return result, time.time() - start
+
+
+class AdaptiveChunkScheduler(object):
+    def __init__(self, pool, nworkers=None, target_chunk_time=20., initial_chunk_size=8, min_chunk_size=1,
+                 max_chunk_size=10000, report_interval=10.):
+        """ Run a function on chunks of a sequence with a pool of workers.
+
+        Parameters
+        ----------
+        pool : multiprocessing.Pool
+            Pool of workers.
+        nworkers : int, optional
+            Number of processes in the pool. The default is nworkers of the thread budget (see
+            astrorapid/parallelism.py), which is the size of the pools made by make_pool.
+        target_chunk_time : float
+            Time in seconds that a chunk should take once the time per object has been measured.
+        initial_chunk_size : int
+            Size of the first chunk of each worker, used to measure the time per object.
+        min_chunk_size, max_chunk_size : int
+            Bounds of the chunk size.
+        report_interval : float
+            Seconds between progress reports.
+
+        """
+        self.pool = pool
+        self.nworkers = get_parallelism()['nworkers'] if nworkers is None else nworkers
+        self.target_chunk_time = target_chunk_time
+        self.initial_chunk_size = initial_chunk_size
+        self.min_chunk_size = max(1, min_chunk_size)
+        self.max_chunk_size = max(self.min_chunk_size, max_chunk_size)
+        self.report_interval = report_interval
+        self.nobjects_timed = 0
+        self.busy_time = 0.
+
+    def get_chunk_size(self, nremaining):
+        """ Returns the size of the next chunk """
+        if self.nobjects_timed == 0:
+            size = self.initial_chunk_size
+        else:
+            size = self.target_chunk_time / max(self.busy_time / self.nobjects_timed, 1e-6)
+        # Guided scheduling: never take more than a share of what is left, so the tail is spread over all workers
+        size = min(size, nremaining / (2. * self.nworkers))
+        size = int(min(max(size, self.min_chunk_size), self.max_chunk_size))
+        return min(size, nremaining)
+
+    def imap_unordered(self, func, items, name='objects'):
+        """ Yield func((offset, items[offset:offset + n])) of consecutive chunks of items in the order they finish.
+
+        Parameters
+        ----------
+        func : callable
+            Picklable function of a chunk (offset, items) run in the workers.
+        items : array
+            Sequence to split into chunks.
+        name : str
+            Name of the items in the progress reports.
+
+        """
+        nitems = len(items)
+        results = queue.Queue()
+        start_time = last_report = time.time()
+        offset = 0
+        nin_flight = 0
+        ndone = 0
+
+        while offset < nitems or nin_flight > 0:
+            # Keep two chunks per worker queued, so a worker never waits for the parent to hand it the next chunk
+            while offset < nitems and nin_flight < 2 * self.nworkers:
+                size = self.get_chunk_size(nitems - offset)
+                chunk = (offset, items[offset:offset + size])
+                self.pool.apply_async(_timed_call, ((func, chunk),),
+                                      callback=lambda result, size=size: results.put((size, result, None)),
+                                      error_callback=lambda e: results.put((0, None, e)))
+                offset += size
+                nin_flight += 1
+
+            size, output, error = results.get()
+            nin_flight -= 1
+            if error is not None:
+                raise error
+            result, elapsed = output
+            self.nobjects_timed += size
+            self.busy_time += elapsed
+            ndone += size
+
+            now = time.time()
+            if now - last_report > self.report_interval or ndone == nitems:
+                rate = ndone / (now - start_time) if now > start_time else 0.
+                eta = (nitems - ndone) / rate if rate > 0 else float('nan')
+                print("{} of {} {} done, {:.1f} {}/s, {:.1f}ms per object per worker, next chunk size {}, "
+                      "ETA {:.0f}s".format(ndone, nitems, name, rate, name, 1e3 * self.busy_time / self.nobjects_timed,
+                                           self.get_chunk_size(max(nitems - offset, 1)), eta))
+                last_report = now
+
+            yield result
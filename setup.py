@@ -82,6 +82,7 @@ setup(name='astrorapid',
     entry_points={
         'console_scripts': [
             'sample=astrorapid:main',
+            'astrorapid=astrorapid.cli:main',
         ],
     },
 )
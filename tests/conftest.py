@@ -0,0 +1,196 @@
+"""
+Synthetic PLAsTiCC-like data release used by the tests of the ingestion code
+
+Each model directory has one HEAD.FITS and one PHOT.FITS file in the layout of the ZTF MSIP releases, and the header
+index is a local SQLite index (see astrorapid/read_from_database/local_index.py), so no MySQL server is needed.
+"""
+import os
+import glob
+import tempfile
+import numpy as np
+import pytest
+import astropy.io.fits as afits
+
+# get_data.py reads PLASTICC_DIR when it is imported
+os.environ.setdefault('PLASTICC_DIR', tempfile.gettempdir())
+
+RELEASE = 'TEST'
+MODELS = (1, 2, 80)
+BASE = 'NONIa-0001'
+NOBJECTS_PER_MODEL = 12
+
+
+def make_light_curve(rng, peak_mjd, nobs=40):
+    """ Returns the MJD, FLT, FLUXCAL, FLUXCALERR and PHOTFLAG columns of a transient in g and r """
+    mjd = np.sort(peak_mjd - 60 + 120 * rng.random(nobs))
+    flt = np.array(['g', 'r'] * (nobs // 2))
+    flux = 1000. * np.exp(-0.5 * ((mjd - peak_mjd) / 12.) ** 2) + rng.normal(0, 20, nobs)
+    fluxerr = np.full(nobs, 20.)
+    photflag = np.where(flux > 100, 4096, 0)
+    photflag[np.argmax(photflag)] = 6144
+    return mjd, flt, flux, fluxerr, photflag
+
+
+def make_release(data_dir, release=RELEASE, models=MODELS, nobjects=NOBJECTS_PER_MODEL, seed=0):
+    """ Writes the HEAD.FITS and PHOT.FITS files of a synthetic release. Returns the list of HEAD.FITS files. """
+    rng = np.random.RandomState(seed)
+    head_files = []
+    for model in models:
+        model_dir = os.path.join(data_dir, release, 'ZTF_MSIP_MODEL{:02d}'.format(model))
+        os.makedirs(model_dir)
+
+        phot_columns = [[] for i in range(5)]
+        head = {name: [] for name in ('SNID', 'PTROBS_MIN', 'PTROBS_MAX', 'SNTYPE', 'SIM_PEAKMAG_r',
+                                      'SIM_REDSHIFT_HOST', 'MWEBV', 'SIM_DLMU', 'PEAKMJD', 'RA', 'DECL',
+                                      'HOSTGAL_PHOTOZ', 'HOSTGAL_PHOTOZ_ERR')}
+        nrows = 0
+        for i in range(nobjects):
+            peak_mjd = 58300. + 100 * rng.random()
+            light_curve = make_light_curve(rng, peak_mjd)
+            for column, values in zip(phot_columns, light_curve):
+                column.extend(values)
+            redshift = 0. if i == 0 else 0.05 + 0.5 * rng.random()
+            head['SNID'].append(str(1000 * model + i))
+            head['PTROBS_MIN'].append(nrows + 1)
+            head['PTROBS_MAX'].append(nrows + len(light_curve[0]))
+            head['SNTYPE'].append(model)
+            head['SIM_PEAKMAG_r'].append(19. + rng.random())
+            head['SIM_REDSHIFT_HOST'].append(redshift)
+            head['MWEBV'].append(0.05 * rng.random())
+            head['SIM_DLMU'].append(40.)
+            head['PEAKMJD'].append(peak_mjd)
+            head['RA'].append(360 * rng.random())
+            head['DECL'].append(np.degrees(np.arcsin(2 * rng.random() - 1)))
+            head['HOSTGAL_PHOTOZ'].append(redshift)
+            head['HOSTGAL_PHOTOZ_ERR'].append(0.01)
+            nrows += len(light_curve[0])
+
+            # The PHOT.FITS files separate the objects with a dummy row
+            for column, value in zip(phot_columns, (-777., '-', 0., 0., 0)):
+                column.append(value)
+            nrows += 1
+
+        formats = {'SNID': '16A', 'PTROBS_MIN': 'J', 'PTROBS_MAX': 'J', 'SNTYPE': 'J', 'RA': 'D', 'DECL': 'D'}
+        head_hdu = afits.BinTableHDU.from_columns(
+            [afits.Column(name=name, format=formats.get(name, 'E'), array=np.array(values))
+             for name, values in head.items()])
+        phot_hdu = afits.BinTableHDU.from_columns([
+            afits.Column(name='MJD', format='D', array=np.array(phot_columns[0])),
+            afits.Column(name='FLT', format='2A', array=np.array(phot_columns[1])),
+            afits.Column(name='FLUXCAL', format='E', array=np.array(phot_columns[2])),
+            afits.Column(name='FLUXCALERR', format='E', array=np.array(phot_columns[3])),
+            afits.Column(name='ZEROPT', format='E', array=np.full(nrows, 27.5)),
+            afits.Column(name='PHOTFLAG', format='J', array=np.array(phot_columns[4]))])
+
+        prefix = os.path.join(model_dir, 'ZTF_MSIP_{}'.format(BASE))
+        head_hdu.writeto(prefix + '_HEAD.FITS')
+        phot_hdu.writeto(prefix + '_PHOT.FITS')
+        head_files.append(prefix + '_HEAD.FITS')
+    return head_files
+
+
+def make_indexed_release(tmp_path, monkeypatch, release=RELEASE):
+    from astrorapid.read_from_database import get_data, local_index, database
+
+    data_dir = str(tmp_path / 'plasticc_data')
+    head_files = make_release(data_dir, release=release)
+    index_path = str(tmp_path / 'index.sqlite')
+    local_index.build_local_index(head_files, index_path, database.get_index_table_name_for_release(release))
+    monkeypatch.setattr(get_data, 'DATA_DIR', data_dir)
+
+    return {'data_release': release, 'index_path': index_path, 'data_dir': data_dir,
+            'phot_files': sorted(glob.glob(os.path.join(data_dir, release, '*', '*_PHOT.FITS')))}
+
+
+@pytest.fixture
+def release(tmp_path, monkeypatch):
+    """ A synthetic release with a local header index. Returns a dict with the data_release name, the index_path,
+    the data_dir and the PHOT.FITS files. """
+    return make_indexed_release(tmp_path, monkeypatch)
+
+
+@pytest.fixture
+def default_release(tmp_path, monkeypatch):
+    """ The synthetic release under the name of the data release read by
+    read_light_curves_from_database.main(). Returns the same dict as release. """
+    return make_indexed_release(tmp_path, monkeypatch, release='ZTF_20180716')
+
+
+def make_saved_light_curves(fname, consolidated=True, models=MODELS, nobjects=NOBJECTS_PER_MODEL, seed=0):
+    """ Writes preprocessed light curves, in the format of InputLightCurve.preprocess_light_curve, to a light curve
+    store or to a pandas HDFStore (without the slow preprocessing of the ingestion). Returns the DataFrames by objid.
+    """
+    from astrorapid.light_curve_store import LightCurveStoreWriter, arrays_to_light_curve
+
+    rng = np.random.RandomState(seed)
+    light_curves = {}
+    for model in models:
+        for i in range(nobjects):
+            objid = 'MSIP_{:02d}_{}_{}'.format(model, BASE, 1000 * model + i)
+            nobs = rng.randint(8, 40)
+            passband = np.sort(rng.randint(0, 2, nobs)).astype(np.uint8)
+            time = np.concatenate([np.sort(rng.uniform(-60, 80, np.sum(passband == pbidx))) for pbidx in (0, 1)])
+            flux = np.clip(np.exp(-0.5 * (time / 20.) ** 2) + rng.normal(0, 0.02, nobs), 0, None)
+            arrays = {'time': time, 'flux': flux, 'fluxErr': np.full(nobs, 0.02),
+                      'photflag': np.where(time >= 0, 4096, 0).astype(np.int32), 'passband': passband}
+            redshift = 0. if i == 0 else 0.05 + 0.5 * rng.random()
+            otherinfo = [redshift, rng.uniform(-90, 90), 0.05 * rng.random(), 58300. + 100 * rng.random(), -5., 10.]
+            light_curves[objid] = arrays_to_light_curve(arrays, np.array(otherinfo), ('g', 'r'))
+
+    if consolidated:
+        with LightCurveStoreWriter(fname, passbands=('g', 'r')) as writer:
+            for objid, data in light_curves.items():
+                writer.append(objid, data)
+    else:
+        import pandas as pd
+        with pd.HDFStore(fname) as store:
+            for objid, data in light_curves.items():
+                store.append(objid, data)
+    return light_curves
+
+
+@pytest.fixture
+def saved_light_curves(tmp_path):
+    """ A light curve store of preprocessed light curves. Returns its path. """
+    fname = str(tmp_path / 'saved_lc.hdf5')
+    make_saved_light_curves(fname)
+    return fname
+
+
+@pytest.fixture
+def saved_light_curves_pandas(tmp_path):
+    """ The same light curves as saved_light_curves in a pandas HDFStore. Returns its path. """
+    fname = str(tmp_path / 'saved_lc_pandas.hdf5')
+    make_saved_light_curves(fname, consolidated=False)
+    return fname
+
+
+@pytest.fixture
+def growing_light_curves(tmp_path):
+    """ A light curve store with the first 8 objects of each model and a function that appends the other objects, as
+    in a new version of the saved light curves. Returns (path, append). """
+    from astrorapid.light_curve_store import LightCurveStoreWriter
+
+    fname = str(tmp_path / 'saved_lc.hdf5')
+    light_curves = make_saved_light_curves(str(tmp_path / 'all_saved_lc.hdf5'))
+    first = {objid: data for objid, data in light_curves.items() if int(objid.split('_')[-1]) % 1000 < 8}
+
+    def write(objects, mode):
+        with LightCurveStoreWriter(fname, passbands=('g', 'r'), mode=mode) as writer:
+            for objid, data in objects.items():
+                writer.append(objid, data)
+
+    write(first, 'w')
+    return fname, lambda: write({objid: data for objid, data in light_curves.items() if objid not in first}, 'a')
+
+
+@pytest.fixture(scope='session')
+def tiny_model():
+    """ A small untrained model with the input and output shapes of the classifier with redshift, since the shipped
+    models can only be loaded by the Keras versions they were saved with """
+    keras = pytest.importorskip('keras')
+    from astrorapid.classify import CLASS_NAMES
+
+    model = keras.Sequential([keras.Input((50, 3)), keras.layers.GRU(8, return_sequences=True),
+                              keras.layers.TimeDistributed(keras.layers.Dense(len(CLASS_NAMES), activation='softmax'))])
+    return model
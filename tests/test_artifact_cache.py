@@ -0,0 +1,109 @@
+import os
+import pytest
+
+from astrorapid import artifact_cache
+from astrorapid.artifact_cache import ArtifactCache, hash_params
+
+
+@pytest.fixture
+def input_file(tmp_path):
+    fpath = str(tmp_path / 'saved_lc.hdf5')
+    with open(fpath, 'wb') as f:
+        f.write(b'light curves v1')
+    return fpath
+
+
+def write_artifact(cache, stage, key, params, upstream=(), fnames=('X.npy',)):
+    artifact_dir = cache.get_dir(stage, key)
+    for fname in fnames:
+        with open(os.path.join(artifact_dir, fname), 'w') as f:
+            f.write(key)
+    cache.record(stage, key, params, upstream)
+
+
+def test_keys(tmp_path):
+    cache = ArtifactCache(str(tmp_path / 'cache'))
+    key = cache.get_key('arrays', {'zcut': 0.5, 'bcut': True}, ['abc'])
+    assert key == cache.get_key('arrays', {'bcut': True, 'zcut': 0.5}, ('abc',))
+    assert key == hash_params('arrays', {'zcut': 0.5, 'bcut': True}, ['abc'])
+    assert len(key) == 16
+    assert len({key, cache.get_key('split', {'zcut': 0.5, 'bcut': True}, ['abc']),
+                cache.get_key('arrays', {'zcut': 0.4, 'bcut': True}, ['abc']),
+                cache.get_key('arrays', {'zcut': 0.5, 'bcut': True}, ['abd']),
+                cache.get_key('arrays', {'zcut': 0.5, 'bcut': True})}) == 5
+
+
+def test_file_hash_is_remembered(tmp_path, input_file, capsys):
+    cache = ArtifactCache(str(tmp_path / 'cache'))
+    digest = cache.file_hash(input_file)
+    assert cache.file_hash(input_file) == digest
+    assert ArtifactCache(str(tmp_path / 'cache')).file_hash(input_file) == digest
+    assert capsys.readouterr().out.count('Hashing') == 1
+
+    with open(input_file, 'wb') as f:
+        f.write(b'light curves v2 with more objects')
+    assert cache.file_hash(input_file) != digest
+
+
+def test_is_complete(tmp_path):
+    cache = ArtifactCache(str(tmp_path / 'cache'))
+    key = cache.get_key('arrays', {})
+    assert not cache.is_complete('arrays', key)
+    write_artifact(cache, 'arrays', key, {}, fnames=('X.npy', 'y.npy'))
+    assert cache.is_complete('arrays', key)
+    # The manifest is saved
+    assert ArtifactCache(str(tmp_path / 'cache')).is_complete('arrays', key)
+
+    os.remove(os.path.join(cache.get_dir('arrays', key), 'y.npy'))
+    assert not cache.is_complete('arrays', key)
+
+
+def test_changes_invalidate_downstream_artifacts(tmp_path, input_file):
+    cache = ArtifactCache(str(tmp_path / 'cache'))
+
+    def get_keys(array_params, split_params, model_params):
+        arrays_key = cache.get_key('arrays', array_params, [cache.file_hash(input_file)])
+        split_key = cache.get_key('split', split_params, [arrays_key])
+        model_key = cache.get_key('model', model_params, [split_key])
+        return arrays_key, split_key, model_key
+
+    params = ({'zcut': 0.5}, {'train_size': 0.6}, {'epochs': 25})
+    keys = get_keys(*params)
+    for stage, key, stage_params, upstream in zip(('arrays', 'split', 'model'), keys, params,
+                                                  ([cache.file_hash(input_file)], keys[:1], keys[1:2])):
+        write_artifact(cache, stage, key, stage_params, upstream)
+
+    assert get_keys(*params) == keys
+    assert all(cache.is_complete(stage, key) for stage, key in zip(('arrays', 'split', 'model'), keys))
+
+    # A stage is redone with everything downstream of it, but not upstream
+    new_keys = get_keys({'zcut': 0.5}, {'train_size': 0.7}, {'epochs': 25})
+    assert new_keys[0] == keys[0] and new_keys[1] != keys[1] and new_keys[2] != keys[2]
+    assert not cache.is_complete('split', new_keys[1]) and not cache.is_complete('model', new_keys[2])
+
+    new_keys = get_keys(*params[:2], {'epochs': 50})
+    assert new_keys[:2] == keys[:2] and new_keys[2] != keys[2]
+
+    # A new version of the input file changes every key
+    with open(input_file, 'wb') as f:
+        f.write(b'light curves v2 with more objects')
+    new_keys = get_keys(*params)
+    assert all(new_key != key for new_key, key in zip(new_keys, keys))
+
+
+def test_find_latest(tmp_path, monkeypatch):
+    cache = ArtifactCache(str(tmp_path / 'cache'))
+    times = iter(['2024-01-01 00:00:0{}'.format(i) for i in range(10)])
+    monkeypatch.setattr(artifact_cache.time, 'strftime', lambda fmt: next(times))
+
+    assert cache.find_latest('arrays', {'zcut': 0.5}) is None
+    for upstream in ('v1', 'v2'):
+        write_artifact(cache, 'arrays', cache.get_key('arrays', {'zcut': 0.5}, [upstream]), {'zcut': 0.5}, [upstream])
+    write_artifact(cache, 'arrays', cache.get_key('arrays', {'zcut': 0.4}, ['v3']), {'zcut': 0.4}, ['v3'])
+    key_v2 = cache.get_key('arrays', {'zcut': 0.5}, ['v2'])
+    assert cache.find_latest('arrays', {'zcut': 0.5}) == key_v2
+
+    # Incomplete artifacts are skipped
+    os.remove(os.path.join(cache.get_dir('arrays', key_v2), 'X.npy'))
+    assert cache.find_latest('arrays', {'zcut': 0.5}) == cache.get_key('arrays', {'zcut': 0.5}, ['v1'])
+    assert cache.find_latest('split', {'zcut': 0.5}) is None
@@ -0,0 +1,65 @@
+import pytest
+
+from astrorapid.read_from_database import database
+
+
+class FakeCursor(object):
+    def __init__(self, rows, fail_after=None):
+        self.rows = rows
+        self.fail_after = fail_after
+        self.fetch_sizes = []
+        self.position = 0
+        self.closed = False
+
+    def execute(self, query):
+        pass
+
+    def fetchmany(self, size):
+        if self.fail_after is not None and self.position >= self.fail_after:
+            raise IOError("connection lost")
+        self.fetch_sizes.append(size)
+        rows = self.rows[self.position:self.position + size]
+        self.position += len(rows)
+        return rows
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnection(object):
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.closed = False
+
+    def cursor(self, cursor_class=None):
+        return self._cursor
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def connection(monkeypatch):
+    connection = FakeConnection(FakeCursor([(i,) for i in range(25)]))
+    monkeypatch.setattr(database, 'get_mysql_connection', lambda: connection)
+    return connection
+
+
+def test_big_query_is_fetched_in_batches(connection):
+    assert list(database.exec_big_sql_query("SELECT", fetch_size=10)) == [(i,) for i in range(25)]
+    assert connection._cursor.fetch_sizes == [10, 10, 10, 10]
+    assert connection._cursor.closed and connection.closed
+
+
+def test_big_query_is_closed_when_stopped_early(connection):
+    rows = database.exec_big_sql_query("SELECT", fetch_size=10)
+    assert next(rows) == (0,)
+    rows.close()
+    assert connection._cursor.closed and connection.closed
+
+
+def test_big_query_is_closed_after_an_error(connection):
+    connection._cursor.fail_after = 10
+    with pytest.raises(RuntimeError, match="connection lost"):
+        list(database.exec_big_sql_query("SELECT", fetch_size=10))
+    assert connection._cursor.closed and connection.closed
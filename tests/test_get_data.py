@@ -0,0 +1,129 @@
+import numpy as np
+import pytest
+
+from astrorapid.read_from_database.get_data import GetData
+
+
+def get_sorted_objids(getter, **kwargs):
+    return [h[0] for h in getter.get_lcs_headers(columns=['objid'], sort=True, **kwargs)]
+
+
+@pytest.mark.parametrize('batch_size', [1, 5, 12, 36, 100])
+def test_key_ranges_partition_the_index(release, batch_size):
+    getter = GetData(release['data_release'], index_path=release['index_path'])
+    objids = get_sorted_objids(getter)
+    key_ranges = getter.get_objid_key_ranges(batch_size)
+
+    assert key_ranges[0][0] is None
+    assert key_ranges[-1][1] is None
+    for (after_objid, upto_objid), (next_after_objid, next_upto_objid) in zip(key_ranges[:-1], key_ranges[1:]):
+        assert upto_objid == next_after_objid
+
+    batches = [get_sorted_objids(getter, after_objid=after_objid, upto_objid=upto_objid)
+               for after_objid, upto_objid in key_ranges]
+    assert sum(batches, []) == objids
+    assert all(len(batch) == batch_size for batch in batches[:-1])
+    assert 0 < len(batches[-1]) <= batch_size
+
+
+def test_key_ranges_with_selection(release):
+    getter = GetData(release['data_release'], index_path=release['index_path'])
+    objids = get_sorted_objids(getter, model='2')
+    key_ranges = getter.get_objid_key_ranges(5, model='2')
+
+    assert len(key_ranges) == 3
+    batches = [get_sorted_objids(getter, model='2', after_objid=after_objid, upto_objid=upto_objid)
+               for after_objid, upto_objid in key_ranges]
+    assert sum(batches, []) == objids
+    assert all(objid.startswith('MSIP_02_') for objid in objids)
+
+
+def test_key_ranges_of_exact_multiple(release):
+    getter = GetData(release['data_release'], index_path=release['index_path'])
+    nobjects = len(get_sorted_objids(getter))
+    key_ranges = getter.get_objid_key_ranges(nobjects // 3)
+
+    # No empty range is added after the last objid, but the last range is still unbounded
+    assert len(key_ranges) == 3
+    assert key_ranges[-1] == (get_sorted_objids(getter)[2 * nobjects // 3 - 1], None)
+
+
+def get_selected_objids(getter, **cuts):
+    extrasql = GetData.get_cuts_sql(**cuts)
+    return {h[0] for h in getter.get_lcs_headers(columns=['objid'], extrasql=extrasql)}
+
+
+def test_cuts_sql(release):
+    from astropy import units as u
+    from astropy.coordinates import SkyCoord
+    from astrorapid import helpers
+
+    getter = GetData(release['data_release'], index_path=release['index_path'])
+    headers = list(getter.get_lcs_headers(columns=['objid', 'sim_redshift_host', 'ra', 'decl']))
+    objids = np.array([h[0] for h in headers])
+    redshift = np.array([h[1] for h in headers])
+    b = SkyCoord(ra=[h[2] for h in headers] * u.degree, dec=[h[3] for h in headers] * u.degree, frame='icrs').galactic.b
+    model = np.array([int(objid.split('_')[1]) for objid in objids])
+
+    assert get_selected_objids(getter) == set(objids)
+    assert get_selected_objids(getter, zcut=0.3) == set(objids[(redshift <= 0.3) & (redshift != 0)])
+    assert get_selected_objids(getter, bcut=True) == set(objids[np.abs(b.degree) >= 15])
+    assert get_selected_objids(getter, variablescut=True) == \
+        set(objids[~np.isin(model, helpers.get_variable_sntypes())])
+    assert get_selected_objids(getter, zcut=0.3, bcut=True, variablescut=True) == \
+        set(objids[(redshift <= 0.3) & (redshift != 0) & (np.abs(b.degree) >= 15)
+                   & ~np.isin(model, helpers.get_variable_sntypes())])
+
+
+def test_cuts_sql_is_empty_without_cuts():
+    assert GetData.get_cuts_sql() == ''
+
+
+def test_light_curve_table_and_arrays(release):
+    import astropy.table as at
+
+    getter = GetData(release['data_release'], index_path=release['index_path'])
+    objid, ptrobs_min, ptrobs_max = next(getter.get_lcs_headers(columns=['objid', 'ptrobs_min', 'ptrobs_max']))
+
+    table = getter.get_light_curve_array(objid, ptrobs_min, ptrobs_max)
+    assert isinstance(table, at.Table)
+    assert len(table) == ptrobs_max - ptrobs_min + 1
+
+    lc = getter.get_light_curve_arrays(objid, ptrobs_min, ptrobs_max, passbands=('g', 'r'))
+    np.testing.assert_array_equal(lc['mjd'], table['MJD'])
+    np.testing.assert_array_equal(lc['flux'], table['FLUXCAL'])
+    np.testing.assert_array_equal(lc['pb'], np.char.strip(np.asarray(table['FLT']).astype(str)))
+    assert lc['mjd'].dtype == np.float64 and lc['photflag'].dtype == np.int64
+
+
+def test_local_index_queries_are_quiet(release, capsys):
+    from astrorapid.read_from_database import local_index
+
+    query = "SELECT COUNT(objid) FROM release_{};".format(release['data_release'])
+    assert local_index.exec_sql_query(query, release['index_path']) == [(36,)]
+    assert capsys.readouterr().out == ''
+    local_index.exec_sql_query(query, release['index_path'], verbose=True)
+    assert capsys.readouterr().out == query + '\n'
+
+
+@pytest.mark.parametrize('nthreads', [1, 2])
+def test_bulk_photometry_reads_the_headers_as_it_goes(release, nthreads):
+    getter = GetData(release['data_release'], index_path=release['index_path'])
+    headers = list(getter.get_lcs_headers(columns=['objid', 'ptrobs_min', 'ptrobs_max'], sort=True))
+    nread = []
+
+    def iter_headers():
+        for i, h in enumerate(headers):
+            nread.append(i)
+            yield h
+
+    results = getter.read_photometry_bulk(iter_headers(), nthreads=nthreads)
+    next(results)
+    # The first file is read before the headers of the last file
+    assert len(nread) < len(headers) - 1
+
+    results = list(getter.read_photometry_bulk(headers, nthreads=nthreads))
+    assert sorted(h[0] for h, phot in results) == sorted(h[0] for h in headers)
+    for h, phot in results:
+        table = getter.get_light_curve_array(*h[:3])
+        np.testing.assert_array_equal(phot['MJD'], table['MJD'])
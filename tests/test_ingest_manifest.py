@@ -0,0 +1,98 @@
+import os
+import numpy as np
+import pytest
+
+from astrorapid.read_from_database.ingest_manifest import IngestManifest, subtract_ranges
+
+
+@pytest.mark.parametrize('key_range, done_ranges, expected', [
+    ((0, 100), [], [(0, 100)]),
+    ((0, 100), [(20, 40)], [(0, 20), (40, 100)]),
+    ((0, 100), [(0, 100)], []),
+    ((0, 100), [(50, 150)], [(0, 50)]),
+    ((0, 10), [(20, 30)], [(0, 10)]),
+    ((0, 100), [(10, 20), (30, 40)], [(0, 10), (20, 30), (40, 100)]),
+    ((None, None), [], [(None, None)]),
+    ((None, None), [(None, 'b'), ('d', None)], [('b', 'd')]),
+    ((None, 'f'), [('b', 'd')], [(None, 'b'), ('d', 'f')]),
+    (('b', None), [(None, 'c')], [('c', None)]),
+])
+def test_subtract_ranges(key_range, done_ranges, expected):
+    assert subtract_ranges(key_range, done_ranges) == expected
+
+
+def covered(ranges, n=30):
+    """ The integers in [0, n] covered by (lower, upper] ranges """
+    keys = set()
+    for lower, upper in ranges:
+        keys |= set(range(lower + 1, upper + 1))
+    return keys
+
+
+def test_subtract_random_ranges():
+    rng = np.random.RandomState(0)
+    for i in range(200):
+        key_range = tuple(sorted(rng.choice(31, 2, replace=False)))
+        done_ranges = [tuple(sorted(rng.choice(31, 2, replace=False))) for j in range(rng.randint(4))]
+        remaining = subtract_ranges(key_range, done_ranges)
+        assert covered(remaining) == covered([key_range]) - covered(done_ranges)
+        # The pieces do not overlap
+        assert sum(upper - lower for lower, upper in remaining) == len(covered(remaining))
+
+
+def record_batch(manifest, key_range, nobjects):
+    fname = manifest.get_batch_fname(key_range)
+    with open(os.path.join(manifest.save_dir, fname), 'wb') as f:
+        f.write(os.urandom(100))
+    manifest.record(fname, key_range, nobjects)
+    return fname
+
+
+def test_verify_offset_batches(tmp_path):
+    manifest = IngestManifest(str(tmp_path), mode='offset', selection='TEST')
+    record_batch(manifest, (0, 10), 10)
+    fname = record_batch(manifest, (20, 30), 9)
+    manifest.record_rejects(fname, [('MSIP_01_NONIa-0001_1025', 'no detections')])
+    assert manifest.verify(nobjects_expected=30) == ['Range (10, 20] is missing',
+                                                     '19 objects in the batches and 1 rejected but 30 in the selection']
+    assert manifest.get_remaining([(0, 10), (10, 20), (20, 30)]) == [(10, 20)]
+
+    record_batch(manifest, (10, 20), 10)
+    assert manifest.verify(nobjects_expected=30) == []
+    assert manifest.get_remaining([(0, 15), (15, 30)]) == []
+
+
+def test_verify_finds_changed_and_missing_files(tmp_path):
+    manifest = IngestManifest(str(tmp_path), mode='offset', selection='TEST')
+    changed = record_batch(manifest, (0, 10), 10)
+    missing = record_batch(manifest, (10, 20), 10)
+    with open(os.path.join(str(tmp_path), changed), 'ab') as f:
+        f.write(b'\0')
+    os.remove(os.path.join(str(tmp_path), missing))
+
+    assert manifest.verify() == ['{} does not match its checksum'.format(changed), '{} is missing'.format(missing)]
+    # Only the batch whose file is missing is redone
+    assert manifest.get_remaining([(0, 20)]) == [(10, 20)]
+
+
+def test_verify_keyset_batches(tmp_path):
+    manifest = IngestManifest(str(tmp_path), mode='keyset', selection='TEST')
+    record_batch(manifest, (None, 'MSIP_01_NONIa-0001_1005'), 6)
+    assert manifest.verify() == ['Range (MSIP_01_NONIa-0001_1005, None] is missing']
+    assert manifest.get_remaining([(None, None)]) == [('MSIP_01_NONIa-0001_1005', None)]
+
+    record_batch(manifest, ('MSIP_01_NONIa-0001_1005', None), 30)
+    assert manifest.verify(nobjects_expected=36) == []
+
+    # The manifest is resumed from its file
+    manifest = IngestManifest(str(tmp_path), mode='keyset', selection='TEST')
+    assert [key_range for fname, key_range, nobjects, size, checksum in sorted(manifest.get_completed())] == \
+        [('MSIP_01_NONIa-0001_1005', None), (None, 'MSIP_01_NONIa-0001_1005')]
+
+
+def test_manifest_of_other_selection_cannot_be_resumed(tmp_path):
+    IngestManifest(str(tmp_path), mode='offset', selection='TEST')
+    with pytest.raises(RuntimeError):
+        IngestManifest(str(tmp_path), mode='offset', selection='TEST zcut=0.5')
+    with pytest.raises(RuntimeError):
+        IngestManifest(str(tmp_path), mode='keyset', selection='TEST')
@@ -0,0 +1,100 @@
+import threading
+import numpy as np
+import pytest
+
+from astrorapid.parallelism import make_pool
+from astrorapid.process_light_curves import InputLightCurve
+from astrorapid.light_curve_store import LightCurveStoreWriter, LightCurveStoreReader, arrays_to_light_curve
+from astrorapid.read_from_database.get_data import GetData
+from astrorapid.read_from_database.ingest_pipeline import read_light_curves_pipelined
+
+PASSBANDS = ('g', 'r')
+
+
+def fast_preprocess(self):
+    """ Stands in for InputLightCurve.preprocess_light_curve, whose fit of t0 takes seconds per object """
+    passband = np.array([PASSBANDS.index(pb) for pb in self.passband], dtype=np.uint8)
+    order = np.argsort(passband, kind='stable')
+    arrays = {'time': self.t[order], 'flux': self.flux[order], 'fluxErr': self.fluxerr[order],
+              'photflag': self.photflag[order].astype(np.int32), 'passband': passband[order]}
+    otherinfo = np.array([self.redshift, self.b, self.mwebv, self.trigger_mjd, 0., self.peakmjd])
+    return arrays_to_light_curve(arrays, otherinfo, PASSBANDS)
+
+
+@pytest.fixture
+def fast_preprocessing(monkeypatch):
+    # The pool processes are forked after this, so they preprocess with it too
+    monkeypatch.setattr(InputLightCurve, 'preprocess_light_curve', fast_preprocess)
+
+
+def run_with_timeout(func, timeout=60):
+    """ Run func in a thread. Returns whether it finished in time and the exception it raised, if any. """
+    errors = []
+
+    def target():
+        try:
+            func()
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    return not thread.is_alive(), errors
+
+
+def test_pipeline_writes_every_object(release, fast_preprocessing, tmp_path):
+    fname = str(tmp_path / 'batch.hdf5')
+    rejects = []
+    stats = read_light_curves_pipelined(release['data_release'], fname, batch_size=100, passbands=PASSBANDS,
+                                        index_path=release['index_path'], consolidated=True, npreprocess=2,
+                                        queue_size=4, header_chunk=3, rejects=rejects)
+
+    getter = GetData(release['data_release'], index_path=release['index_path'])
+    objids = [h[0] for h in getter.get_lcs_headers(columns=['objid'], sort=True)]
+    with LightCurveStoreReader(fname) as reader:
+        assert sorted(reader.objids) == objids
+    assert rejects == []
+    assert [stage.count for stage in stats] == [len(objids)] * 4
+    assert stats[2].nworkers == 2
+
+
+def fail_on_write(self, *args, **kwargs):
+    raise RuntimeError("disk full")
+
+
+@pytest.mark.parametrize('shared_pool', [False, True])
+def test_failed_write_stops_the_pipeline(release, fast_preprocessing, monkeypatch, tmp_path, shared_pool):
+    monkeypatch.setattr(LightCurveStoreWriter, 'append_arrays', fail_on_write)
+    pool = make_pool(2) if shared_pool else None
+
+    # A small queue_size fills the queues and the in-flight limit before the write fails
+    finished, errors = run_with_timeout(lambda: read_light_curves_pipelined(
+        release['data_release'], str(tmp_path / 'batch.hdf5'), passbands=PASSBANDS, index_path=release['index_path'],
+        consolidated=True, npreprocess=2, queue_size=2, header_chunk=1, pool=pool))
+
+    assert finished
+    assert len(errors) == 1 and str(errors[0]) == "disk full"
+    if shared_pool:
+        # The pool can still be used for the next batch
+        assert pool.map(abs, [-1, -2]) == [1, 2]
+        pool.close()
+        pool.join()
+
+
+def test_main_with_pipeline(default_release, fast_preprocessing, monkeypatch, tmp_path):
+    import sys
+    from astrorapid.read_from_database import read_light_curves_from_database
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'argv', ['read_light_curves_from_database', '--keyset', '--pipeline', '--consolidated',
+                                      '--nprocesses', '2', '--index_path', default_release['index_path'],
+                                      '--combinefiles'])
+    read_light_curves_from_database.main()
+
+    # --combinefiles only combines the batches if the manifest shows that they cover the whole selection
+    getter = GetData(default_release['data_release'], index_path=default_release['index_path'])
+    objids = [h[0] for h in getter.get_lcs_headers(columns=['objid'], sort=True)]
+    with LightCurveStoreReader(str(tmp_path / 'training_set_files' / 'saved_lc_MSIP_ZTF_20180716_.hdf5')) as reader:
+        assert sorted(reader.objids) == objids
@@ -0,0 +1,195 @@
+import os
+import pickle
+import h5py
+import numpy as np
+import pandas as pd
+import pytest
+
+from astrorapid.light_curve_store import LightCurveStoreWriter, LightCurveStoreReader, OBS_FIELDS, \
+    arrays_to_light_curve, light_curve_to_arrays, is_light_curve_store, combine_light_curve_stores, \
+    link_light_curve_stores, compact_light_curve_store, LightCurveList
+
+PASSBANDS = ('g', 'r')
+
+
+def make_objects(nobjects, seed=0, prefix='MSIP_01_NONIa-0001_'):
+    """ Returns a list of (objid, arrays, otherinfo) of random light curves """
+    rng = np.random.RandomState(seed)
+    objects = []
+    for i in range(nobjects):
+        nobs = rng.randint(0, 40)
+        arrays = {'time': np.sort(rng.uniform(-50, 100, nobs)), 'flux': rng.uniform(0, 1, nobs),
+                  'fluxErr': rng.uniform(0, 0.1, nobs), 'photflag': rng.choice([0, 4096, 6144], nobs).astype(np.int32),
+                  'passband': np.sort(rng.randint(0, len(PASSBANDS), nobs)).astype(np.uint8)}
+        otherinfo = rng.uniform(0, 1, rng.randint(4, 7))
+        objects.append(('{}{}'.format(prefix, i), arrays, otherinfo))
+    return objects
+
+
+def write_store(fname, objects, buffer_objects=7):
+    with LightCurveStoreWriter(fname, passbands=PASSBANDS, buffer_objects=buffer_objects) as writer:
+        for objid, arrays, otherinfo in objects:
+            writer.append_arrays(objid, arrays, otherinfo)
+
+
+def check_batch(batch, objects, rows):
+    assert len(batch['objid']) == len(rows)
+    for i, row in enumerate(rows):
+        objid, arrays, otherinfo = objects[row]
+        assert batch['objid'][i] == objid
+        for field in OBS_FIELDS + ('passband',):
+            np.testing.assert_array_equal(batch[field][batch['offsets'][i]:batch['offsets'][i + 1]], arrays[field])
+        assert batch['ninfo'][i] == len(otherinfo)
+        np.testing.assert_array_equal(batch['otherinfo'][i][:len(otherinfo)], otherinfo)
+
+
+@pytest.mark.parametrize('max_gap, max_row_gap', [(65536, 4096), (0, 0), (30, 3)])
+def test_read_batch(tmp_path, max_gap, max_row_gap):
+    fname = str(tmp_path / 'store.hdf5')
+    objects = make_objects(50)
+    write_store(fname, objects)
+    assert is_light_curve_store(fname)
+
+    rng = np.random.RandomState(1)
+    with LightCurveStoreReader(fname) as reader:
+        assert len(reader) == len(objects)
+        assert reader.passbands == PASSBANDS
+        for rows in (np.arange(len(objects)), rng.permutation(len(objects)), rng.randint(0, len(objects), 20),
+                     np.array([len(objects) - 1, 0]), np.zeros(0, dtype=int)):
+            check_batch(reader.read_batch(rows, max_gap=max_gap, max_row_gap=max_row_gap), objects, rows)
+
+        objids = [objects[row][0] for row in (3, 17, 3)]
+        np.testing.assert_array_equal(reader.get_rows(objids), [3, 17, 3])
+
+
+def test_light_curve_dataframe_roundtrip(tmp_path):
+    fname = str(tmp_path / 'store.hdf5')
+    objects = make_objects(10)
+    data = {objid: arrays_to_light_curve(arrays, otherinfo, PASSBANDS) for objid, arrays, otherinfo in objects}
+    with LightCurveStoreWriter(fname, passbands=PASSBANDS) as writer:
+        for objid, df in data.items():
+            writer.append(objid, df)
+
+    with LightCurveStoreReader(fname) as reader:
+        for objid, df in reader.iter_light_curves(list(data)[::-1]):
+            pd.testing.assert_frame_equal(df, data[objid])
+        pd.testing.assert_frame_equal(reader.get_light_curve(objects[4][0]), data[objects[4][0]])
+
+    arrays, otherinfo = light_curve_to_arrays(data[objects[4][0]], PASSBANDS)
+    np.testing.assert_array_equal(otherinfo, objects[4][2])
+    np.testing.assert_array_equal(arrays['time'], objects[4][1]['time'])
+
+
+def test_append_to_store(tmp_path):
+    fname = str(tmp_path / 'store.hdf5')
+    objects = make_objects(20)
+    write_store(fname, objects[:12])
+    with LightCurveStoreWriter(fname, mode='a') as writer:
+        for objid, arrays, otherinfo in objects[12:]:
+            writer.append_arrays(objid, arrays, otherinfo)
+
+    with LightCurveStoreReader(fname) as reader:
+        check_batch(reader.read_batch(np.arange(len(reader))), objects, np.arange(len(objects)))
+
+
+def write_batch_stores(tmp_path, objects, nfiles=3):
+    """ Write the objects to nfiles stores, like the batch files of an ingest. Returns their paths. """
+    fnames = []
+    for n, part in enumerate(np.array_split(np.arange(len(objects)), nfiles)):
+        fnames.append(str(tmp_path / 'batch_{}.hdf5'.format(n)))
+        write_store(fnames[-1], [objects[i] for i in part])
+    return fnames
+
+
+def check_store(fname, objects):
+    with LightCurveStoreReader(fname) as reader:
+        assert len(reader) == len(objects)
+        rows = np.random.RandomState(2).permutation(len(objects))
+        check_batch(reader.read_batch(rows), objects, rows)
+
+
+def test_combine_stores(tmp_path):
+    objects = make_objects(30)
+    fnames = write_batch_stores(tmp_path, objects)
+
+    assert combine_light_curve_stores(fnames + [str(tmp_path / 'missing.hdf5')], str(tmp_path / 'combined.hdf5')) \
+        == len(objects)
+    check_store(str(tmp_path / 'combined.hdf5'), objects)
+
+    # Append more objects to the combined store
+    more_objects = make_objects(5, seed=1, prefix='MSIP_02_NONIa-0001_')
+    write_store(str(tmp_path / 'more.hdf5'), more_objects)
+    assert combine_light_curve_stores([str(tmp_path / 'more.hdf5')], str(tmp_path / 'combined.hdf5'), mode='a') \
+        == len(objects) + len(more_objects)
+    check_store(str(tmp_path / 'combined.hdf5'), objects + more_objects)
+
+
+def test_combine_stores_with_other_passbands(tmp_path):
+    write_store(str(tmp_path / 'gr.hdf5'), make_objects(3))
+    with LightCurveStoreWriter(str(tmp_path / 'ri.hdf5'), passbands=('r', 'i')) as writer:
+        writer.append_arrays(*make_objects(1)[0])
+    with pytest.raises(ValueError):
+        combine_light_curve_stores([str(tmp_path / 'gr.hdf5'), str(tmp_path / 'ri.hdf5')],
+                                   str(tmp_path / 'combined.hdf5'))
+
+
+@pytest.mark.parametrize('nprocesses', [1, 2])
+def test_link_and_compact_stores(tmp_path, nprocesses):
+    objects = make_objects(30)
+    fnames = write_batch_stores(tmp_path, objects)
+    # An empty batch has no otherinfo dataset
+    write_store(str(tmp_path / 'empty.hdf5'), [])
+    fnames.insert(1, str(tmp_path / 'empty.hdf5'))
+
+    linked = str(tmp_path / 'linked.hdf5')
+    assert link_light_curve_stores(fnames, linked) == len(objects)
+    with h5py.File(linked, 'r') as hdffile:
+        assert hdffile['observations/time'].is_virtual
+        assert list(hdffile.attrs['sources'].astype(str)) == [os.path.abspath(fname) for fname in fnames]
+    check_store(linked, objects)
+
+    compacted = str(tmp_path / 'compacted.hdf5')
+    assert compact_light_curve_store(linked, compacted, nprocesses=nprocesses) == len(objects)
+    for fname in fnames:
+        os.remove(fname)
+    with h5py.File(compacted, 'r') as hdffile:
+        assert not hdffile['observations/time'].is_virtual
+    check_store(compacted, objects)
+
+
+def test_light_curve_list(tmp_path):
+    fname = str(tmp_path / 'store.hdf5')
+    objects = make_objects(30)
+    write_store(fname, objects)
+    data = [arrays_to_light_curve(arrays, otherinfo, PASSBANDS) for objid, arrays, otherinfo in objects]
+
+    lcs = LightCurveList(fname)
+    assert len(lcs) == len(objects)
+    for df, expected in zip(lcs, data):
+        pd.testing.assert_frame_equal(df, expected)
+    pd.testing.assert_frame_equal(lcs[4], data[4])
+    pd.testing.assert_frame_equal(lcs[np.int64(-1)], data[-1])
+    with pytest.raises(IndexError):
+        lcs[len(objects)]
+
+    # Slicing and fancy indexing give views of the same store without reading it
+    rows = np.array([17, 3, 25, 3])
+    for view, expected_rows in ((lcs[5:20:3], np.arange(5, 20, 3)), (lcs[rows], rows),
+                                (lcs[rows][1:], rows[1:]), (lcs[np.arange(len(objects)) % 7 == 0], np.arange(0, 30, 7)),
+                                (lcs[[]], np.zeros(0, dtype=int))):
+        np.testing.assert_array_equal(view.rows, expected_rows)
+        assert view._reader is None
+        assert len(list(view)) == len(expected_rows)
+        for df, row in zip(view, expected_rows):
+            pd.testing.assert_frame_equal(df, data[row])
+
+    # A list with an open reader can be pickled, e.g. to send it to a worker process
+    view = LightCurveList(fname, rows)
+    view[0]
+    copy = pickle.loads(pickle.dumps(view))
+    assert copy._reader is None
+    np.testing.assert_array_equal(copy.rows, rows)
+    pd.testing.assert_frame_equal(copy[2], data[25])
+    for lc_list in (lcs, view, copy):
+        lc_list.close()
+        assert lc_list._reader is None
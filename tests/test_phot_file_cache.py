@@ -0,0 +1,169 @@
+import gzip
+import shutil
+import os
+import threading
+import numpy as np
+import pytest
+import astropy.io.fits as afits
+
+from astrorapid.read_from_database import get_data
+from astrorapid.read_from_database.get_data import PhotFileCache
+
+
+def is_closed(phot_HDU):
+    return phot_HDU._file is None or phot_HDU._file.closed
+
+
+def test_least_recently_used_file_is_closed(release):
+    phot_files = release['phot_files']
+    cache = PhotFileCache(maxsize=2)
+    hdus = {}
+    for phot_file in phot_files[:2]:
+        with cache.open(phot_file) as phot_HDU:
+            hdus[phot_file] = phot_HDU
+    # Use the first file again so that the second one is the least recently used
+    with cache.open(phot_files[0]) as phot_HDU:
+        assert phot_HDU is hdus[phot_files[0]]
+    with cache.open(phot_files[2]) as phot_HDU:
+        hdus[phot_files[2]] = phot_HDU
+
+    assert list(cache._entries) == [phot_files[0], phot_files[2]]
+    assert is_closed(hdus[phot_files[1]])
+    assert not is_closed(hdus[phot_files[0]]) and not is_closed(hdus[phot_files[2]])
+
+    cache.clear()
+    assert all(is_closed(phot_HDU) for phot_HDU in hdus.values())
+
+
+def test_evicted_file_stays_open_while_in_use(release):
+    phot_files = release['phot_files']
+    cache = PhotFileCache(maxsize=1)
+    with afits.open(phot_files[0]) as phot_HDU:
+        expected = np.array(phot_HDU[1].data['FLUXCAL'])
+
+    with cache.open(phot_files[0]) as phot_HDU:
+        # Another thread evicts the file while this one is still reading it
+        thread = threading.Thread(target=lambda: cache.open(phot_files[1]).__enter__())
+        thread.start()
+        thread.join()
+        assert list(cache._entries) == [phot_files[1]]
+        assert not is_closed(phot_HDU)
+        np.testing.assert_array_equal(phot_HDU[1].data['FLUXCAL'], expected)
+    assert is_closed(phot_HDU)
+
+
+def test_concurrent_eviction(release):
+    phot_files = release['phot_files']
+    cache = PhotFileCache(maxsize=1)
+    expected = {}
+    for phot_file in phot_files:
+        with afits.open(phot_file) as phot_HDU:
+            expected[phot_file] = np.array(phot_HDU[1].data['MJD'])
+    errors = []
+
+    def read_files(seed):
+        rng = np.random.RandomState(seed)
+        try:
+            for i in range(200):
+                phot_file = phot_files[rng.randint(len(phot_files))]
+                with cache.open(phot_file) as phot_HDU:
+                    np.testing.assert_array_equal(np.array(phot_HDU[1].data['MJD']), expected[phot_file])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=read_files, args=(seed,)) for seed in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(cache._entries) == 1
+    assert all(entry.nusers == 0 for entry in cache._entries.values())
+
+
+def test_gzipped_files_are_decompressed_once(release, tmp_path):
+    phot_file = release['phot_files'][0]
+    with open(phot_file, 'rb') as f_in, gzip.open(str(tmp_path / 'PHOT.FITS.gz'), 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    cache = PhotFileCache(cache_dir=str(tmp_path / 'cache'))
+
+    local_file = cache.get_local_copy(str(tmp_path / 'PHOT.FITS.gz'))
+    with open(local_file, 'rb') as f1, open(phot_file, 'rb') as f2:
+        assert f1.read() == f2.read()
+    assert cache.get_local_copy(str(tmp_path / 'PHOT.FITS.gz')) == local_file
+    assert cache.get_local_copy(phot_file) == phot_file
+
+
+def gzip_files(phot_files, tmp_path):
+    gz_files = []
+    for i, phot_file in enumerate(phot_files):
+        gz_files.append(str(tmp_path / '{}_PHOT.FITS.gz'.format(i)))
+        with open(phot_file, 'rb') as f_in, gzip.open(gz_files[-1], 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+    return gz_files
+
+
+def test_decompressed_copies_are_deleted_when_closed(release, tmp_path):
+    gz_files = gzip_files(release['phot_files'][:2], tmp_path)
+    cache = PhotFileCache(maxsize=1, cache_dir=str(tmp_path / 'cache'))
+
+    with cache.open(gz_files[0]) as phot_HDU:
+        first_copy = cache._entries[gz_files[0]].local_file
+        with cache.open(gz_files[1]):
+            # The first file is evicted, but its copy is kept until it is released
+            assert os.path.isfile(first_copy)
+        np.testing.assert_array_equal(phot_HDU[1].data['MJD'], afits.getdata(release['phot_files'][0], 1)['MJD'])
+    assert not os.path.exists(first_copy)
+    assert os.listdir(str(tmp_path / 'cache')) == [os.path.basename(cache._entries[gz_files[1]].local_file)]
+
+    cache.clear()
+    assert os.listdir(str(tmp_path / 'cache')) == []
+
+
+def test_files_are_decompressed_outside_the_lock(release, tmp_path, monkeypatch):
+    gz_file = gzip_files(release['phot_files'][:1], tmp_path)[0]
+    cache = PhotFileCache(cache_dir=str(tmp_path / 'cache'))
+    decompressing, finish = threading.Event(), threading.Event()
+    get_local_copy = cache.get_local_copy
+
+    def slow_get_local_copy(phot_file):
+        decompressing.set()
+        finish.wait(30)
+        return get_local_copy(phot_file)
+
+    monkeypatch.setattr(cache, 'get_local_copy', slow_get_local_copy)
+    results = []
+    readers = [threading.Thread(target=lambda: results.append(cache.acquire(gz_file))) for i in range(2)]
+    readers[0].start()
+    assert decompressing.wait(30)
+    readers[1].start()
+
+    # Other files are opened while the gzipped file is being decompressed
+    with cache.open(release['phot_files'][1]) as phot_HDU:
+        assert len(phot_HDU[1].data) > 0
+    assert results == []
+
+    finish.set()
+    for reader in readers:
+        reader.join(30)
+    # The second reader waited for the file opened by the first one
+    assert len(results) == 2 and results[0] is results[1]
+    assert results[0].nusers == 2 and len(results[0].phot_HDU[1].data) > 0
+    for entry in results:
+        cache.release(entry)
+    cache.clear()
+
+
+def test_open_error_keeps_its_cause(tmp_path, monkeypatch):
+    monkeypatch.setattr(get_data.helpers, 'call_with_retries', lambda func: func())
+    bad_file = str(tmp_path / 'PHOT.FITS')
+    with open(bad_file, 'wb') as f:
+        f.write(b'not a fits file')
+    cache = PhotFileCache()
+
+    with pytest.raises(RuntimeError, match='Could not open photometry file') as excinfo:
+        cache.acquire(bad_file)
+    assert excinfo.value.__cause__ is not None
+    assert str(excinfo.value.__cause__) in str(excinfo.value)
+    assert bad_file not in cache._entries
@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from astrorapid.prepare_arrays import PrepareTrainingSetArrays, LazyIndexedArray, get_train_test_indices, \
+    extend_train_test_indices
+from astrorapid.light_curve_store import LightCurveStoreReader
+from astrorapid.artifact_cache import ArtifactCache
+
+
+def prepare_arrays(fpath, **kwargs):
+    kwargs = dict(dict(passbands=('g', 'r'), contextual_info=(0,), reread=True, bcut=False, zcut=None, nchunks=5),
+                  **kwargs)
+    preparearrays = PrepareTrainingSetArrays(**kwargs)
+    X_train, X_test, y_train, y_test, labels_train, labels_test, class_names, class_weights, sample_weights, \
+        timesX_train, timesX_test, orig_lc_train, orig_lc_test, objids_train, objids_test = \
+        preparearrays.prepare_training_set_arrays(fpath, '')
+    return {'X': (X_train, X_test), 'y': (y_train, y_test), 'labels': (labels_train, labels_test),
+            'timesX': (timesX_train, timesX_test), 'orig_lc': (orig_lc_train, orig_lc_test),
+            'objids': (objids_train, objids_test), 'sample_weights': sample_weights, 'class_weights': class_weights,
+            'preparearrays': preparearrays}
+
+
+def test_rows_match_their_objects(saved_light_curves, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    arrays = prepare_arrays(saved_light_curves)
+
+    with LightCurveStoreReader(saved_light_curves) as reader:
+        nobjects = len(reader)
+        store_objids = list(reader.objids)
+        for part in range(2):
+            objids = np.asarray(arrays['objids'][part]).astype(str)
+            for i, objid in enumerate(objids):
+                data = reader.get_light_curve(objid)
+                pd.testing.assert_frame_equal(arrays['orig_lc'][part][i], data)
+                assert arrays['labels'][part][i] == int(objid.split('_')[1])
+                tinterp, len_t = arrays['preparearrays'].get_t_interp(data)
+                np.testing.assert_allclose(np.asarray(arrays['timesX'][part][i])[:len_t], tinterp)
+
+    objids = np.concatenate([np.asarray(arrays['objids'][part]).astype(str) for part in range(2)])
+    rejects = pd.read_csv(arrays['preparearrays'].get_array_path('rejects', saved_light_curves, ext='.csv'), dtype=str)
+    assert len(objids) + len(rejects) == nobjects
+    assert set(objids) | set(rejects['objid']) == set(store_objids)
+    # The rows are shuffled, not in the order of the store
+    assert list(objids) != [objid for objid in store_objids if objid in set(objids)]
+
+
+def test_store_and_pandas_inputs_give_the_same_arrays(saved_light_curves, saved_light_curves_pandas, tmp_path,
+                                                      monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    def by_objid(arrays):
+        objids = np.concatenate([np.asarray(arrays['objids'][part]).astype(str) for part in range(2)])
+        X = np.concatenate([np.asarray(arrays['X'][part]) for part in range(2)])
+        return {objid: X[i] for i, objid in enumerate(objids)}
+
+    X_store = by_objid(prepare_arrays(saved_light_curves))
+    X_pandas = by_objid(prepare_arrays(saved_light_curves_pandas))
+    assert sorted(X_store) == sorted(X_pandas)
+    for objid in X_store:
+        np.testing.assert_allclose(X_store[objid], X_pandas[objid], rtol=1e-6)
+
+
+def test_stratified_split_with_sparse_labels(saved_light_curves, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    arrays = prepare_arrays(saved_light_curves, stratify=True, sparse_labels=True)
+
+    # The training set rows are not contiguous, so they are read lazily
+    X_train, y_train = arrays['X'][0], arrays['y'][0]
+    assert isinstance(X_train, LazyIndexedArray) and isinstance(y_train, LazyIndexedArray)
+    y_train = np.asarray(y_train)
+    assert y_train.shape == X_train.shape[:2]
+
+    # Every timestep has the class weight of its object, like the per-object weights of one-hot labels
+    sample_weights = arrays['sample_weights']
+    assert sample_weights.shape == y_train.shape
+    classes, counts = np.unique(arrays['labels'][0], return_counts=True)
+    object_weights = (counts.max() / counts)[np.searchsorted(classes, arrays['labels'][0])]
+    np.testing.assert_allclose(sample_weights, np.broadcast_to(object_weights[:, None], y_train.shape))
+    np.testing.assert_allclose(np.unique(object_weights), np.unique(list(arrays['class_weights'].values())))
+
+
+@pytest.mark.parametrize('stratify', [False, True])
+def test_extend_train_test_indices(stratify):
+    rng = np.random.RandomState(0)
+    labels = rng.randint(1, 4, 200)
+    idx_train, idx_test = get_train_test_indices(120, labels=labels[:120], stratify=stratify)
+    new_train, new_test = extend_train_test_indices(idx_train, idx_test, 200, labels=labels, stratify=stratify)
+
+    np.testing.assert_array_equal(new_train[new_train < 120], idx_train)
+    np.testing.assert_array_equal(new_test[new_test < 120], idx_test)
+    np.testing.assert_array_equal(np.sort(np.concatenate([new_train, new_test])), np.arange(200))
+    assert np.sum(new_train >= 120) == 48
+
+    # Too few new objects of a class to stratify them
+    new_train, new_test = extend_train_test_indices(idx_train, idx_test, 122, labels=labels, stratify=stratify)
+    assert len(new_train) + len(new_test) == 122
+
+
+def get_objid_sets(arrays):
+    return [set(np.asarray(arrays['objids'][part]).astype(str)) for part in range(2)]
+
+
+@pytest.mark.parametrize('use_cache', [False, True])
+@pytest.mark.parametrize('stratify', [False, True])
+def test_extended_arrays_keep_their_split(growing_light_curves, tmp_path, monkeypatch, use_cache, stratify):
+    monkeypatch.chdir(tmp_path)
+    fname, append_objects = growing_light_curves
+
+    def prepare(**kwargs):
+        cache = ArtifactCache(str(tmp_path / 'cache')) if use_cache else None
+        return prepare_arrays(fname, stratify=stratify, cache=cache, **kwargs)
+
+    train, test = get_objid_sets(prepare())
+    assert get_objid_sets(prepare(reread=False)) == [train, test]
+
+    append_objects()
+    new_train, new_test = get_objid_sets(prepare(reread=False, extend=True))
+    assert train < new_train and test < new_test
+    assert not new_train & new_test
+    with LightCurveStoreReader(fname) as reader:
+        assert len(new_train | new_test) > len(train | test) and new_train | new_test <= set(reader.objids)
+
+    # The split is reused when the arrays are loaded again
+    assert get_objid_sets(prepare(reread=False)) == [new_train, new_test]
+
+
+def test_stream_keeps_the_saved_class_numbers(saved_light_curves, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    sparse = prepare_arrays(saved_light_curves, sparse_labels=True)
+    streamed = prepare_arrays(saved_light_curves, reread=False, stream=True)
+    assert sparse['preparearrays'].class_lut is None
+
+    class_lut = streamed['preparearrays'].class_lut
+    for part in range(2):
+        y = streamed['y'][part]
+        # The labels are a view of the memmapped array, not read into memory
+        assert isinstance(y, (np.memmap, LazyIndexedArray)) and y.ndim == 2
+        np.testing.assert_array_equal(class_lut[np.asarray(y)], np.asarray(sparse['y'][part]))
@@ -0,0 +1,79 @@
+import threading
+import numpy as np
+import pytest
+
+from astrorapid.classify import Classify
+from astrorapid.example import get_example_light_curve
+from astrorapid.serve import MicroBatcher, ClassificationClient, make_server, light_curve_from_json
+
+
+def get_light_curves(n):
+    """ The example light curve n times with different objids and shifted times """
+    mjd, flux, fluxerr, passband, zeropoint, photflag, ra, dec, objid, redshift, mwebv = get_example_light_curve()
+    return [light_curve_from_json([np.asarray(mjd) + i, flux, fluxerr, passband, zeropoint, photflag, ra, dec,
+                                   'object_{}'.format(i), redshift, mwebv]) for i in range(n)]
+
+
+@pytest.fixture
+def service(tiny_model):
+    batcher = MicroBatcher(model=tiny_model, max_batch_size=16, max_wait=0.5)
+    server = make_server(batcher, port=0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield batcher, server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def test_concurrent_requests_are_batched(service, tiny_model, capsys):
+    batcher, port = service
+    light_curves = get_light_curves(8)
+    # Light curves without r band observations are removed by the cuts, and the ones without a trigger fail
+    mjd, flux, fluxerr, passband, zeropoint, photflag, ra, dec, objid, redshift, mwebv = light_curves[0]
+    no_r_band = (mjd, flux, fluxerr, np.full(len(mjd), 'g'), zeropoint, photflag, ra, dec, 'no_r_band', redshift,
+                 mwebv)
+    no_trigger = (mjd, flux, fluxerr, passband, zeropoint, np.zeros(len(mjd), dtype=int), ra, dec, 'no_trigger',
+                  redshift, mwebv)
+    capsys.readouterr()
+
+    results = {}
+    errors = {}
+    requests = light_curves + [no_r_band, no_trigger]
+    barrier = threading.Barrier(len(requests))
+
+    def classify(light_curve):
+        client = ClassificationClient(port=port)
+        barrier.wait()
+        try:
+            results[light_curve[8]] = client.classify([light_curve])
+        except RuntimeError as e:
+            errors[light_curve[8]] = e
+        client.close()
+
+    threads = [threading.Thread(target=classify, args=(light_curve,)) for light_curve in requests]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(60)
+
+    # Batches are classified without printing
+    assert capsys.readouterr().out == ''
+
+    client = ClassificationClient(port=port)
+    stats = client.stats()
+    client.close()
+    assert stats['requests'] == stats['light_curves'] == len(requests)
+    assert stats['batches'] < len(requests)
+    assert sum(int(size) * count for size, count in stats['batch_size_histogram'].items()) == len(requests)
+    assert stats['queue_depth'] == 0 and stats['max_queue_depth'] > 1
+
+    y_predict, time_steps = Classify(light_curves, model=tiny_model).get_predictions()
+    for i, light_curve in enumerate(light_curves):
+        class_names, (result,) = results[light_curve[8]]
+        assert class_names == batcher.class_names
+        assert result['objid'] == light_curve[8]
+        np.testing.assert_allclose(result['probabilities'], y_predict[i], rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(result['mjd'], time_steps[i])
+    assert results['no_r_band'][1] == [None]
+    assert list(errors) == ['no_trigger']
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+
+from astrorapid.classify import Classify
+from astrorapid.example import get_example_light_curve
+from astrorapid.single_object import SingleObjectClassifier, get_galactic_latitude
+
+
+def get_light_curves():
+    """ The example light curve, with fewer observations, at another position and without the flux of one band """
+    light_curve = get_example_light_curve()
+    mjd, flux, fluxerr, passband, zeropoint, photflag, ra, dec, objid, redshift, mwebv = \
+        [np.asarray(a) if isinstance(a, list) else a for a in light_curve]
+    keep = np.arange(len(mjd)) < 40
+    keep[np.flatnonzero(photflag == 6144)] = True
+    return [light_curve,
+            (mjd[keep], flux[keep], fluxerr[keep], passband[keep], zeropoint[keep], photflag[keep], ra, dec,
+             'fewer_observations', redshift, mwebv),
+            (mjd, flux, fluxerr, passband, zeropoint, photflag, 10., -60., 'other_position', 0.3, mwebv),
+            (mjd, np.where(passband == 'g', 0., flux), fluxerr, passband, zeropoint, photflag, ra, dec, 'flat_g',
+             redshift, mwebv)]
+
+
+def test_galactic_latitude():
+    rng = np.random.RandomState(0)
+    for ra, dec in zip(rng.uniform(0, 360, 20), rng.uniform(-90, 90, 20)):
+        expected = SkyCoord(ra=ra * u.degree, dec=dec * u.degree, frame='icrs').galactic.b.degree
+        assert get_galactic_latitude(ra, dec) == pytest.approx(expected, abs=1e-6)
+
+
+@pytest.mark.parametrize('return_predictions_at_obstime', [False, True])
+def test_predictions_match_classify(tiny_model, return_predictions_at_obstime):
+    classifier = SingleObjectClassifier(model=tiny_model)
+    light_curves = get_light_curves()
+    y_predict_classify, time_steps_classify = Classify(light_curves, model=tiny_model).get_predictions(
+        return_predictions_at_obstime=return_predictions_at_obstime)
+
+    for i, light_curve in enumerate(light_curves):
+        y_predict, time_steps = classifier.get_predictions(light_curve, return_predictions_at_obstime)
+        np.testing.assert_allclose(time_steps, time_steps_classify[i], rtol=1e-12)
+        np.testing.assert_allclose(y_predict, y_predict_classify[i], rtol=1e-4, atol=1e-6)
+
+
+def test_cuts_match_classify(tiny_model):
+    light_curve = get_example_light_curve()
+    mjd, flux, fluxerr, passband, zeropoint, photflag, ra, dec, objid, redshift, mwebv = light_curve
+    no_r_band = (mjd, flux, fluxerr, ['g'] * len(mjd), zeropoint, photflag, ra, dec, objid, redshift, mwebv)
+    for kwargs, cut_light_curve in (({}, no_r_band), ({'zcut': redshift / 2}, light_curve),
+                                    ({'bcut': True}, light_curve[:6] + (266.4, -28.9) + light_curve[8:])):
+        assert SingleObjectClassifier(model=tiny_model, **kwargs).get_predictions(cut_light_curve) == (None, None)
+        assert Classify([cut_light_curve], model=tiny_model, **kwargs).get_predictions() == (None, None)
@@ -0,0 +1,57 @@
+import numpy as np
+
+from astrorapid import data_loader, train_neural_network
+from astrorapid.prepare_arrays import LazyIndexedArray
+from astrorapid.train_neural_network import train_model
+
+
+def test_train_on_lazy_arrays_without_streaming(tmp_path):
+    rng = np.random.RandomState(0)
+    X = rng.uniform(0, 1, (30, 50, 2)).astype(np.float32)
+    y = rng.randint(0, 3, (30, 50))
+    idx_train, idx_test = np.array([0, 2, 5, 7, 9, 11, 13, 20, 22, 25]), np.array([1, 3, 4, 6, 8])
+
+    model = train_model(LazyIndexedArray(X, idx_train), LazyIndexedArray(X, idx_test), LazyIndexedArray(y, idx_train),
+                        LazyIndexedArray(y, idx_test), sample_weights=np.ones((10, 50), dtype=np.float32),
+                        fig_dir=str(tmp_path), epochs=1, num_classes=3, stream=False)
+    assert model.predict(X[:2]).shape == (2, 50, 3)
+
+
+def test_stream_memmapped_class_numbers(tmp_path, monkeypatch):
+    rng = np.random.RandomState(0)
+    nobjects = 200
+    np.save(str(tmp_path / 'X.npy'), rng.uniform(0, 1, (nobjects, 50, 2)).astype(np.float32))
+    # Saved class numbers 0 (pre-explosion), 1 and 3, mapped to the class indexes 0, 1 and 2
+    np.save(str(tmp_path / 'y.npy'), rng.choice([0, 1, 3], (nobjects, 50)).astype(np.uint8))
+    X = np.load(str(tmp_path / 'X.npy'), mmap_mode='r')
+    y = np.load(str(tmp_path / 'y.npy'), mmap_mode='r')
+    class_lut = np.array([0, 1, 0, 2], dtype=np.uint8)
+
+    one_hot_shapes = []
+
+    def to_categorical(y, num_classes=None):
+        one_hot = np.eye(num_classes, dtype=np.float32)[y]
+        one_hot_shapes.append(one_hot.shape)
+        return one_hot
+
+    monkeypatch.setattr(data_loader, 'to_categorical', to_categorical)
+    monkeypatch.setattr(train_neural_network, 'to_categorical', to_categorical)
+
+    idx_train = np.arange(0, nobjects, 2)
+    model = train_model(LazyIndexedArray(X, idx_train), X[1::2], LazyIndexedArray(y, idx_train), y[1::2],
+                        sample_weights=np.ones(len(idx_train)), fig_dir=str(tmp_path), epochs=1, num_classes=3,
+                        stream=True, sparse_labels=False, class_lut=class_lut)
+    assert model.loss == 'categorical_crossentropy'
+    assert model.predict(X[:2]).shape == (2, 50, 3)
+
+    # The labels are only one-hot encoded one batch at a time
+    assert one_hot_shapes and all(shape[0] <= 64 and shape[1:] == (50, 3) for shape in one_hot_shapes)
+
+
+def test_training_sequence_maps_class_numbers():
+    y = np.array([[0, 1, 3], [3, 3, 0]], dtype=np.uint8)
+    class_lut = np.array([0, 1, 0, 2], dtype=np.uint8)
+    sequence = data_loader.TrainingSequence(np.zeros((2, 3, 1)), y, batch_size=2, shuffle=False, num_classes=3,
+                                            class_lut=class_lut)
+    X_batch, y_batch = sequence[0]
+    np.testing.assert_array_equal(np.argmax(y_batch, axis=-1), class_lut[y])
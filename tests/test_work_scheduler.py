@@ -0,0 +1,97 @@
+import time
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import pytest
+
+from astrorapid.parallelism import make_pool
+from astrorapid.work_scheduler import AdaptiveChunkScheduler
+
+
+def copy_chunk(chunk):
+    offset, items = chunk
+    return offset, np.array(items)
+
+
+def sleep_per_item(chunk):
+    offset, items = chunk
+    time.sleep(0.001 * len(items))
+    return offset, np.array(items)
+
+
+def fail_on_item_13(chunk):
+    offset, items = chunk
+    if 13 in items:
+        raise ValueError("bad item")
+    return offset, np.array(items)
+
+
+def test_chunk_size():
+    scheduler = AdaptiveChunkScheduler(None, 4, target_chunk_time=2., initial_chunk_size=8, min_chunk_size=3,
+                                       max_chunk_size=500)
+    # The first chunks measure the time per object
+    assert scheduler.get_chunk_size(10000) == 8
+    assert scheduler.get_chunk_size(40) == 5
+    assert scheduler.get_chunk_size(5) == 3
+
+    scheduler.nobjects_timed, scheduler.busy_time = 100, 1.
+    assert scheduler.get_chunk_size(10000) == 200
+    # Slow objects give small chunks, down to min_chunk_size, and fast objects large ones, up to max_chunk_size
+    scheduler.busy_time = 100.
+    assert scheduler.get_chunk_size(10000) == 3
+    scheduler.busy_time = 0.01
+    assert scheduler.get_chunk_size(100000) == 500
+    # Towards the end a chunk is at most a share of the remaining objects for each worker
+    assert scheduler.get_chunk_size(800) == 100
+    assert scheduler.get_chunk_size(16) == 3
+    assert scheduler.get_chunk_size(2) == 2
+
+
+def test_nworkers_default_to_the_thread_budget(monkeypatch):
+    monkeypatch.setenv('ASTRORAPID_NUM_WORKERS', '3')
+    assert AdaptiveChunkScheduler(None).nworkers == 3
+    assert AdaptiveChunkScheduler(None, 2).nworkers == 2
+
+
+def check_chunks(results, items):
+    """ The chunks are consecutive and cover the items once """
+    results = sorted(results, key=lambda result: result[0])
+    offset = 0
+    for chunk_offset, chunk_items in results:
+        assert chunk_offset == offset
+        np.testing.assert_array_equal(chunk_items, items[offset:offset + len(chunk_items)])
+        offset += len(chunk_items)
+    assert offset == len(items)
+
+
+@pytest.mark.parametrize('nitems', [0, 1, 7, 1000])
+def test_imap_unordered_covers_the_items(nitems):
+    items = np.arange(nitems) * 10
+    pool = ThreadPool(3)
+    scheduler = AdaptiveChunkScheduler(pool, 3, target_chunk_time=0.01, initial_chunk_size=4)
+    results = list(scheduler.imap_unordered(sleep_per_item, items))
+    pool.close()
+    pool.join()
+
+    check_chunks(results, items)
+    assert scheduler.nobjects_timed == nitems
+    if nitems == 1000:
+        # The chunks grow from the measured time per object
+        assert max(len(chunk_items) for offset, chunk_items in results) > 4
+
+
+def test_imap_unordered_with_processes():
+    items = np.arange(500)
+    pool = make_pool(2)
+    results = list(AdaptiveChunkScheduler(pool, 2, initial_chunk_size=16).imap_unordered(copy_chunk, items))
+    pool.close()
+    pool.join()
+    check_chunks(results, items)
+
+
+def test_imap_unordered_raises_errors_of_the_workers():
+    pool = ThreadPool(2)
+    scheduler = AdaptiveChunkScheduler(pool, 2, initial_chunk_size=4)
+    with pytest.raises(ValueError, match="bad item"):
+        list(scheduler.imap_unordered(fail_on_item_13, np.arange(100)))
+    pool.terminate()
+    pool.join()